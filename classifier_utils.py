@@ -25,11 +25,15 @@ from albert import fine_tuning_utils
 from albert import modeling
 from albert import optimization
 from albert import tokenization
+import numpy as np
 import tensorflow.compat.v1 as tf
 from tensorflow.contrib import data as contrib_data
 from tensorflow.contrib import metrics as contrib_metrics
 from tensorflow.contrib import tpu as contrib_tpu
 
+# The number of examples whose features are assembled together.
+_CONVERSION_BATCH_SIZE = 1024
+
 
 class InputExample(object):
   """A single training/test example for simple sequence classification."""
@@ -85,6 +89,35 @@ class InputFeatures(object):
     self.is_real_example = is_real_example
 
 
+class TsvColumns(object):
+  """Declares where the fields of the examples are in a GLUE tsv file.
+
+  Column indices may be negative. A `guid` of None names the examples
+  "<set_type>-<line index>", and a `label` of None gives every example
+  `default_label`.
+  """
+
+  def __init__(self,
+               text_a,
+               text_b=None,
+               label=None,
+               guid=None,
+               default_label=None,
+               label_fn=None,
+               process_guid=True,
+               has_header=True,
+               skip_short_rows=False):
+    self.text_a = text_a
+    self.text_b = text_b
+    self.label = label
+    self.guid = guid
+    self.default_label = default_label
+    self.label_fn = label_fn
+    self.process_guid = process_guid
+    self.has_header = has_header
+    self.skip_short_rows = skip_short_rows
+
+
 class DataProcessor(object):
   """Base class for data converters for sequence classification data sets."""
 
@@ -109,6 +142,10 @@ class DataProcessor(object):
     """Gets the list of labels for this data set."""
     raise NotImplementedError()
 
+  def get_tsv_columns(self, set_type):
+    """Gets the `TsvColumns` layout of the tsv file of `set_type`."""
+    raise NotImplementedError()
+
   @classmethod
   def _read_tsv(cls, input_file, quotechar=None):
     """Reads a tab separated value file."""
@@ -119,6 +156,66 @@ class DataProcessor(object):
         lines.append(line)
       return lines
 
+  @classmethod
+  def _read_tsv_columns(cls, input_file, columns, quotechar=None):
+    """Reads the columns declared by `columns` from a tsv file in one pass.
+
+    Returns:
+      A dict from "line_index", "guid", "text_a", "text_b" and "label" to a
+      list with one raw value per row. Fields without a column are missing.
+    """
+    names = ["guid", "text_a", "text_b", "label"]
+    names = [name for name in names if getattr(columns, name) is not None]
+    indices = [getattr(columns, name) for name in names]
+    line_indices = []
+    rows = []
+    with tf.gfile.Open(input_file, "r") as f:
+      reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
+      for (i, line) in enumerate(reader):
+        if i == 0 and columns.has_header:
+          continue
+        try:
+          rows.append([line[j] for j in indices])
+        except IndexError:
+          if columns.skip_short_rows:
+            continue
+          raise
+        line_indices.append(i)
+    data = {"line_index": line_indices}
+    values = list(zip(*rows)) if rows else [()] * len(names)
+    for (name, column) in zip(names, values):
+      data[name] = list(column)
+    return data
+
+  def _read_examples(self, input_file, set_type):
+    """Reads the `InputExample`s of `set_type` from a tsv file."""
+    columns = self.get_tsv_columns(set_type)
+    data = self._read_tsv_columns(input_file, columns)
+    num_rows = len(data["line_index"])
+
+    if columns.guid is None:
+      guids = ["%s-%s" % (set_type, i) for i in data["line_index"]]
+    elif columns.process_guid:
+      guids = [self.process_text(guid) for guid in data["guid"]]
+    else:
+      guids = data["guid"]
+    texts_a = [self.process_text(text) for text in data["text_a"]]
+    if columns.text_b is None:
+      texts_b = [None] * num_rows
+    else:
+      texts_b = [self.process_text(text) for text in data["text_b"]]
+    if columns.label is None:
+      labels = [columns.default_label] * num_rows
+    else:
+      label_fn = columns.label_fn or self.process_text
+      labels = [label_fn(label) for label in data["label"]]
+
+    return [
+        InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label)
+        for (guid, text_a, text_b, label) in zip(guids, texts_a, texts_b,
+                                                 labels)
+    ]
+
   def process_text(self, text):
     if self.use_spm:
       return tokenization.preprocess_text(text, lower=self.do_lower_case)
@@ -131,42 +228,30 @@ class MnliProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "MNLI", "train.tsv")), "train")
+    return self._read_examples(
+        os.path.join(data_dir, "MNLI", "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "MNLI", "dev_matched.tsv")),
-        "dev_matched")
+    return self._read_examples(
+        os.path.join(data_dir, "MNLI", "dev_matched.tsv"), "dev_matched")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "MNLI", "test_matched.tsv")),
-        "test")
+    return self._read_examples(
+        os.path.join(data_dir, "MNLI", "test_matched.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return ["contradiction", "entailment", "neutral"]
 
-  def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
-      if i == 0:
-        continue
-      # Note(mingdachen): We will rely on this guid for GLUE submission.
-      guid = self.process_text(line[0])
-      text_a = self.process_text(line[8])
-      text_b = self.process_text(line[9])
-      if set_type == "test":
-        label = "contradiction"
-      else:
-        label = self.process_text(line[-1])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+  def get_tsv_columns(self, set_type):
+    """See base class."""
+    # Note(mingdachen): We will rely on this guid for GLUE submission.
+    if set_type == "test":
+      return TsvColumns(guid=0, text_a=8, text_b=9,
+                        default_label="contradiction")
+    return TsvColumns(guid=0, text_a=8, text_b=9, label=-1)
 
 
 class MisMnliProcessor(MnliProcessor):
@@ -174,15 +259,13 @@ class MisMnliProcessor(MnliProcessor):
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "MNLI", "dev_mismatched.tsv")),
-        "dev")
+    return self._read_examples(
+        os.path.join(data_dir, "MNLI", "dev_mismatched.tsv"), "dev")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "MNLI", "test_mismatched.tsv")),
-        "test")
+    return self._read_examples(
+        os.path.join(data_dir, "MNLI", "test_mismatched.tsv"), "test")
 
 
 class MrpcProcessor(DataProcessor):
@@ -190,40 +273,28 @@ class MrpcProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "MRPC", "train.tsv")), "train")
+    return self._read_examples(
+        os.path.join(data_dir, "MRPC", "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "MRPC", "dev.tsv")), "dev")
+    return self._read_examples(os.path.join(data_dir, "MRPC", "dev.tsv"), "dev")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "MRPC", "test.tsv")), "test")
+    return self._read_examples(
+        os.path.join(data_dir, "MRPC", "test.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return ["0", "1"]
 
-  def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
-      if i == 0:
-        continue
-      guid = "%s-%s" % (set_type, i)
-      text_a = self.process_text(line[3])
-      text_b = self.process_text(line[4])
-      if set_type == "test":
-        guid = line[0]
-        label = "0"
-      else:
-        label = self.process_text(line[0])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+  def get_tsv_columns(self, set_type):
+    """See base class."""
+    if set_type == "test":
+      return TsvColumns(guid=0, text_a=3, text_b=4, default_label="0",
+                        process_guid=False)
+    return TsvColumns(text_a=3, text_b=4, label=0)
 
 
 class ColaProcessor(DataProcessor):
@@ -231,41 +302,29 @@ class ColaProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "CoLA", "train.tsv")), "train")
+    return self._read_examples(
+        os.path.join(data_dir, "CoLA", "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "CoLA", "dev.tsv")), "dev")
+    return self._read_examples(os.path.join(data_dir, "CoLA", "dev.tsv"), "dev")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "CoLA", "test.tsv")), "test")
+    return self._read_examples(
+        os.path.join(data_dir, "CoLA", "test.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return ["0", "1"]
 
-  def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
-      # Only the test set has a header
-      if set_type == "test" and i == 0:
-        continue
-      guid = "%s-%s" % (set_type, i)
-      if set_type == "test":
-        guid = line[0]
-        text_a = self.process_text(line[1])
-        label = "0"
-      else:
-        text_a = self.process_text(line[3])
-        label = self.process_text(line[1])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=None, label=label))
-    return examples
+  def get_tsv_columns(self, set_type):
+    """See base class."""
+    # Only the test set has a header
+    if set_type == "test":
+      return TsvColumns(guid=0, text_a=1, default_label="0",
+                        process_guid=False)
+    return TsvColumns(text_a=3, label=1, has_header=False)
 
 
 class Sst2Processor(DataProcessor):
@@ -273,41 +332,28 @@ class Sst2Processor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "SST-2", "train.tsv")), "train")
+    return self._read_examples(
+        os.path.join(data_dir, "SST-2", "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "SST-2", "dev.tsv")), "dev")
+    return self._read_examples(
+        os.path.join(data_dir, "SST-2", "dev.tsv"), "dev")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "SST-2", "test.tsv")), "test")
+    return self._read_examples(
+        os.path.join(data_dir, "SST-2", "test.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return ["0", "1"]
 
-  def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
-      if i == 0:
-        continue
-      if set_type != "test":
-        guid = "%s-%s" % (set_type, i)
-        text_a = self.process_text(line[0])
-        label = self.process_text(line[1])
-      else:
-        guid = self.process_text(line[0])
-        # guid = "%s-%s" % (set_type, line[0])
-        text_a = self.process_text(line[1])
-        label = "0"
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=None, label=label))
-    return examples
+  def get_tsv_columns(self, set_type):
+    """See base class."""
+    if set_type == "test":
+      return TsvColumns(guid=0, text_a=1, default_label="0")
+    return TsvColumns(text_a=0, label=1)
 
 
 class StsbProcessor(DataProcessor):
@@ -315,40 +361,28 @@ class StsbProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "STS-B", "train.tsv")), "train")
+    return self._read_examples(
+        os.path.join(data_dir, "STS-B", "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "STS-B", "dev.tsv")), "dev")
+    return self._read_examples(
+        os.path.join(data_dir, "STS-B", "dev.tsv"), "dev")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "STS-B", "test.tsv")), "test")
+    return self._read_examples(
+        os.path.join(data_dir, "STS-B", "test.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return [None]
 
-  def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
-      if i == 0:
-        continue
-      guid = self.process_text(line[0])
-      # guid = "%s-%s" % (set_type, line[0])
-      text_a = self.process_text(line[7])
-      text_b = self.process_text(line[8])
-      if set_type != "test":
-        label = float(line[-1])
-      else:
-        label = 0
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+  def get_tsv_columns(self, set_type):
+    """See base class."""
+    if set_type == "test":
+      return TsvColumns(guid=0, text_a=7, text_b=8, default_label=0)
+    return TsvColumns(guid=0, text_a=7, text_b=8, label=-1, label_fn=float)
 
 
 class QqpProcessor(DataProcessor):
@@ -356,45 +390,29 @@ class QqpProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "QQP", "train.tsv")), "train")
+    return self._read_examples(
+        os.path.join(data_dir, "QQP", "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "QQP", "dev.tsv")), "dev")
+    return self._read_examples(os.path.join(data_dir, "QQP", "dev.tsv"), "dev")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "QQP", "test.tsv")), "test")
+    return self._read_examples(
+        os.path.join(data_dir, "QQP", "test.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return ["0", "1"]
 
-  def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
-      if i == 0:
-        continue
-      guid = line[0]
-      # guid = "%s-%s" % (set_type, line[0])
-      if set_type != "test":
-        try:
-          text_a = self.process_text(line[3])
-          text_b = self.process_text(line[4])
-          label = self.process_text(line[5])
-        except IndexError:
-          continue
-      else:
-        text_a = self.process_text(line[1])
-        text_b = self.process_text(line[2])
-        label = "0"
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+  def get_tsv_columns(self, set_type):
+    """See base class."""
+    if set_type == "test":
+      return TsvColumns(guid=0, text_a=1, text_b=2, default_label="0",
+                        process_guid=False)
+    return TsvColumns(guid=0, text_a=3, text_b=4, label=5,
+                      process_guid=False, skip_short_rows=True)
 
 
 class QnliProcessor(DataProcessor):
@@ -402,42 +420,28 @@ class QnliProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "QNLI", "train.tsv")), "train")
+    return self._read_examples(
+        os.path.join(data_dir, "QNLI", "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "QNLI", "dev.tsv")),
-        "dev_matched")
+    return self._read_examples(
+        os.path.join(data_dir, "QNLI", "dev.tsv"), "dev_matched")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "QNLI", "test.tsv")),
-        "test_matched")
+    return self._read_examples(
+        os.path.join(data_dir, "QNLI", "test.tsv"), "test_matched")
 
   def get_labels(self):
     """See base class."""
     return ["entailment", "not_entailment"]
 
-  def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
-      if i == 0:
-        continue
-      guid = self.process_text(line[0])
-      # guid = "%s-%s" % (set_type, line[0])
-      text_a = self.process_text(line[1])
-      text_b = self.process_text(line[2])
-      if set_type == "test_matched":
-        label = "entailment"
-      else:
-        label = self.process_text(line[-1])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+  def get_tsv_columns(self, set_type):
+    """See base class."""
+    if set_type == "test_matched":
+      return TsvColumns(guid=0, text_a=1, text_b=2, default_label="entailment")
+    return TsvColumns(guid=0, text_a=1, text_b=2, label=-1)
 
 
 class RteProcessor(DataProcessor):
@@ -445,40 +449,27 @@ class RteProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "RTE", "train.tsv")), "train")
+    return self._read_examples(
+        os.path.join(data_dir, "RTE", "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "RTE", "dev.tsv")), "dev")
+    return self._read_examples(os.path.join(data_dir, "RTE", "dev.tsv"), "dev")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "RTE", "test.tsv")), "test")
+    return self._read_examples(
+        os.path.join(data_dir, "RTE", "test.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return ["entailment", "not_entailment"]
 
-  def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
-      if i == 0:
-        continue
-      guid = self.process_text(line[0])
-      # guid = "%s-%s" % (set_type, line[0])
-      text_a = self.process_text(line[1])
-      text_b = self.process_text(line[2])
-      if set_type == "test":
-        label = "entailment"
-      else:
-        label = self.process_text(line[-1])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+  def get_tsv_columns(self, set_type):
+    """See base class."""
+    if set_type == "test":
+      return TsvColumns(guid=0, text_a=1, text_b=2, default_label="entailment")
+    return TsvColumns(guid=0, text_a=1, text_b=2, label=-1)
 
 
 class WnliProcessor(DataProcessor):
@@ -486,40 +477,27 @@ class WnliProcessor(DataProcessor):
 
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "WNLI", "train.tsv")), "train")
+    return self._read_examples(
+        os.path.join(data_dir, "WNLI", "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "WNLI", "dev.tsv")), "dev")
+    return self._read_examples(os.path.join(data_dir, "WNLI", "dev.tsv"), "dev")
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "WNLI", "test.tsv")), "test")
+    return self._read_examples(
+        os.path.join(data_dir, "WNLI", "test.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return ["0", "1"]
 
-  def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
-      if i == 0:
-        continue
-      guid = self.process_text(line[0])
-      # guid = "%s-%s" % (set_type, line[0])
-      text_a = self.process_text(line[1])
-      text_b = self.process_text(line[2])
-      if set_type != "test":
-        label = self.process_text(line[-1])
-      else:
-        label = "0"
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
+  def get_tsv_columns(self, set_type):
+    """See base class."""
+    if set_type == "test":
+      return TsvColumns(guid=0, text_a=1, text_b=2, default_label="0")
+    return TsvColumns(guid=0, text_a=1, text_b=2, label=-1)
 
 
 class AXProcessor(DataProcessor):
@@ -527,138 +505,182 @@ class AXProcessor(DataProcessor):
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "diagnostic", "diagnostic.tsv")),
-        "test")
+    return self._read_examples(
+        os.path.join(data_dir, "diagnostic", "diagnostic.tsv"), "test")
 
   def get_labels(self):
     """See base class."""
     return ["contradiction", "entailment", "neutral"]
 
-  def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
-    for (i, line) in enumerate(lines):
-      if i == 0:
-        continue
-      # Note(mingdachen): We will rely on this guid for GLUE submission.
-      guid = self.process_text(line[0])
-      text_a = self.process_text(line[1])
-      text_b = self.process_text(line[2])
-      if set_type == "test":
-        label = "contradiction"
-      else:
-        label = self.process_text(line[-1])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label))
-    return examples
-
-
-def convert_single_example(ex_index, example, label_list, max_seq_length,
-                           tokenizer, task_name):
-  """Converts a single `InputExample` into a single `InputFeatures`."""
-
-  if isinstance(example, PaddingInputExample):
-    return InputFeatures(
-        input_ids=[0] * max_seq_length,
-        input_mask=[0] * max_seq_length,
-        segment_ids=[0] * max_seq_length,
-        label_id=0,
-        is_real_example=False)
-
-  if task_name != "sts-b":
-    label_map = {}
-    for (i, label) in enumerate(label_list):
-      label_map[label] = i
-
-  tokens_a = tokenizer.tokenize(example.text_a)
-  tokens_b = None
-  if example.text_b:
-    tokens_b = tokenizer.tokenize(example.text_b)
-
-  if tokens_b:
-    # Modifies `tokens_a` and `tokens_b` in place so that the total
-    # length is less than the specified length.
-    # Account for [CLS], [SEP], [SEP] with "- 3"
-    _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
-  else:
-    # Account for [CLS] and [SEP] with "- 2"
-    if len(tokens_a) > max_seq_length - 2:
-      tokens_a = tokens_a[0:(max_seq_length - 2)]
-
-  # The convention in ALBERT is:
-  # (a) For sequence pairs:
-  #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-  #  type_ids: 0     0  0    0    0     0       0 0     1  1  1  1   1 1
-  # (b) For single sequences:
-  #  tokens:   [CLS] the dog is hairy . [SEP]
-  #  type_ids: 0     0   0   0  0     0 0
-  #
-  # Where "type_ids" are used to indicate whether this is the first
-  # sequence or the second sequence. The embedding vectors for `type=0` and
-  # `type=1` were learned during pre-training and are added to the
-  # embedding vector (and position vector). This is not *strictly* necessary
-  # since the [SEP] token unambiguously separates the sequences, but it makes
-  # it easier for the model to learn the concept of sequences.
-  #
-  # For classification tasks, the first vector (corresponding to [CLS]) is
-  # used as the "sentence vector". Note that this only makes sense because
-  # the entire model is fine-tuned.
-  tokens = []
-  segment_ids = []
-  tokens.append("[CLS]")
-  segment_ids.append(0)
-  for token in tokens_a:
-    tokens.append(token)
-    segment_ids.append(0)
-  tokens.append("[SEP]")
-  segment_ids.append(0)
-
-  if tokens_b:
-    for token in tokens_b:
-      tokens.append(token)
-      segment_ids.append(1)
-    tokens.append("[SEP]")
-    segment_ids.append(1)
-
-  input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-  # The mask has 1 for real tokens and 0 for padding tokens. Only real
-  # tokens are attended to.
-  input_mask = [1] * len(input_ids)
-
-  # Zero-pad up to the sequence length.
-  while len(input_ids) < max_seq_length:
-    input_ids.append(0)
-    input_mask.append(0)
-    segment_ids.append(0)
-
-  assert len(input_ids) == max_seq_length
-  assert len(input_mask) == max_seq_length
-  assert len(segment_ids) == max_seq_length
+  def get_tsv_columns(self, set_type):
+    """See base class."""
+    # Note(mingdachen): We will rely on this guid for GLUE submission.
+    if set_type == "test":
+      return TsvColumns(guid=0, text_a=1, text_b=2,
+                        default_label="contradiction")
+    return TsvColumns(guid=0, text_a=1, text_b=2, label=-1)
+
+
+def _truncated_lengths(lengths_a, lengths_b, max_length):
+  """Applies the `_truncate_seq_pair` heuristic to arrays of lengths."""
+  lengths_a = np.minimum(
+      lengths_a, np.maximum(max_length - lengths_b, (max_length + 1) // 2))
+  lengths_b = np.minimum(lengths_b, max_length - lengths_a)
+  return lengths_a, lengths_b
+
+
+def assemble_feature_arrays(ids_a, ids_b, max_seq_length, cls_id, sep_id):
+  """Packs tokenized sequences into padded `[N, max_seq_length]` arrays.
+
+  Args:
+    ids_a: list of N lists with the token ids of the first sequences.
+    ids_b: list of N lists with the token ids of the second sequences. An
+      empty list (or a `ids_b` of None) makes the example a single sequence.
+    max_seq_length: int. The length of the packed sequences.
+    cls_id: int. The id of "[CLS]".
+    sep_id: int. The id of "[SEP]".
+
+  Returns:
+    A tuple of int32 NumPy arrays (input_ids, input_mask, segment_ids).
+  """
+  num_examples = len(ids_a)
+  if ids_b is None:
+    ids_b = [[]] * num_examples
+  lengths_a = np.array([len(ids) for ids in ids_a], dtype=np.int64)
+  lengths_b = np.array([len(ids) for ids in ids_b], dtype=np.int64)
+  has_b = lengths_b > 0
+
+  # Account for [CLS], [SEP], [SEP] with "- 3" and for [CLS] and [SEP] with
+  # "- 2" for single sequences.
+  pair_a, pair_b = _truncated_lengths(lengths_a, lengths_b, max_seq_length - 3)
+  lengths_a = np.where(
+      has_b, pair_a, np.minimum(lengths_a, max_seq_length - 2))
+  lengths_b = np.where(has_b, pair_b, 0)
+
+  # The layout is [CLS] a [SEP] for single sequences and
+  # [CLS] a [SEP] b [SEP] for pairs, where the tokens of b get type 1.
+  input_ids = np.zeros([num_examples, max_seq_length], dtype=np.int32)
+  for (i, (a, b)) in enumerate(zip(ids_a, ids_b)):
+    input_ids[i, 1:1 + lengths_a[i]] = a[:lengths_a[i]]
+    if has_b[i]:
+      input_ids[i, 2 + lengths_a[i]:2 + lengths_a[i] + lengths_b[i]] = (
+          b[:lengths_b[i]])
+  rows = np.arange(num_examples)
+  input_ids[:, 0] = cls_id
+  input_ids[rows, 1 + lengths_a] = sep_id
+  input_ids[rows[has_b], (2 + lengths_a + lengths_b)[has_b]] = sep_id
+
+  seq_lengths = 2 + lengths_a + np.where(has_b, lengths_b + 1, 0)
+  positions = np.arange(max_seq_length)[None]
+  input_mask = (positions < seq_lengths[:, None]).astype(np.int32)
+  segment_ids = ((positions >= (2 + lengths_a)[:, None]) &
+                 (input_mask > 0)).astype(np.int32)
+  return input_ids, input_mask, segment_ids
+
+
+def convert_examples_to_arrays(examples, label_list, max_seq_length,
+                               tokenizer, task_name, start_index=0):
+  """Converts `InputExample`s to a dict of NumPy feature arrays.
+
+  `PaddingInputExample`s become all-zero rows with `is_real_example` 0.
+  `start_index` is the index of the first example, which is only used to
+  log the first few examples of a data set.
+  """
+  num_examples = len(examples)
+  is_real_example = np.array(
+      [not isinstance(example, PaddingInputExample) for example in examples],
+      dtype=np.int32)
+
+  ids_a = []
+  ids_b = []
+  for example in examples:
+    if isinstance(example, PaddingInputExample):
+      ids_a.append([])
+      ids_b.append([])
+      continue
+    ids_a.append(
+        tokenizer.convert_tokens_to_ids(tokenizer.tokenize(example.text_a)))
+    if example.text_b:
+      ids_b.append(
+          tokenizer.convert_tokens_to_ids(tokenizer.tokenize(example.text_b)))
+    else:
+      ids_b.append([])
+  cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+  input_ids, input_mask, segment_ids = assemble_feature_arrays(
+      ids_a, ids_b, max_seq_length, cls_id, sep_id)
+  input_ids *= is_real_example[:, None]
+  input_mask *= is_real_example[:, None]
+  segment_ids *= is_real_example[:, None]
 
   if task_name != "sts-b":
-    label_id = label_map[example.label]
+    label_map = {label: i for (i, label) in enumerate(label_list)}
+    label_ids = np.array(
+        [label_map[example.label] if is_real else 0
+         for (example, is_real) in zip(examples, is_real_example)],
+        dtype=np.int32)
   else:
-    label_id = example.label
-
-  if ex_index < 5:
+    label_ids = np.array(
+        [example.label if is_real else 0
+         for (example, is_real) in zip(examples, is_real_example)],
+        dtype=np.float32)
+
+  for i in range(max(0, min(num_examples, 5 - start_index))):
+    if not is_real_example[i]:
+      continue
+    length = int(input_mask[i].sum())
     tf.logging.info("*** Example ***")
-    tf.logging.info("guid: %s" % (example.guid))
+    tf.logging.info("guid: %s" % (examples[i].guid))
     tf.logging.info("tokens: %s" % " ".join(
-        [tokenization.printable_text(x) for x in tokens]))
-    tf.logging.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-    tf.logging.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-    tf.logging.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-    tf.logging.info("label: %s (id = %d)" % (example.label, label_id))
+        [tokenization.printable_text(x) for x in
+         tokenizer.convert_ids_to_tokens(input_ids[i, :length].tolist())]))
+    tf.logging.info("input_ids: %s" % input_ids[i])
+    tf.logging.info("input_mask: %s" % input_mask[i])
+    tf.logging.info("segment_ids: %s" % segment_ids[i])
+    tf.logging.info("label: %s (id = %s)" % (examples[i].label, label_ids[i]))
+
+  return {
+      "input_ids": input_ids,
+      "input_mask": input_mask,
+      "segment_ids": segment_ids,
+      "label_ids": label_ids,
+      "is_real_example": is_real_example,
+  }
+
+
+def _iter_feature_batches(examples, label_list, max_seq_length, tokenizer,
+                          task_name):
+  """Yields `InputFeatures` converted `_CONVERSION_BATCH_SIZE` at a time."""
+  for start in range(0, len(examples), _CONVERSION_BATCH_SIZE):
+    if start % 10000 < _CONVERSION_BATCH_SIZE:
+      tf.logging.info("Writing example %d of %d" % (start, len(examples)))
+    arrays = convert_examples_to_arrays(
+        examples[start:start + _CONVERSION_BATCH_SIZE], label_list,
+        max_seq_length, tokenizer, task_name, start_index=start)
+    columns = [arrays[name].tolist() for name in
+               ("input_ids", "input_mask", "segment_ids", "label_ids",
+                "is_real_example")]
+    for (input_ids, input_mask, segment_ids, label_id,
+         is_real_example) in zip(*columns):
+      yield InputFeatures(
+          input_ids=input_ids,
+          input_mask=input_mask,
+          segment_ids=segment_ids,
+          label_id=label_id,
+          is_real_example=bool(is_real_example))
 
-  feature = InputFeatures(
-      input_ids=input_ids,
-      input_mask=input_mask,
-      segment_ids=segment_ids,
-      label_id=label_id,
-      is_real_example=True)
-  return feature
+
+def convert_single_example(ex_index, example, label_list, max_seq_length,
+                           tokenizer, task_name):
+  """Converts a single `InputExample` into a single `InputFeatures`."""
+  arrays = convert_examples_to_arrays(
+      [example], label_list, max_seq_length, tokenizer, task_name,
+      start_index=ex_index)
+  return InputFeatures(
+      input_ids=arrays["input_ids"][0].tolist(),
+      input_mask=arrays["input_mask"][0].tolist(),
+      segment_ids=arrays["segment_ids"][0].tolist(),
+      label_id=arrays["label_ids"][0].item(),
+      is_real_example=bool(arrays["is_real_example"][0]))
 
 
 def file_based_convert_examples_to_features(
@@ -667,21 +689,16 @@ def file_based_convert_examples_to_features(
 
   writer = tf.python_io.TFRecordWriter(output_file)
 
-  for (ex_index, example) in enumerate(examples):
-    if ex_index % 10000 == 0:
-      tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
+  def create_int_feature(values):
+    f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+    return f
 
-    feature = convert_single_example(ex_index, example, label_list,
-                                     max_seq_length, tokenizer, task_name)
-
-    def create_int_feature(values):
-      f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
-      return f
-
-    def create_float_feature(values):
-      f = tf.train.Feature(float_list=tf.train.FloatList(value=list(values)))
-      return f
+  def create_float_feature(values):
+    f = tf.train.Feature(float_list=tf.train.FloatList(value=list(values)))
+    return f
 
+  for feature in _iter_feature_batches(examples, label_list, max_seq_length,
+                                       tokenizer, task_name):
     features = collections.OrderedDict()
     features["input_ids"] = create_int_feature(feature.input_ids)
     features["input_mask"] = create_int_feature(feature.input_mask)
@@ -813,11 +830,138 @@ def create_model(albert_config, is_training, input_ids, input_mask, segment_ids,
     return (loss, per_example_loss, probabilities, logits, predictions)
 
 
+def _classifier_logits(output_layer, num_labels):
+  """Applies the output layer of `create_model`, reusing its variables."""
+  hidden_size = output_layer.shape[-1].value
+  with tf.variable_scope(tf.get_variable_scope(), reuse=tf.AUTO_REUSE):
+    output_weights = tf.get_variable(
+        "output_weights", [num_labels, hidden_size],
+        initializer=tf.truncated_normal_initializer(stddev=0.02))
+    output_bias = tf.get_variable(
+        "output_bias", [num_labels], initializer=tf.zeros_initializer())
+  logits = tf.matmul(output_layer, output_weights, transpose_b=True)
+  return tf.nn.bias_add(logits, output_bias)
+
+
+def create_early_exit_model(albert_config, input_ids, input_mask, segment_ids,
+                            labels, num_labels, use_one_hot_embeddings,
+                            exit_threshold):
+  """Creates a classification model that stops at the first confident layer.
+
+  The output layer of `create_model` is applied to the pooled output of every
+  layer, and an example exits once its largest class probability reaches
+  `exit_threshold`. This is for inference only and needs a model with a
+  single hidden group.
+
+  Returns:
+    The outputs of `create_model` followed by the int32 number of layers that
+    each example went through.
+  """
+  def exit_fn(pooled_output):
+    logits = _classifier_logits(pooled_output, num_labels)
+    confidence = tf.reduce_max(tf.nn.softmax(logits, axis=-1), axis=-1)
+    return logits, confidence >= exit_threshold
+
+  model = modeling.AlbertModel(
+      config=albert_config,
+      is_training=False,
+      input_ids=input_ids,
+      input_mask=input_mask,
+      token_type_ids=segment_ids,
+      use_one_hot_embeddings=use_one_hot_embeddings,
+      exit_fn=exit_fn)
+
+  with tf.variable_scope("loss"):
+    logits = model.get_exit_outputs()
+    probabilities = tf.nn.softmax(logits, axis=-1)
+    predictions = tf.argmax(probabilities, axis=-1, output_type=tf.int32)
+    log_probs = tf.nn.log_softmax(logits, axis=-1)
+    one_hot_labels = tf.one_hot(labels, depth=num_labels, dtype=tf.float32)
+    per_example_loss = -tf.reduce_sum(one_hot_labels * log_probs, axis=-1)
+    loss = tf.reduce_mean(per_example_loss)
+
+  return (loss, per_example_loss, probabilities, logits, predictions,
+          model.get_exit_layers())
+
+
+def create_layer_probabilities(albert_config, input_ids, input_mask,
+                               segment_ids, num_labels, use_one_hot_embeddings):
+  """Returns the class probabilities of the output layer after every layer.
+
+  Returns:
+    float Tensor of shape [batch_size, num_hidden_layers, num_labels], used to
+    calibrate the threshold of `create_early_exit_model`.
+  """
+  model = modeling.AlbertModel(
+      config=albert_config,
+      is_training=False,
+      input_ids=input_ids,
+      input_mask=input_mask,
+      token_type_ids=segment_ids,
+      use_one_hot_embeddings=use_one_hot_embeddings)
+
+  # The output of the last inner group of every layer.
+  layer_outputs = model.get_all_encoder_layers()[
+      albert_config.inner_group_num - 1::albert_config.inner_group_num]
+  first_tokens = tf.stack([layer[:, 0] for layer in layer_outputs], axis=1)
+  hidden_size = albert_config.hidden_size
+  with tf.variable_scope("bert/pooler", reuse=True):
+    pooled_output = tf.layers.dense(
+        tf.reshape(first_tokens, [-1, hidden_size]),
+        hidden_size,
+        activation=tf.tanh,
+        kernel_initializer=modeling.create_initializer(
+            albert_config.initializer_range),
+        name="dense")
+  logits = _classifier_logits(pooled_output, num_labels)
+  return tf.reshape(tf.nn.softmax(logits, axis=-1),
+                    [-1, len(layer_outputs), num_labels])
+
+
+def calibrate_early_exit(layer_probabilities, label_ids,
+                         thresholds=(0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99)):
+  """Simulates early exit on the output of `create_layer_probabilities`.
+
+  Args:
+    layer_probabilities: float array of shape [num_examples, num_layers,
+      num_labels].
+    label_ids: int array of shape [num_examples].
+    thresholds: The exit thresholds to simulate.
+
+  Returns:
+    A list of (threshold, accuracy, mean number of layers) tuples, starting
+    with the full model as threshold 1.0.
+  """
+  num_examples, num_layers, _ = layer_probabilities.shape
+  confidence = layer_probabilities.max(axis=-1)
+  predictions = layer_probabilities.argmax(axis=-1)
+  results = [(1.0, np.mean(predictions[:, -1] == label_ids), num_layers)]
+  for threshold in thresholds:
+    should_exit = confidence >= threshold
+    should_exit[:, -1] = True
+    exit_layers = should_exit.argmax(axis=1)
+    accuracy = np.mean(
+        predictions[np.arange(num_examples), exit_layers] == label_ids)
+    results.append((threshold, accuracy, np.mean(exit_layers + 1)))
+  return results
+
+
 def model_fn_builder(albert_config, num_labels, init_checkpoint, learning_rate,
                      num_train_steps, num_warmup_steps, use_tpu,
                      use_one_hot_embeddings, task_name, hub_module=None,
-                     optimizer="adamw"):
-  """Returns `model_fn` closure for TPUEstimator."""
+                     optimizer="adamw", early_exit_threshold=0.0,
+                     calibrate_early_exit=False, loss_scale=None):
+  """Returns `model_fn` closure for TPUEstimator.
+
+  With a positive `early_exit_threshold`, eval and predict use
+  `create_early_exit_model`. With `calibrate_early_exit`, predict returns the
+  "layer_probabilities" and "label_ids" for `calibrate_early_exit`.
+  `loss_scale` is passed to `optimization.create_optimizer`.
+  """
+  if early_exit_threshold > 0 or calibrate_early_exit:
+    if task_name == "sts-b" or hub_module:
+      raise ValueError("Early exit needs a classification task and an "
+                       "`albert_config`.")
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
     """The `model_fn` for TPUEstimator."""
@@ -838,10 +982,21 @@ def model_fn_builder(albert_config, num_labels, init_checkpoint, learning_rate,
 
     is_training = (mode == tf.estimator.ModeKeys.TRAIN)
 
-    (total_loss, per_example_loss, probabilities, logits, predictions) = \
-        create_model(albert_config, is_training, input_ids, input_mask,
-                     segment_ids, label_ids, num_labels, use_one_hot_embeddings,
-                     task_name, hub_module)
+    exit_layers = None
+    if mode == tf.estimator.ModeKeys.PREDICT and calibrate_early_exit:
+      layer_probabilities = create_layer_probabilities(
+          albert_config, input_ids, input_mask, segment_ids, num_labels,
+          use_one_hot_embeddings)
+    elif not is_training and early_exit_threshold > 0:
+      (total_loss, per_example_loss, probabilities, logits, predictions,
+       exit_layers) = create_early_exit_model(
+           albert_config, input_ids, input_mask, segment_ids, label_ids,
+           num_labels, use_one_hot_embeddings, early_exit_threshold)
+    else:
+      (total_loss, per_example_loss, probabilities, logits, predictions) = \
+          create_model(albert_config, is_training, input_ids, input_mask,
+                       segment_ids, label_ids, num_labels,
+                       use_one_hot_embeddings, task_name, hub_module)
 
     tvars = tf.trainable_variables()
     initialized_variable_names = {}
@@ -872,7 +1027,7 @@ def model_fn_builder(albert_config, num_labels, init_checkpoint, learning_rate,
 
       train_op = optimization.create_optimizer(
           total_loss, learning_rate, num_train_steps, num_warmup_steps,
-          use_tpu, optimizer)
+          use_tpu, optimizer, loss_scale=loss_scale)
 
       output_spec = contrib_tpu.TPUEstimatorSpec(
           mode=mode,
@@ -956,14 +1111,25 @@ def model_fn_builder(albert_config, num_labels, init_checkpoint, learning_rate,
           loss=total_loss,
           eval_metrics=eval_metrics,
           scaffold_fn=scaffold_fn)
-    else:
+    elif calibrate_early_exit:
       output_spec = contrib_tpu.TPUEstimatorSpec(
           mode=mode,
           predictions={
-              "probabilities": probabilities,
-              "predictions": predictions
+              "layer_probabilities": layer_probabilities,
+              "label_ids": label_ids
           },
           scaffold_fn=scaffold_fn)
+    else:
+      predictions = {
+          "probabilities": probabilities,
+          "predictions": predictions
+      }
+      if exit_layers is not None:
+        predictions["exit_layers"] = exit_layers
+      output_spec = contrib_tpu.TPUEstimatorSpec(
+          mode=mode,
+          predictions=predictions,
+          scaffold_fn=scaffold_fn)
     return output_spec
 
   return model_fn
@@ -993,7 +1159,8 @@ def input_fn_builder(features, seq_length, is_training, drop_remainder):
 
     # This is for demo purposes and does NOT scale to large data sets. We do
     # not use Dataset.from_generator() because that uses tf.py_func which is
-    # not TPU compatible. The right way to load data is with TFRecordReader.
+    # not TPU compatible. The right way to load data is with TFRecordReader,
+    # or `numpy_input_fn_builder` on CPU/GPU.
     d = tf.data.Dataset.from_tensor_slices({
         "input_ids":
             tf.constant(
@@ -1023,19 +1190,64 @@ def input_fn_builder(features, seq_length, is_training, drop_remainder):
   return input_fn
 
 
+def numpy_input_fn_builder(arrays, is_training, drop_remainder):
+  """Creates an `input_fn` closure that reads features from NumPy arrays.
+
+  Unlike `input_fn_builder`, the features are not embedded in the graph as
+  constants: the dataset only holds example indices and each batch is
+  gathered from the arrays in host memory with a `tf.py_func`, so it scales
+  to large data sets but does not run on TPU.
+
+  Args:
+    arrays: dict from feature name to a NumPy array whose first dimension is
+      the example, e.g. the output of `convert_examples_to_arrays`.
+    is_training: bool. Whether to repeat and shuffle the examples.
+    drop_remainder: bool. Whether to drop the last partial batch.
+
+  Returns:
+    The `input_fn`.
+  """
+  names = sorted(arrays.keys())
+  num_examples = len(arrays[names[0]])
+  for name in names:
+    if len(arrays[name]) != num_examples:
+      raise ValueError("Feature `%s` has %d examples, expected %d." %
+                       (name, len(arrays[name]), num_examples))
+  dtypes = [tf.as_dtype(arrays[name].dtype) for name in names]
+
+  def gather_batch(indices):
+    return [arrays[name][indices] for name in names]
+
+  def input_fn(params):
+    """The actual input function."""
+    batch_size = params["batch_size"]
+
+    d = tf.data.Dataset.range(num_examples)
+    if is_training:
+      d = d.repeat()
+      d = d.shuffle(buffer_size=100)
+    d = d.batch(batch_size=batch_size, drop_remainder=drop_remainder)
+
+    def _gather(indices):
+      tensors = tf.py_func(gather_batch, [indices], dtypes, stateful=False)
+      features = {}
+      for (name, tensor) in zip(names, tensors):
+        tensor.set_shape(
+            [batch_size if drop_remainder else None] +
+            list(arrays[name].shape[1:]))
+        features[name] = tensor
+      return features
+
+    return d.map(_gather)
+
+  return input_fn
+
+
 # This function is not used by this file but is still used by the Colab and
 # people who depend on it.
 def convert_examples_to_features(examples, label_list, max_seq_length,
                                  tokenizer, task_name):
   """Convert a set of `InputExample`s to a list of `InputFeatures`."""
 
-  features = []
-  for (ex_index, example) in enumerate(examples):
-    if ex_index % 10000 == 0:
-      tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
-
-    feature = convert_single_example(ex_index, example, label_list,
-                                     max_seq_length, tokenizer, task_name)
-
-    features.append(feature)
-  return features
+  return list(_iter_feature_batches(examples, label_list, max_seq_length,
+                                    tokenizer, task_name))
@@ -0,0 +1,75 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python2, python3
+"""Tests for classifier_utils."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from albert import classifier_utils
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+
+class ClassifierUtilsTest(tf.test.TestCase):
+
+  def test_numpy_input_fn_builder(self):
+    arrays = {
+        "input_ids": np.arange(15, dtype=np.int32).reshape([5, 3]),
+        "label_ids": np.arange(5, dtype=np.float32),
+    }
+    input_fn = classifier_utils.numpy_input_fn_builder(
+        arrays, is_training=False, drop_remainder=False)
+    features = tf.data.make_one_shot_iterator(
+        input_fn({"batch_size": 2})).get_next()
+    self.assertEqual(features["input_ids"].dtype, tf.int32)
+    self.assertEqual(features["input_ids"].shape.as_list(), [None, 3])
+    # The arrays are not embedded in the graph.
+    self.assertLess(tf.get_default_graph().as_graph_def().ByteSize(), 1000)
+
+    batches = []
+    with self.test_session() as sess:
+      while True:
+        try:
+          batches.append(sess.run(features))
+        except tf.errors.OutOfRangeError:
+          break
+    self.assertLen(batches, 3)
+    self.assertAllEqual(
+        np.concatenate([batch["input_ids"] for batch in batches]),
+        arrays["input_ids"])
+    self.assertAllEqual(
+        np.concatenate([batch["label_ids"] for batch in batches]),
+        arrays["label_ids"])
+
+  def test_numpy_input_fn_builder_training(self):
+    arrays = {"input_ids": np.arange(10, dtype=np.int32).reshape([5, 2])}
+    input_fn = classifier_utils.numpy_input_fn_builder(
+        arrays, is_training=True, drop_remainder=True)
+    features = tf.data.make_one_shot_iterator(
+        input_fn({"batch_size": 4})).get_next()
+    self.assertEqual(features["input_ids"].shape.as_list(), [4, 2])
+
+    with self.test_session() as sess:
+      for _ in range(3):
+        input_ids = sess.run(features["input_ids"])
+        # Every row is one of the examples.
+        self.assertAllEqual(input_ids[:, 1], input_ids[:, 0] + 1)
+        self.assertAllEqual(input_ids[:, 0] % 2, np.zeros([4]))
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -0,0 +1,351 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python2, python3
+"""Checkpoint evaluation loop shared by the fine-tuning scripts.
+
+The fine-tuning scripts evaluate every checkpoint written to `output_dir`,
+keep a copy of the best one as `model.ckpt-best` and remove the others. This
+library implements that loop once:
+
+  * `CheckpointWatcher` finds new checkpoints, waking up on file system
+    notifications when `watchdog` is installed and polling otherwise.
+  * `WarmEvaluator` evaluates or predicts with a graph, session and input
+    pipeline that are built once; only the variables are restored per
+    checkpoint.
+  * `evaluate_checkpoints` runs the loop, evaluating pending checkpoints
+    concurrently (one evaluation function per device) and handling the
+    best-checkpoint retention.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import six
+import tensorflow.compat.v1 as tf
+
+# pylint: disable=g-import-not-at-top
+try:
+  from watchdog import events as watchdog_events
+  from watchdog import observers as watchdog_observers
+except ImportError:
+  watchdog_events = None
+  watchdog_observers = None
+# pylint: enable=g-import-not-at-top
+
+BEST_CHECKPOINT_NAME = "model.ckpt-best"
+
+
+def get_checkpoint_step(checkpoint_path):
+  """Returns the step of `model.ckpt-<step>`, or None for other names."""
+  step = checkpoint_path.rsplit("-", 1)[-1]
+  return int(step) if step.isdigit() else None
+
+
+def find_checkpoints(output_dir):
+  """Returns a {step: checkpoint_path} dict of the checkpoints in a dir."""
+  steps_and_files = {}
+  for filename in tf.gfile.ListDirectory(output_dir):
+    if filename.endswith(".index"):
+      checkpoint_path = os.path.join(output_dir, filename[:-len(".index")])
+      step = get_checkpoint_step(checkpoint_path)
+      if step is not None:
+        steps_and_files[step] = checkpoint_path
+  return steps_and_files
+
+
+def remove_checkpoint(checkpoint_path):
+  for src_ckpt in tf.gfile.Glob(checkpoint_path + ".*"):
+    tf.logging.info("removing {}".format(src_ckpt))
+    tf.gfile.Remove(src_ckpt)
+
+
+def copy_checkpoint(checkpoint_path, target_path):
+  for src_ckpt in tf.gfile.Glob(checkpoint_path + ".*"):
+    tgt_ckpt = target_path + src_ckpt[len(checkpoint_path):]
+    tf.logging.info("saving {} to {}".format(src_ckpt, tgt_ckpt))
+    tf.gfile.Copy(src_ckpt, tgt_ckpt, overwrite=True)
+
+
+def get_eval_devices():
+  """Returns one device per local GPU, or [None] if there is no GPU."""
+  # pylint: disable=g-import-not-at-top
+  from tensorflow.python.client import device_lib
+  # pylint: enable=g-import-not-at-top
+  devices = [d.name for d in device_lib.list_local_devices()
+             if d.device_type == "GPU"]
+  return devices or [None]
+
+
+class CheckpointWatcher(object):
+  """Watches a directory for new checkpoints.
+
+  `wait` returns as soon as a checkpoint index is written if the `watchdog`
+  package is installed and the directory is local, and after
+  `poll_interval_secs` otherwise.
+  """
+
+  def __init__(self, output_dir, poll_interval_secs=60):
+    self.output_dir = output_dir
+    self.poll_interval_secs = poll_interval_secs
+    self._changed = threading.Event()
+    self._observer = None
+    if watchdog_observers is not None and "://" not in output_dir:
+      watcher = self
+
+      class _IndexHandler(watchdog_events.FileSystemEventHandler):
+
+        def on_any_event(self, event):
+          path = getattr(event, "dest_path", None) or event.src_path
+          if path.endswith(".index"):
+            watcher._changed.set()  # pylint: disable=protected-access
+
+      self._observer = watchdog_observers.Observer()
+      self._observer.schedule(_IndexHandler(), output_dir, recursive=False)
+      self._observer.start()
+
+  def find_checkpoints(self):
+    self._changed.clear()
+    return find_checkpoints(self.output_dir)
+
+  def wait(self):
+    self._changed.wait(self.poll_interval_secs)
+
+  def close(self):
+    if self._observer is not None:
+      self._observer.stop()
+      self._observer.join()
+
+
+class WarmEvaluator(object):
+  """Evaluates checkpoints without rebuilding the graph for each of them.
+
+  `Estimator.evaluate` and `Estimator.predict` build a new graph and session,
+  and re-create the input pipeline, for every checkpoint. This class builds
+  them once on `device` and only restores the variables from the checkpoint.
+  It works with the `model_fn`/`input_fn` closures of the fine-tuning scripts
+  on CPU/GPU; use the TPUEstimator on TPU.
+  """
+
+  def __init__(self, model_fn, input_fn, mode, device=None, params=None):
+    self.mode = mode
+    self._graph = tf.Graph()
+    with self._graph.as_default():
+      global_step = tf.train.get_or_create_global_step()
+      dataset = input_fn(params or {})
+      self._iterator = tf.data.make_initializable_iterator(dataset)
+      features = self._iterator.get_next()
+      with tf.device(device):
+        spec = model_fn(features, None, mode, params or {})
+      if hasattr(spec, "as_estimator_spec"):
+        spec = spec.as_estimator_spec()
+
+      if mode == tf.estimator.ModeKeys.EVAL:
+        metric_ops = dict(spec.eval_metric_ops)
+        metric_ops["loss"] = tf.metrics.mean(spec.loss)
+        self._update_op = tf.group(*[op for _, op in metric_ops.values()])
+        self._metrics = {k: v for k, (v, _) in six.iteritems(metric_ops)}
+        self._metrics["global_step"] = global_step
+      else:
+        self._predictions = spec.predictions
+      self._batch_size = tf.shape(tf.nest.flatten(features)[0])[0]
+
+      self._init_ops = [tf.local_variables_initializer(),
+                        tf.tables_initializer(), self._iterator.initializer]
+      self._saver = tf.train.Saver()
+
+    self._session = tf.Session(
+        graph=self._graph,
+        config=tf.ConfigProto(allow_soft_placement=True))
+
+  def _restore(self, checkpoint_path):
+    self._session.run(self._init_ops)
+    self._saver.restore(self._session, checkpoint_path)
+
+  def evaluate(self, checkpoint_path):
+    """Returns the metrics of a checkpoint, like `Estimator.evaluate`."""
+    self._restore(checkpoint_path)
+    while True:
+      try:
+        self._session.run(self._update_op)
+      except tf.errors.OutOfRangeError:
+        break
+    return self._session.run(self._metrics)
+
+  def predict(self, checkpoint_path):
+    """Yields single-example predictions, like `Estimator.predict`."""
+    self._restore(checkpoint_path)
+    while True:
+      try:
+        batch = self._session.run(self._predictions)
+      except tf.errors.OutOfRangeError:
+        break
+      batch_size = len(next(six.itervalues(batch)))
+      for i in range(batch_size):
+        yield {key: value[i] for key, value in six.iteritems(batch)}
+
+  def benchmark(self, checkpoint_path):
+    """Returns the examples per second of the steady-state inference loop.
+
+    The restore and the first batch, which pays the one-off setup costs, are
+    not timed.
+    """
+    self._restore(checkpoint_path)
+    if self.mode == tf.estimator.ModeKeys.EVAL:
+      run_op = self._update_op
+    else:
+      run_op = self._predictions
+    self._session.run(run_op)
+    num_examples = 0
+    start_time = time.time()
+    while True:
+      try:
+        _, batch_size = self._session.run([run_op, self._batch_size])
+      except tf.errors.OutOfRangeError:
+        break
+      num_examples += batch_size
+    if not num_examples:
+      raise ValueError("Benchmarking needs more than one batch.")
+    return num_examples / (time.time() - start_time)
+
+  def close(self):
+    self._session.close()
+
+
+def create_eval_fns(estimator, model_fn, input_fn, mode, use_tpu, steps=None,
+                    devices=None, batch_size=None):
+  """Returns the per-device evaluation functions of `evaluate_checkpoints`.
+
+  On TPU the checkpoints are evaluated with `estimator`; otherwise a
+  `WarmEvaluator` is built on each of `devices` (all local GPUs by default),
+  with `batch_size` passed to `input_fn` and `model_fn` as
+  `params["batch_size"]`, like the Estimator does. In PREDICT mode the
+  functions yield single-example predictions.
+  """
+  if use_tpu:
+    if mode == tf.estimator.ModeKeys.EVAL:
+      return [lambda checkpoint_path: estimator.evaluate(
+          input_fn=input_fn, steps=steps, checkpoint_path=checkpoint_path)]
+    return [lambda checkpoint_path: estimator.predict(
+        input_fn, yield_single_examples=True, checkpoint_path=checkpoint_path)]
+
+  if devices is None:
+    devices = get_eval_devices()
+  params = {"batch_size": batch_size} if batch_size is not None else None
+  evaluators = [WarmEvaluator(model_fn, input_fn, mode, device=device,
+                              params=params)
+                for device in devices]
+  if mode == tf.estimator.ModeKeys.EVAL:
+    return [evaluator.evaluate for evaluator in evaluators]
+  return [evaluator.predict for evaluator in evaluators]
+
+
+def _read_best_trial_info(best_trial_info_file):
+  """Returns (global_step, best_global_step, best_perf) of earlier evals."""
+  if tf.gfile.Exists(best_trial_info_file):
+    with tf.gfile.GFile(best_trial_info_file, "r") as best_info:
+      global_step, best_global_step, best_perf = (
+          best_info.read().split(":"))
+    return int(global_step), int(best_global_step), float(best_perf)
+  return -1, -1, -1
+
+
+def evaluate_checkpoints(output_dir, eval_fns, key_name, last_step, writer,
+                         poll_interval_secs=60):
+  """Evaluates the checkpoints of `output_dir` until `last_step` is reached.
+
+  Args:
+    output_dir: directory the checkpoints are written to.
+    eval_fns: list of functions mapping a checkpoint path to a dict of
+      metrics. Up to `len(eval_fns)` pending checkpoints are evaluated
+      concurrently, the i-th one with `eval_fns[i]`.
+    key_name: metric used to select the best checkpoint.
+    last_step: the loop stops once a checkpoint of this step is evaluated.
+    writer: file object the results are written to.
+    poll_interval_secs: how long to wait for new checkpoints.
+
+  Returns:
+    A tuple of the best metric value and the global step it was reached at.
+    The best checkpoint is kept as `model.ckpt-best` in `output_dir`, and the
+    progress is recorded in `best_trial.txt` so the loop can be resumed.
+  """
+  best_trial_info_file = os.path.join(output_dir, "best_trial.txt")
+  best_checkpoint_path = os.path.join(output_dir, BEST_CHECKPOINT_NAME)
+  global_step, best_global_step, best_perf = _read_best_trial_info(
+      best_trial_info_file)
+  tf.logging.info(
+      "Best trial info: Step: %s, Best Value Step: %s, "
+      "Best Value: %s", global_step, best_global_step, best_perf)
+
+  def _remove_evaluated(steps_and_files):
+    # Keep the newest checkpoints around, e.g. to resume training from.
+    for step, checkpoint_path in sorted(steps_and_files.items()):
+      if step <= global_step and len(
+          [s for s in steps_and_files if s > step]) > 1:
+        remove_checkpoint(checkpoint_path)
+
+  watcher = CheckpointWatcher(output_dir, poll_interval_secs)
+  pool = ThreadPool(len(eval_fns)) if len(eval_fns) > 1 else None
+  try:
+    while global_step < last_step:
+      steps_and_files = watcher.find_checkpoints()
+      _remove_evaluated(steps_and_files)
+      pending = [(step, checkpoint_path) for step, checkpoint_path
+                 in sorted(steps_and_files.items()) if step > global_step]
+      tf.logging.info("found {} pending files.".format(len(pending)))
+      if not pending:
+        tf.logging.info("found 0 file, global step: {}. Waiting."
+                        .format(global_step))
+        watcher.wait()
+        continue
+
+      pending = pending[:len(eval_fns)]
+      jobs = [(eval_fn, checkpoint_path)
+              for eval_fn, (_, checkpoint_path) in zip(eval_fns, pending)]
+      if pool is not None:
+        results = pool.map(lambda job: job[0](job[1]), jobs)
+      else:
+        results = [eval_fn(checkpoint_path) for eval_fn, checkpoint_path
+                   in jobs]
+
+      for (step, checkpoint_path), result in zip(pending, results):
+        tf.logging.info("***** Eval results *****")
+        for key in sorted(result.keys()):
+          tf.logging.info("  %s = %s", key, str(result[key]))
+          writer.write("%s = %s\n" % (key, str(result[key])))
+        if result[key_name] > best_perf:
+          best_perf = result[key_name]
+          best_global_step = step
+          copy_checkpoint(checkpoint_path, best_checkpoint_path)
+          writer.write("saved {} to {}\n".format(
+              checkpoint_path, best_checkpoint_path))
+        writer.write("best {} = {}\n".format(key_name, best_perf))
+        tf.logging.info("  best {} = {}\n".format(key_name, best_perf))
+        writer.write("=" * 50 + "\n")
+        global_step = max(global_step, step)
+      writer.flush()
+      with tf.gfile.GFile(best_trial_info_file, "w") as best_info:
+        best_info.write("{}:{}:{}".format(
+            global_step, best_global_step, best_perf))
+      _remove_evaluated(watcher.find_checkpoints())
+  finally:
+    watcher.close()
+    if pool is not None:
+      pool.close()
+  return best_perf, best_global_step
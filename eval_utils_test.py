@@ -0,0 +1,123 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python2, python3
+"""Tests for eval_utils."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+from albert import eval_utils
+import six
+import tensorflow.compat.v1 as tf
+
+
+def _input_fn(params):
+  """Six examples [0, 1, ..., 5] in batches of `params["batch_size"]`."""
+  d = tf.data.Dataset.from_tensor_slices({"x": tf.range(6, dtype=tf.float32)})
+  return d.batch(params["batch_size"])
+
+
+def _model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
+  """Scales the inputs by a variable `w`."""
+  w = tf.get_variable("w", shape=[], initializer=tf.zeros_initializer())
+  predictions = features["x"] * w
+  if mode == tf.estimator.ModeKeys.PREDICT:
+    return tf.estimator.EstimatorSpec(
+        mode=mode, predictions={"y": predictions})
+  return tf.estimator.EstimatorSpec(
+      mode=mode,
+      loss=tf.reduce_mean(predictions),
+      eval_metric_ops={"mean_y": tf.metrics.mean(predictions)})
+
+
+class EvalUtilsTest(tf.test.TestCase):
+
+  def _save_checkpoint(self, output_dir, step, w_value):
+    with tf.Graph().as_default():
+      global_step = tf.train.get_or_create_global_step()
+      w = tf.get_variable("w", shape=[], initializer=tf.zeros_initializer())
+      with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run([w.assign(w_value), global_step.assign(step)])
+        return tf.train.Saver().save(
+            sess, os.path.join(output_dir, "model.ckpt"), global_step=step)
+
+  def test_warm_evaluator(self):
+    output_dir = self.get_temp_dir()
+    checkpoint_1 = self._save_checkpoint(output_dir, 1, 1.0)
+    checkpoint_2 = self._save_checkpoint(output_dir, 2, 2.0)
+
+    eval_fn, = eval_utils.create_eval_fns(
+        None, _model_fn, _input_fn, tf.estimator.ModeKeys.EVAL, False,
+        devices=[None], batch_size=4)
+    self.assertAllClose(eval_fn(checkpoint_1)["mean_y"], 2.5)
+    result = eval_fn(checkpoint_2)
+    self.assertAllClose(result["mean_y"], 5.0)
+    self.assertEqual(result["global_step"], 2)
+
+    predict_fn, = eval_utils.create_eval_fns(
+        None, _model_fn, _input_fn, tf.estimator.ModeKeys.PREDICT, False,
+        devices=[None], batch_size=4)
+    predictions = [prediction["y"] for prediction in predict_fn(checkpoint_2)]
+    self.assertAllClose(predictions, [0.0, 2.0, 4.0, 6.0, 8.0, 10.0])
+
+  def test_warm_evaluator_benchmark(self):
+    output_dir = self.get_temp_dir()
+    checkpoint = self._save_checkpoint(output_dir, 1, 1.0)
+
+    evaluator = eval_utils.WarmEvaluator(
+        _model_fn, _input_fn, tf.estimator.ModeKeys.EVAL,
+        params={"batch_size": 4})
+    self.assertGreater(evaluator.benchmark(checkpoint), 0)
+    # Benchmarking leaves the evaluator usable.
+    self.assertAllClose(evaluator.evaluate(checkpoint)["mean_y"], 2.5)
+    evaluator.close()
+
+    # The only batch is the warm-up one.
+    evaluator = eval_utils.WarmEvaluator(
+        _model_fn, _input_fn, tf.estimator.ModeKeys.EVAL,
+        params={"batch_size": 6})
+    with self.assertRaises(ValueError):
+      evaluator.benchmark(checkpoint)
+    evaluator.close()
+
+  def test_evaluate_checkpoints_keeps_best(self):
+    output_dir = self.get_temp_dir()
+    accuracies = {1: 0.5, 2: 0.9, 3: 0.7}
+    for step in accuracies:
+      self._save_checkpoint(output_dir, step, float(step))
+
+    def eval_fn(checkpoint_path):
+      return {"accuracy": accuracies[eval_utils.get_checkpoint_step(
+          checkpoint_path)]}
+
+    writer = six.StringIO()
+    best_perf, best_global_step = eval_utils.evaluate_checkpoints(
+        output_dir, [eval_fn], "accuracy", 3, writer, poll_interval_secs=1)
+    self.assertEqual((best_perf, best_global_step), (0.9, 2))
+    self.assertEqual(sorted(eval_utils.find_checkpoints(output_dir)), [2, 3])
+
+    best_checkpoint_path = os.path.join(output_dir,
+                                        eval_utils.BEST_CHECKPOINT_NAME)
+    self.assertEqual(
+        tf.train.load_checkpoint(best_checkpoint_path).get_tensor("w"), 2.0)
+    with tf.gfile.GFile(os.path.join(output_dir, "best_trial.txt")) as f:
+      self.assertEqual(f.read(), "3:2:0.9")
+
+
+if __name__ == "__main__":
+  tf.test.main()
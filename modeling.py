@@ -55,7 +55,15 @@ class AlbertConfig(object):
                attention_probs_dropout_prob=0,
                max_position_embeddings=512,
                type_vocab_size=2,
-               initializer_range=0.02):
+               initializer_range=0.02,
+               attention_chunk_size=0,
+               attention_window_size=0,
+               num_global_tokens=1,
+               use_layer_loop=False,
+               remove_padding=False,
+               compute_dtype="float32",
+               quantize_weights=False,
+               recompute_layers=0):
     """Constructs AlbertConfig.
 
     Args:
@@ -84,6 +92,39 @@ class AlbertConfig(object):
         `AlbertModel`.
       initializer_range: The stdev of the truncated_normal_initializer for
         initializing all weight matrices.
+      attention_chunk_size: If positive, the attention is computed over chunks
+        of this many queries and keys with a streaming softmax, so that its
+        memory grows linearly instead of quadratically with the sequence
+        length, in training as well. Needs a zero
+        `attention_probs_dropout_prob` in training. 0 computes the full
+        attention matrix.
+      attention_window_size: If positive, use sliding-window attention: the
+        sequence is split into blocks of this many tokens, and every token
+        only attends to the tokens of its own and the two neighbouring blocks
+        and to the global tokens. 0 uses the full attention.
+      num_global_tokens: The number of leading tokens (e.g. [CLS]) that every
+        token attends to, and that attend to every token, with sliding-window
+        attention.
+      use_layer_loop: Whether to apply the shared layer of a model with a
+        single hidden group in a `tf.while_loop` instead of unrolling all the
+        layers in the graph. Ignored if `num_hidden_groups` > 1.
+      remove_padding: Whether the encoder packs the tokens of `input_mask`
+        into a single dense sequence for the position-wise layers, and only
+        scatters them back to [batch_size, seq_length] for the attention. The
+        outputs at the padded positions are then 0. It needs a
+        [batch_size, seq_length] attention mask and does not run on TPU.
+      compute_dtype: The dtype of the encoder computation, "float32",
+        "bfloat16" or "float16". With a reduced precision, the matmuls and
+        attention run in this dtype while the variables are stored and the
+        softmax and layer normalization are computed in float32.
+      quantize_weights: Whether the model reads the int8 weights of a
+        checkpoint converted by `quantize_checkpoint.py` (see
+        `int8_variable_getter`). Only for inference.
+      recompute_layers: If positive, use gradient checkpointing: the encoder
+        is split into segments of this many layers, and the activations
+        inside a segment are recomputed from its input during the backward
+        pass instead of being kept. Needs zero dropout probabilities and is
+        not supported with `use_layer_loop`.
     """
     self.vocab_size = vocab_size
     self.embedding_size = embedding_size
@@ -100,6 +141,14 @@ class AlbertConfig(object):
     self.max_position_embeddings = max_position_embeddings
     self.type_vocab_size = type_vocab_size
     self.initializer_range = initializer_range
+    self.attention_chunk_size = attention_chunk_size
+    self.attention_window_size = attention_window_size
+    self.num_global_tokens = num_global_tokens
+    self.use_layer_loop = use_layer_loop
+    self.remove_padding = remove_padding
+    self.compute_dtype = compute_dtype
+    self.quantize_weights = quantize_weights
+    self.recompute_layers = recompute_layers
 
   @classmethod
   def from_dict(cls, json_object):
@@ -158,7 +207,10 @@ class AlbertModel(object):
                token_type_ids=None,
                use_one_hot_embeddings=False,
                use_einsum=True,
-               scope=None):
+               scope=None,
+               position_ids=None,
+               attention_mask=None,
+               exit_fn=None):
     """Constructor for AlbertModel.
 
     Args:
@@ -173,11 +225,28 @@ class AlbertModel(object):
       use_einsum: (optional) bool. Whether to use einsum or reshape+matmul for
         dense layers
       scope: (optional) variable scope. Defaults to "bert".
+      position_ids: (optional) int32 Tensor of shape [batch_size, seq_length].
+        Defaults to the positions 0, 1, ..., seq_length - 1.
+      attention_mask: (optional) int32 Tensor of shape [batch_size,
+        seq_length, seq_length], 1 where a token (second dimension) can attend
+        to another one (third dimension). Overrides the attention derived
+        from `input_mask`, e.g. to encode several sequences as one.
+      exit_fn: (optional) function for adaptive-depth inference. It maps the
+        pooled output of a layer, [batch_size, hidden_size], to a tuple of a
+        float Tensor of per-example outputs (e.g. logits) and a bool Tensor of
+        shape [batch_size] that is True for the examples that can stop at
+        that layer. The layers then run in a loop that drops the finished
+        examples from the batch; see `get_exit_outputs` and
+        `get_exit_layers`. It requires a single hidden group and is only
+        supported for inference.
 
     Raises:
       ValueError: The config is invalid or one of the input tensor shapes
         is invalid.
     """
+    if exit_fn is not None and (is_training or config.num_hidden_groups != 1):
+      raise ValueError("`exit_fn` is only supported for inference with a "
+                       "single hidden group.")
     config = copy.deepcopy(config)
     if not is_training:
       config.hidden_dropout_prob = 0.0
@@ -193,7 +262,11 @@ class AlbertModel(object):
     if token_type_ids is None:
       token_type_ids = tf.zeros(shape=[batch_size, seq_length], dtype=tf.int32)
 
-    with tf.variable_scope(scope, default_name="bert"):
+    custom_getter = None
+    if config.quantize_weights:
+      custom_getter = int8_variable_getter
+    with tf.variable_scope(scope, default_name="bert",
+                           custom_getter=custom_getter) as model_scope:
       with tf.variable_scope("embeddings"):
         # Perform embedding lookup on the word ids.
         (self.word_embedding_output,
@@ -218,16 +291,22 @@ class AlbertModel(object):
             initializer_range=config.initializer_range,
             max_position_embeddings=config.max_position_embeddings,
             dropout_prob=config.hidden_dropout_prob,
-            use_one_hot_embeddings=use_one_hot_embeddings)
+            use_one_hot_embeddings=use_one_hot_embeddings,
+            position_ids=position_ids)
+
+      if attention_mask is None:
+        attention_mask = input_mask
 
       with tf.variable_scope("encoder"):
         # Run the stacked transformer.
         # `sequence_output` shape = [batch_size, seq_length, hidden_size].
+        # With `exit_fn`, only the first layer is part of the stack.
         self.all_encoder_layers = transformer_model(
             input_tensor=self.embedding_output,
-            attention_mask=input_mask,
+            attention_mask=attention_mask,
             hidden_size=config.hidden_size,
-            num_hidden_layers=config.num_hidden_layers,
+            num_hidden_layers=(
+                1 if exit_fn is not None else config.num_hidden_layers),
             num_hidden_groups=config.num_hidden_groups,
             num_attention_heads=config.num_attention_heads,
             intermediate_size=config.intermediate_size,
@@ -237,7 +316,14 @@ class AlbertModel(object):
             attention_probs_dropout_prob=config.attention_probs_dropout_prob,
             initializer_range=config.initializer_range,
             do_return_all_layers=True,
-            use_einsum=use_einsum)
+            use_einsum=use_einsum,
+            attention_chunk_size=config.attention_chunk_size,
+            attention_window_size=config.attention_window_size,
+            num_global_tokens=config.num_global_tokens,
+            use_layer_loop=config.use_layer_loop,
+            remove_padding=config.remove_padding,
+            compute_dtype=tf.as_dtype(config.compute_dtype),
+            recompute_layers=config.recompute_layers)
 
       self.sequence_output = self.all_encoder_layers[-1]
       # The "pooler" converts the encoded sequence tensor of shape
@@ -255,9 +341,128 @@ class AlbertModel(object):
             activation=tf.tanh,
             kernel_initializer=create_initializer(config.initializer_range))
 
+    self.exit_outputs = None
+    self.exit_layers = None
+    if exit_fn is not None:
+      self._run_early_exit(config, model_scope, exit_fn, attention_mask,
+                           use_einsum)
+
+  def _run_early_exit(self, config, model_scope, exit_fn, attention_mask,
+                      use_einsum):
+    """Runs the remaining layers until every example has exited."""
+    batch_size = get_shape_list(self.sequence_output, expected_rank=3)[0]
+    num_hidden_layers = config.num_hidden_layers
+
+    def apply_layer(layer_input, layer_mask):
+      with tf.variable_scope(model_scope, reuse=True):
+        with tf.variable_scope("encoder"):
+          return transformer_model(
+              input_tensor=layer_input,
+              attention_mask=layer_mask,
+              hidden_size=config.hidden_size,
+              num_hidden_layers=1,
+              num_hidden_groups=1,
+              num_attention_heads=config.num_attention_heads,
+              intermediate_size=config.intermediate_size,
+              inner_group_num=config.inner_group_num,
+              intermediate_act_fn=get_activation(config.hidden_act),
+              hidden_dropout_prob=0.0,
+              attention_probs_dropout_prob=0.0,
+              initializer_range=config.initializer_range,
+              use_einsum=use_einsum,
+              attention_chunk_size=config.attention_chunk_size,
+              attention_window_size=config.attention_window_size,
+              num_global_tokens=config.num_global_tokens,
+              remove_padding=config.remove_padding,
+              compute_dtype=tf.as_dtype(config.compute_dtype))
+
+    def pool(layer_output):
+      with tf.variable_scope(model_scope, reuse=True):
+        with tf.variable_scope("pooler"):
+          return tf.layers.dense(
+              tf.squeeze(layer_output[:, 0:1, :], axis=1),
+              config.hidden_size,
+              activation=tf.tanh,
+              kernel_initializer=create_initializer(config.initializer_range),
+              name="dense")
+
+    def exit_examples(layer_idx, pooled_output, example_ids, accumulators):
+      """Records the examples that exit; returns which ones continue."""
+      outputs, should_exit = exit_fn(pooled_output)
+      if accumulators is None:
+        accumulators = (tf.zeros_like(outputs), tf.zeros_like(pooled_output),
+                        tf.zeros([batch_size], dtype=tf.int32))
+      # Every example exits at the last layer.
+      should_exit = tf.logical_or(should_exit,
+                                  layer_idx >= num_hidden_layers - 1)
+      exit_ids = tf.boolean_mask(example_ids, should_exit)[:, None]
+      exit_outputs, pooled_outputs, exit_layers = accumulators
+      exit_outputs += tf.scatter_nd(
+          exit_ids, tf.boolean_mask(outputs, should_exit),
+          tf.shape(exit_outputs))
+      pooled_outputs += tf.scatter_nd(
+          exit_ids, tf.boolean_mask(pooled_output, should_exit),
+          tf.shape(pooled_outputs))
+      exit_layers += tf.scatter_nd(
+          exit_ids, tf.fill(tf.shape(exit_ids)[:1], layer_idx + 1),
+          [batch_size])
+      return (tf.logical_not(should_exit),
+              (exit_outputs, pooled_outputs, exit_layers))
+
+    # The first layer was run with the full batch.
+    example_ids = tf.range(batch_size)
+    keep, accumulators = exit_examples(0, self.pooled_output, example_ids,
+                                       None)
+    layer_output = tf.boolean_mask(self.sequence_output, keep)
+    layer_mask = tf.boolean_mask(attention_mask, keep)
+    example_ids = tf.boolean_mask(example_ids, keep)
+
+    def body(layer_idx, layer_output, layer_mask, example_ids, accumulators):
+      layer_output = apply_layer(layer_output, layer_mask)
+      keep, accumulators = exit_examples(
+          layer_idx, pool(layer_output), example_ids, accumulators)
+      return (layer_idx + 1, tf.boolean_mask(layer_output, keep),
+              tf.boolean_mask(layer_mask, keep),
+              tf.boolean_mask(example_ids, keep), accumulators)
+
+    def cond(layer_idx, unused_output, unused_mask, example_ids,
+             unused_accumulators):
+      return tf.logical_and(layer_idx < num_hidden_layers,
+                            tf.size(example_ids) > 0)
+
+    _, _, _, _, accumulators = tf.while_loop(
+        cond, body,
+        [tf.constant(1), layer_output, layer_mask, example_ids, accumulators],
+        shape_invariants=[
+            tf.TensorShape([]),
+            tf.TensorShape([None]).concatenate(layer_output.shape[1:]),
+            tf.TensorShape([None]).concatenate(layer_mask.shape[1:]),
+            tf.TensorShape([None]),
+            tuple(x.shape for x in accumulators)],
+        name="early_exit")
+    self.exit_outputs, self.pooled_output, self.exit_layers = accumulators
+    self.sequence_output = None
+    self.all_encoder_layers = None
+
   def get_pooled_output(self):
     return self.pooled_output
 
+  def get_exit_outputs(self):
+    """Gets the `exit_fn` outputs of the layer at which each example exited.
+
+    Returns:
+      float Tensor of shape [batch_size, ...], or None without `exit_fn`.
+    """
+    return self.exit_outputs
+
+  def get_exit_layers(self):
+    """Gets the number of layers that each example went through.
+
+    Returns:
+      int32 Tensor of shape [batch_size], or None without `exit_fn`.
+    """
+    return self.exit_layers
+
   def get_sequence_output(self):
     """Gets final hidden layer of encoder.
 
@@ -308,8 +513,10 @@ def gelu(x):
   Returns:
     `x` with the GELU activation applied.
   """
+  # A Python float, unlike a NumPy float64, takes the dtype of `x`, e.g.
+  # bfloat16.
   cdf = 0.5 * (1.0 + tf.tanh(
-      (np.sqrt(2 / np.pi) * (x + 0.044715 * tf.pow(x, 3)))))
+      (math.sqrt(2 / math.pi) * (x + 0.044715 * tf.pow(x, 3)))))
   return x * cdf
 
 
@@ -428,9 +635,14 @@ def dropout(input_tensor, dropout_prob):
 
 
 def layer_norm(input_tensor, name=None):
-  """Run layer normalization on the last dimension of the tensor."""
-  return contrib_layers.layer_norm(
-      inputs=input_tensor, begin_norm_axis=-1, begin_params_axis=-1, scope=name)
+  """Run layer normalization on the last dimension of the tensor.
+
+  Reduced-precision inputs are normalized in float32 and cast back.
+  """
+  output_tensor = contrib_layers.layer_norm(
+      inputs=tf.cast(input_tensor, tf.float32), begin_norm_axis=-1,
+      begin_params_axis=-1, scope=name)
+  return tf.cast(output_tensor, input_tensor.dtype)
 
 
 def layer_norm_and_dropout(input_tensor, dropout_prob, name=None):
@@ -445,6 +657,85 @@ def create_initializer(initializer_range=0.02):
   return tf.truncated_normal_initializer(stddev=initializer_range)
 
 
+def float32_variable_getter(getter, name, *args, **kwargs):
+  """Custom getter that stores reduced-precision variables in float32.
+
+  Variables requested as bfloat16 or float16 are created (and checkpointed and
+  updated) in float32, and cast to the requested dtype where they are read.
+  """
+  dtype = kwargs.get("dtype")
+  if dtype in (tf.bfloat16, tf.float16):
+    kwargs["dtype"] = tf.float32
+    return tf.cast(getter(name, *args, **kwargs), dtype)
+  return getter(name, *args, **kwargs)
+
+
+def get_quantization_axis(name, shape):
+  """Returns the axis that the scales of an int8 weight reduce, or None.
+
+  The 2-D dense kernels get a scale per output column and the word embeddings
+  a scale per token. The other variables are not quantized.
+
+  Args:
+    name: string. The variable name.
+    shape: list of ints. The variable shape.
+
+  Returns:
+    int or None.
+  """
+  if len(shape) != 2:
+    return None
+  if name.endswith("word_embeddings"):
+    return 1
+  if name.endswith("/kernel"):
+    return 0
+  return None
+
+
+def quantize_int8(weights, axis):
+  """Symmetrically quantizes a numpy array to int8 with per-channel scales.
+
+  Args:
+    weights: float numpy array.
+    axis: int. The axis the scales reduce, from `get_quantization_axis`.
+
+  Returns:
+    A tuple of the int8 array and the float32 scales, which have size 1 along
+    `axis`, such that `weights` ~= `quantized * scale`.
+  """
+  scale = np.max(np.abs(weights), axis=axis, keepdims=True) / 127.0
+  scale[scale == 0] = 1.0
+  quantized = np.clip(np.round(weights / scale), -127, 127).astype(np.int8)
+  return quantized, scale.astype(np.float32)
+
+
+def int8_variable_getter(getter, name, *args, **kwargs):
+  """Custom getter that reads int8 weights and dequantizes them.
+
+  The weights selected by `get_quantization_axis` are read from a non-trainable
+  int8 variable "<name>_int8" and a float32 variable "<name>_scale", as
+  written by `quantize_checkpoint.py`, and returned as their product.
+  """
+  shape = kwargs.get("shape")
+  axis = None
+  if shape is not None:
+    axis = get_quantization_axis(name, tf.TensorShape(shape).as_list())
+  if axis is None:
+    return getter(name, *args, **kwargs)
+
+  scale_shape = tf.TensorShape(shape).as_list()
+  scale_shape[axis] = 1
+  quantized = getter(
+      name + "_int8", *args,
+      **dict(kwargs, dtype=tf.int8, initializer=tf.zeros_initializer(),
+             trainable=False))
+  scale = getter(
+      name + "_scale", *args,
+      **dict(kwargs, shape=scale_shape, initializer=tf.ones_initializer(),
+             trainable=False))
+  return tf.cast(quantized, scale.dtype.base_dtype) * scale
+
+
 def get_timing_signal_1d_given_position(channels,
                                         position,
                                         min_timescale=1.0,
@@ -536,7 +827,8 @@ def embedding_postprocessor(input_tensor,
                             initializer_range=0.02,
                             max_position_embeddings=512,
                             dropout_prob=0.1,
-                            use_one_hot_embeddings=True):
+                            use_one_hot_embeddings=True,
+                            position_ids=None):
   """Performs various post-processing on a word embedding tensor.
 
   Args:
@@ -559,6 +851,8 @@ def embedding_postprocessor(input_tensor,
     dropout_prob: float. Dropout probability applied to the final output tensor.
     use_one_hot_embeddings: bool. If True, use one-hot method for word
       embeddings. If False, use `tf.nn.embedding_lookup()`.
+    position_ids: (optional) int32 Tensor of shape [batch_size, seq_length].
+      Defaults to the positions 0, 1, ..., seq_length - 1.
 
   Returns:
     float tensor with same shape as `input_tensor`.
@@ -595,7 +889,12 @@ def embedding_postprocessor(input_tensor,
     output += token_type_embeddings
 
   if use_position_embeddings:
-    assert_op = tf.assert_less_equal(seq_length, max_position_embeddings)
+    if position_ids is not None:
+      # The sequence can be longer than the table when positions repeat.
+      assert_op = tf.assert_less(tf.reduce_max(position_ids),
+                                 max_position_embeddings)
+    else:
+      assert_op = tf.assert_less_equal(seq_length, max_position_embeddings)
     with tf.control_dependencies([assert_op]):
       full_position_embeddings = tf.get_variable(
           name=position_embedding_name,
@@ -610,20 +909,33 @@ def embedding_postprocessor(input_tensor,
       # for position [0, 1, 2, ..., max_position_embeddings-1], and the current
       # sequence has positions [0, 1, 2, ... seq_length-1], so we can just
       # perform a slice.
-      position_embeddings = tf.slice(full_position_embeddings, [0, 0],
-                                     [seq_length, -1])
-      num_dims = len(output.shape.as_list())
-
-      # Only the last two dimensions are relevant (`seq_length` and `width`), so
-      # we broadcast among the first dimensions, which is typically just
-      # the batch size.
-      position_broadcast_shape = []
-      for _ in range(num_dims - 2):
-        position_broadcast_shape.append(1)
-      position_broadcast_shape.extend([seq_length, width])
-      position_embeddings = tf.reshape(position_embeddings,
-                                       position_broadcast_shape)
-      output += position_embeddings
+      if position_ids is not None:
+        if use_one_hot_embeddings:
+          flat_position_ids = tf.reshape(position_ids, [-1])
+          one_hot_ids = tf.one_hot(flat_position_ids,
+                                   depth=max_position_embeddings)
+          position_embeddings = tf.matmul(one_hot_ids, full_position_embeddings)
+          position_embeddings = tf.reshape(position_embeddings,
+                                           [batch_size, seq_length, width])
+        else:
+          position_embeddings = tf.nn.embedding_lookup(full_position_embeddings,
+                                                       position_ids)
+        output += position_embeddings
+      else:
+        position_embeddings = tf.slice(full_position_embeddings, [0, 0],
+                                       [seq_length, -1])
+        num_dims = len(output.shape.as_list())
+
+        # Only the last two dimensions are relevant (`seq_length` and
+        # `width`), so we broadcast among the first dimensions, which is
+        # typically just the batch size.
+        position_broadcast_shape = []
+        for _ in range(num_dims - 2):
+          position_broadcast_shape.append(1)
+        position_broadcast_shape.extend([seq_length, width])
+        position_embeddings = tf.reshape(position_embeddings,
+                                         position_broadcast_shape)
+        output += position_embeddings
 
   output = layer_norm_and_dropout(output, dropout_prob)
   return output
@@ -686,12 +998,14 @@ def dense_layer_3d(input_tensor,
     w = tf.get_variable(
         name="kernel",
         shape=[hidden_size, num_attention_heads * head_size],
-        initializer=initializer)
+        initializer=initializer,
+        dtype=input_tensor.dtype)
     w = tf.reshape(w, [hidden_size, num_attention_heads, head_size])
     b = tf.get_variable(
         name="bias",
         shape=[num_attention_heads * head_size],
-        initializer=tf.zeros_initializer)
+        initializer=tf.zeros_initializer,
+        dtype=input_tensor.dtype)
     b = tf.reshape(b, [num_attention_heads, head_size])
     if use_einsum:
       ret = tf.einsum("BFH,HND->BFND", input_tensor, w)
@@ -704,6 +1018,57 @@ def dense_layer_3d(input_tensor,
     return ret
 
 
+def dense_layer_3d_qkv(input_tensor,
+                       num_attention_heads,
+                       head_size,
+                       initializer,
+                       use_einsum):
+  """The query, key and value dense layers of self-attention as one layer.
+
+  Reads the same `query`, `key` and `value` variables as three
+  `dense_layer_3d` calls, but runs a single matmul with their concatenated
+  kernels and directly produces the head-major layout of the attention.
+
+  Args:
+    input_tensor: float Tensor of shape [batch, seq_length, hidden_size].
+    num_attention_heads: Number of attention heads.
+    head_size: The size per attention head.
+    initializer: Kernel initializer.
+    use_einsum: bool. Whether to use einsum or reshape+matmul for dense layers.
+
+  Returns:
+    A list of the query, key and value float Tensors, of shape [batch,
+    num_attention_heads, seq_length, head_size].
+  """
+  input_shape = get_shape_list(input_tensor, expected_rank=3)
+  hidden_size = input_shape[2]
+
+  kernels = []
+  biases = []
+  for name in ("query", "key", "value"):
+    with tf.variable_scope(name):
+      kernels.append(tf.get_variable(
+          name="kernel",
+          shape=[hidden_size, num_attention_heads * head_size],
+          initializer=initializer,
+          dtype=input_tensor.dtype))
+      biases.append(tf.get_variable(
+          name="bias",
+          shape=[num_attention_heads * head_size],
+          initializer=tf.zeros_initializer,
+          dtype=input_tensor.dtype))
+  w = tf.reshape(tf.concat(kernels, axis=1),
+                 [hidden_size, 3, num_attention_heads, head_size])
+  b = tf.reshape(tf.concat(biases, axis=0),
+                 [3, 1, num_attention_heads, 1, head_size])
+  if use_einsum:
+    ret = tf.einsum("BFH,HKND->KBNFD", input_tensor, w)
+  else:
+    ret = tf.transpose(einsum_via_matmul(input_tensor, w, 1), [2, 0, 3, 1, 4])
+  ret += b
+  return tf.unstack(ret, axis=0)
+
+
 def dense_layer_3d_proj(input_tensor,
                         hidden_size,
                         head_size,
@@ -732,10 +1097,12 @@ def dense_layer_3d_proj(input_tensor,
     w = tf.get_variable(
         name="kernel",
         shape=[num_attention_heads * head_size, hidden_size],
-        initializer=initializer)
+        initializer=initializer,
+        dtype=input_tensor.dtype)
     w = tf.reshape(w, [num_attention_heads, head_size, hidden_size])
     b = tf.get_variable(
-        name="bias", shape=[hidden_size], initializer=tf.zeros_initializer)
+        name="bias", shape=[hidden_size], initializer=tf.zeros_initializer,
+        dtype=input_tensor.dtype)
     if use_einsum:
       ret = tf.einsum("BFND,NDH->BFH", input_tensor, w)
     else:
@@ -775,9 +1142,11 @@ def dense_layer_2d(input_tensor,
     w = tf.get_variable(
         name="kernel",
         shape=[hidden_size, output_size],
-        initializer=initializer)
+        initializer=initializer,
+        dtype=input_tensor.dtype)
     b = tf.get_variable(
-        name="bias", shape=[output_size], initializer=tf.zeros_initializer)
+        name="bias", shape=[output_size], initializer=tf.zeros_initializer,
+        dtype=input_tensor.dtype)
     if use_einsum:
       ret = tf.einsum("BFH,HO->BFO", input_tensor, w)
     else:
@@ -789,6 +1158,32 @@ def dense_layer_2d(input_tensor,
     return ret
 
 
+def create_attention_bias(attention_mask):
+  """Creates the additive attention bias of an attention mask.
+
+  Args:
+    attention_mask: int32 Tensor of shape [batch_size, to_seq_length], or
+      [batch_size, from_seq_length, to_seq_length] to mask the keys per
+      query, with 1 for positions that can be attended to and 0 in positions
+      that should not be.
+
+  Returns:
+    float32 Tensor of shape [batch_size, 1, 1, to_seq_length] (or
+    [batch_size, 1, from_seq_length, to_seq_length]) that broadcasts against
+    the attention logits of every head and query.
+  """
+  mask = tf.cast(attention_mask, tf.float32)
+  if mask.shape.ndims == 3:
+    mask = tf.expand_dims(mask, 1)
+  else:
+    mask = mask[:, None, None, :]
+
+  # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
+  # masked positions, this operation will create a tensor which is 0.0 for
+  # positions we want to attend and -10000.0 for masked positions.
+  return (1.0 - mask) * -10000.0
+
+
 def dot_product_attention(q, k, v, bias, dropout_rate=0.0):
   """Dot-product attention.
 
@@ -798,7 +1193,8 @@ def dot_product_attention(q, k, v, bias, dropout_rate=0.0):
       match with q.
     v: Tensor with shape [..., length_kv, depth_v] Leading dimensions must
       match with q.
-    bias: bias Tensor (see attention_bias())
+    bias: (optional) additive attention bias that broadcasts against the
+      [..., length_q, length_kv] logits, e.g. from `create_attention_bias`.
     dropout_rate: a float.
 
   Returns:
@@ -806,33 +1202,277 @@ def dot_product_attention(q, k, v, bias, dropout_rate=0.0):
   """
   logits = tf.matmul(q, k, transpose_b=True)  # [..., length_q, length_kv]
   logits = tf.multiply(logits, 1.0 / math.sqrt(float(get_shape_list(q)[-1])))
+  # The softmax of reduced-precision inputs runs in float32.
+  logits = tf.cast(logits, tf.float32)
   if bias is not None:
-    # `attention_mask` = [B, T]
-    from_shape = get_shape_list(q)
-    if len(from_shape) == 4:
-      broadcast_ones = tf.ones([from_shape[0], 1, from_shape[2], 1], tf.float32)
-    elif len(from_shape) == 5:
-      # from_shape = [B, N, Block_num, block_size, depth]#
-      broadcast_ones = tf.ones([from_shape[0], 1, from_shape[2], from_shape[3],
-                                1], tf.float32)
-
-    bias = tf.matmul(broadcast_ones,
-                     tf.cast(bias, tf.float32), transpose_b=True)
-
-    # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
-    # masked positions, this operation will create a tensor which is 0.0 for
-    # positions we want to attend and -10000.0 for masked positions.
-    adder = (1.0 - bias) * -10000.0
-
     # Since we are adding it to the raw scores before the softmax, this is
-    # effectively the same as removing these entirely.
-    logits += adder
-  else:
-    adder = 0.0
+    # effectively the same as removing the masked positions entirely.
+    logits += bias
 
   attention_probs = tf.nn.softmax(logits, name="attention_probs")
   attention_probs = dropout(attention_probs, dropout_rate)
-  return tf.matmul(attention_probs, v)
+  return tf.matmul(tf.cast(attention_probs, v.dtype), v)
+
+
+def chunked_dot_product_attention(q, k, v, bias, chunk_size,
+                                  dropout_rate=0.0):
+  """Dot-product attention computed chunk by chunk with a streaming softmax.
+
+  Gives the same result as `dot_product_attention`, but only materializes the
+  logits of `chunk_size` queries against `chunk_size` keys at a time: each
+  chunk of queries runs over the chunks of keys keeping the running maximum,
+  normalizer and weighted sum of the values of the softmax. The backward pass
+  recomputes the probabilities of each chunk from the log normalizers of the
+  queries instead of keeping them, so the memory of training grows linearly
+  with the sequence length as well.
+
+  Args:
+    q: Tensor with shape [B, N, F, depth_k].
+    k: Tensor with shape [B, N, T, depth_k].
+    v: Tensor with shape [B, N, T, depth_v].
+    bias: (optional) additive attention bias of shape [B, 1, 1, T] or
+      [B, 1, F, T], e.g. from `create_attention_bias`. No gradient flows into
+      it.
+    chunk_size: int. The number of queries and keys of a chunk.
+    dropout_rate: a float. Must be 0, since the backward pass could not
+      recompute the dropout masks.
+
+  Returns:
+    Tensor with shape [B, N, F, depth_v].
+
+  Raises:
+    ValueError: If `dropout_rate` is not 0.
+  """
+  if dropout_rate:
+    raise ValueError("`chunked_dot_product_attention` does not support "
+                     "attention dropout.")
+  batch_size, num_heads, from_length, depth = get_shape_list(
+      q, expected_rank=4)
+  to_length = get_shape_list(k, expected_rank=4)[2]
+  depth_v = get_shape_list(v, expected_rank=4)[3]
+  num_from_chunks = (from_length + chunk_size - 1) // chunk_size
+  num_to_chunks = (to_length + chunk_size - 1) // chunk_size
+  from_padding = num_from_chunks * chunk_size - from_length
+  to_padding = num_to_chunks * chunk_size - to_length
+  scale = 1.0 / math.sqrt(float(depth))
+
+  def to_chunks(x, padding, num_chunks):
+    # [B, N, L, D] -> [num_chunks, B, N, chunk_size, D]
+    x = tf.pad(x, [[0, 0], [0, 0], [0, padding], [0, 0]])
+    x = tf.reshape(x, [batch_size, num_heads, num_chunks, chunk_size, -1])
+    return tf.transpose(x, [2, 0, 1, 3, 4])
+
+  def from_chunks(x, length):
+    # [num_chunks, B, N, chunk_size, D] -> [B, N, L, D]
+    x = tf.transpose(x, [1, 2, 0, 3, 4])
+    x = tf.reshape(x, [batch_size, num_heads, -1, get_shape_list(x)[-1]])
+    return x[:, :, :length]
+
+  # The padded keys get a much lower bias than the masked ones, so that they
+  # do not take part in the softmax even when all the keys are masked.
+  if bias is None:
+    bias = tf.zeros([1, 1, 1, to_length])
+  bias = tf.stop_gradient(bias)
+  per_query_bias = bias.shape[2].value != 1
+  bias = tf.pad(bias, [[0, 0], [0, 0],
+                       [0, from_padding if per_query_bias else 0],
+                       [0, to_padding]], constant_values=-1e9)
+  bias_shape = get_shape_list(bias, expected_rank=4)
+  if per_query_bias:
+    # [num_from_chunks, num_to_chunks, B, 1, chunk_size, chunk_size]
+    bias_chunks = tf.reshape(
+        bias, [bias_shape[0], 1, num_from_chunks, chunk_size, num_to_chunks,
+               chunk_size])
+    bias_chunks = tf.transpose(bias_chunks, [2, 4, 0, 1, 3, 5])
+  else:
+    # [num_to_chunks, B, 1, 1, chunk_size]
+    bias_chunks = tf.reshape(
+        bias, [bias_shape[0], 1, 1, num_to_chunks, chunk_size])
+    bias_chunks = tf.transpose(bias_chunks, [3, 0, 1, 2, 4])
+
+  def chunk_logits(q_chunk, k_chunk, i, j):
+    """The float32 logits of the i-th chunk of queries to the j-th of keys."""
+    logits = tf.cast(tf.matmul(q_chunk, k_chunk, transpose_b=True),
+                     tf.float32)
+    return logits + (bias_chunks[i, j] if per_query_bias else bias_chunks[j])
+
+  @tf.custom_gradient
+  def attention(q, k, v):
+    """Returns the attention outputs with a gradient that recomputes them."""
+    q_chunks = to_chunks(q * scale, from_padding, num_from_chunks)
+    k_chunks = to_chunks(k, to_padding, num_to_chunks)
+    v_chunks = to_chunks(v, to_padding, num_to_chunks)
+
+    def attend_from_chunk(i):
+      """Attends from the i-th chunk of queries to all the keys."""
+
+      def body(j, running_max, normalizer, weighted_sum):
+        logits = chunk_logits(q_chunks[i], k_chunks[j], i, j)
+        new_max = tf.maximum(running_max,
+                             tf.reduce_max(logits, axis=-1, keepdims=True))
+        probs = tf.exp(logits - new_max)
+        correction = tf.exp(running_max - new_max)
+        normalizer = normalizer * correction + tf.reduce_sum(
+            probs, axis=-1, keepdims=True)
+        chunk_sum = tf.matmul(tf.cast(probs, v.dtype), v_chunks[j])
+        weighted_sum = (weighted_sum * correction +
+                        tf.cast(chunk_sum, tf.float32))
+        return j + 1, new_max, normalizer, weighted_sum
+
+      _, running_max, normalizer, weighted_sum = tf.while_loop(
+          lambda j, unused_max, unused_normalizer, unused_sum: (
+              j < num_to_chunks), body,
+          [tf.constant(0),
+           tf.fill([batch_size, num_heads, chunk_size, 1], -float("inf")),
+           tf.zeros([batch_size, num_heads, chunk_size, 1]),
+           tf.zeros([batch_size, num_heads, chunk_size, depth_v])])
+      return weighted_sum / normalizer, running_max + tf.log(normalizer)
+
+    # [num_from_chunks, B, N, chunk_size, depth_v] and the log normalizers
+    # [num_from_chunks, B, N, chunk_size, 1] of the softmax.
+    output_chunks, log_normalizers = tf.map_fn(
+        attend_from_chunk, tf.range(num_from_chunks),
+        dtype=(tf.float32, tf.float32), parallel_iterations=1)
+
+    def grad(d_outputs):
+      """Recomputes the probabilities chunk by chunk to backpropagate."""
+      q32_chunks = tf.cast(q_chunks, tf.float32)
+      k32_chunks = tf.cast(k_chunks, tf.float32)
+      v32_chunks = tf.cast(v_chunks, tf.float32)
+      d_output_chunks = to_chunks(tf.cast(d_outputs, tf.float32),
+                                  from_padding, num_from_chunks)
+      # The gradient of the softmax normalizer, one per query.
+      d_normalizers = tf.reduce_sum(
+          d_output_chunks * output_chunks, axis=-1, keepdims=True)
+
+      def chunk_grads(i, j):
+        """The probabilities and logit gradients of a pair of chunks."""
+        probs = tf.exp(chunk_logits(q32_chunks[i], k32_chunks[j], i, j) -
+                       log_normalizers[i])
+        d_probs = tf.matmul(d_output_chunks[i], v32_chunks[j],
+                            transpose_b=True)
+        return probs, probs * (d_probs - d_normalizers[i])
+
+      def d_from_chunk(i):
+        """The gradient of the i-th chunk of queries."""
+
+        def body(j, d_q):
+          _, d_logits = chunk_grads(i, j)
+          return j + 1, d_q + tf.matmul(d_logits, k32_chunks[j])
+
+        _, d_q = tf.while_loop(
+            lambda j, unused_d_q: j < num_to_chunks, body,
+            [tf.constant(0), tf.zeros([batch_size, num_heads, chunk_size,
+                                       depth])])
+        return d_q * scale
+
+      def d_to_chunk(j):
+        """The gradients of the j-th chunk of keys and values."""
+
+        def body(i, d_k, d_v):
+          probs, d_logits = chunk_grads(i, j)
+          d_k += tf.matmul(d_logits, q32_chunks[i], transpose_a=True)
+          d_v += tf.matmul(probs, d_output_chunks[i], transpose_a=True)
+          return i + 1, d_k, d_v
+
+        _, d_k, d_v = tf.while_loop(
+            lambda i, unused_d_k, unused_d_v: i < num_from_chunks, body,
+            [tf.constant(0),
+             tf.zeros([batch_size, num_heads, chunk_size, depth]),
+             tf.zeros([batch_size, num_heads, chunk_size, depth_v])])
+        return d_k, d_v
+
+      d_q = tf.map_fn(d_from_chunk, tf.range(num_from_chunks),
+                      dtype=tf.float32, parallel_iterations=1)
+      d_k, d_v = tf.map_fn(d_to_chunk, tf.range(num_to_chunks),
+                           dtype=(tf.float32, tf.float32),
+                           parallel_iterations=1)
+      return (tf.cast(from_chunks(d_q, from_length), q.dtype),
+              tf.cast(from_chunks(d_k, to_length), k.dtype),
+              tf.cast(from_chunks(d_v, to_length), v.dtype))
+
+    return tf.cast(from_chunks(output_chunks, from_length), v.dtype), grad
+
+  return attention(q, k, v)
+
+
+def local_dot_product_attention(q, k, v, attention_mask, block_size,
+                                num_global_tokens=1, dropout_rate=0.0):
+  """Sliding-window dot-product attention with global tokens.
+
+  The sequence is split into blocks of `block_size` tokens. The queries of a
+  block attend to the keys of the same and of the two neighbouring blocks and
+  to the first `num_global_tokens` keys, which are global: their queries
+  attend to all the keys. The cost grows linearly with the sequence length.
+
+  Args:
+    q: Tensor with shape [B, N, T, depth_k].
+    k: Tensor with shape [B, N, T, depth_k].
+    v: Tensor with shape [B, N, T, depth_v].
+    attention_mask: (optional) int32 Tensor of shape [B, T], with 1 for
+      positions that can be attended to and 0 in positions that should not be.
+    block_size: int. The number of tokens of a block.
+    num_global_tokens: int. The number of leading global tokens.
+    dropout_rate: a float.
+
+  Returns:
+    Tensor with shape [B, N, T, depth_v].
+  """
+  batch_size, num_heads, seq_length, _ = get_shape_list(q, expected_rank=4)
+  if attention_mask is None:
+    attention_mask = tf.ones([batch_size, seq_length], dtype=tf.int32)
+  num_blocks = (seq_length + block_size - 1) // block_size
+  padding = num_blocks * block_size - seq_length
+
+  def to_blocks(x):
+    # [B, N, T, D] -> [B, N, num_blocks, block_size, D]
+    x = tf.pad(x, [[0, 0], [0, 0], [0, padding], [0, 0]])
+    return tf.reshape(x, [batch_size, num_heads, num_blocks, block_size, -1])
+
+  def with_neighbours(x, axis):
+    # Concatenates the previous, current and next block of every block.
+    paddings = [[0, 0]] * x.shape.ndims
+    previous = tf.pad(x, paddings[:axis] + [[1, 0]] + paddings[axis + 1:])
+    following = tf.pad(x, paddings[:axis] + [[0, 1]] + paddings[axis + 1:])
+    previous = tf.gather(previous, tf.range(num_blocks), axis=axis)
+    following = tf.gather(following, tf.range(1, num_blocks + 1), axis=axis)
+    return tf.concat([previous, x, following], axis=axis + 1)
+
+  # The global tokens are masked out of the windows since every block already
+  # attends to them.
+  mask = tf.cast(attention_mask, tf.float32)
+  window_mask = mask * tf.cast(
+      tf.range(seq_length) >= num_global_tokens, tf.float32)[None]
+  window_mask = tf.reshape(tf.pad(window_mask, [[0, 0], [0, padding]]),
+                           [batch_size, num_blocks, block_size])
+  window_mask = with_neighbours(window_mask, 1)
+
+  # `window_k` = [B, N, num_blocks, 3 * block_size + num_global_tokens, D]
+  window_k = with_neighbours(to_blocks(k), 2)
+  window_v = with_neighbours(to_blocks(v), 2)
+  if num_global_tokens > 0:
+    global_mask = tf.tile(mask[:, None, :num_global_tokens],
+                          [1, num_blocks, 1])
+    window_mask = tf.concat([window_mask, global_mask], axis=2)
+    window_k = tf.concat([window_k, tf.tile(
+        k[:, :, None, :num_global_tokens], [1, 1, num_blocks, 1, 1])], axis=3)
+    window_v = tf.concat([window_v, tf.tile(
+        v[:, :, None, :num_global_tokens], [1, 1, num_blocks, 1, 1])], axis=3)
+  # `window_bias` = [B, 1, num_blocks, 1, 3 * block_size + num_global_tokens]
+  window_bias = (1.0 - window_mask[:, None, :, None]) * -10000.0
+
+  outputs = dot_product_attention(to_blocks(q), window_k, window_v,
+                                  window_bias, dropout_rate)
+  outputs = tf.reshape(outputs, [batch_size, num_heads, -1,
+                                 get_shape_list(v, expected_rank=4)[3]])
+  outputs = outputs[:, :, :seq_length]
+  if num_global_tokens > 0:
+    global_outputs = dot_product_attention(
+        q[:, :, :num_global_tokens], k, v,
+        create_attention_bias(attention_mask), dropout_rate)
+    outputs = tf.concat(
+        [global_outputs, outputs[:, :, num_global_tokens:]], axis=2)
+  return outputs
 
 
 def attention_layer(from_tensor,
@@ -847,17 +1487,24 @@ def attention_layer(from_tensor,
                     batch_size=None,
                     from_seq_length=None,
                     to_seq_length=None,
-                    use_einsum=True):
+                    use_einsum=True,
+                    attention_bias=None,
+                    attention_chunk_size=0,
+                    attention_window_size=0,
+                    num_global_tokens=1,
+                    token_indices=None,
+                    padded_shape=None):
   """Performs multi-headed attention from `from_tensor` to `to_tensor`.
 
   Args:
     from_tensor: float Tensor of shape [batch_size, from_seq_length,
       from_width].
     to_tensor: float Tensor of shape [batch_size, to_seq_length, to_width].
-    attention_mask: (optional) int32 Tensor of shape [batch_size, seq_length].
-      The values should be 1 or 0. The attention scores will effectively
-      be set to -infinity for any positions in the mask that are 0, and
-      will be unchanged for positions that are 1.
+    attention_mask: (optional) int32 Tensor of shape [batch_size, seq_length],
+      or [batch_size, from_seq_length, to_seq_length] to mask the keys per
+      query. The values should be 1 or 0. The attention scores will
+      effectively be set to -infinity for any positions in the mask that are
+      0, and will be unchanged for positions that are 1.
     num_attention_heads: int. Number of attention heads.
     query_act: (optional) Activation function for the query transform.
     key_act: (optional) Activation function for the key transform.
@@ -872,6 +1519,22 @@ def attention_layer(from_tensor,
     to_seq_length: (Optional) If the input is 2D, this might be the seq length
       of the 3D version of the `to_tensor`.
     use_einsum: bool. Whether to use einsum or reshape+matmul for dense layers
+    attention_bias: (optional) float Tensor from `create_attention_bias`,
+      used instead of `attention_mask` so that it is only computed once for
+      all the layers.
+    attention_chunk_size: int. If positive, use
+      `chunked_dot_product_attention` with chunks of this size.
+    attention_window_size: int. If positive, use
+      `local_dot_product_attention` with blocks of this size. It requires a
+      [batch_size, seq_length] `attention_mask`.
+    num_global_tokens: int. The number of global tokens of the sliding-window
+      attention.
+    token_indices: (optional) int32 Tensor of shape [num_tokens, 2]. If set,
+      `from_tensor` and `to_tensor` are [1, num_tokens, width] packed
+      sequences whose tokens are at these (batch, position) indices, and the
+      output is packed the same way.
+    padded_shape: (optional) [batch_size, seq_length] of the sequences of
+      `token_indices`.
 
   Returns:
     float Tensor of shape [batch_size, from_seq_length, num_attention_heads,
@@ -906,30 +1569,62 @@ def attention_layer(from_tensor,
   #   N = `num_attention_heads`
   #   H = `size_per_head`
 
-  # `query_layer` = [B, F, N, H]
-  q = dense_layer_3d(from_tensor, num_attention_heads, size_per_head,
-                     create_initializer(initializer_range), query_act,
-                     use_einsum, "query")
-
-  # `key_layer` = [B, T, N, H]
-  k = dense_layer_3d(to_tensor, num_attention_heads, size_per_head,
-                     create_initializer(initializer_range), key_act,
-                     use_einsum, "key")
-  # `value_layer` = [B, T, N, H]
-  v = dense_layer_3d(to_tensor, num_attention_heads, size_per_head,
-                     create_initializer(initializer_range), value_act,
-                     use_einsum, "value")
-  q = tf.transpose(q, [0, 2, 1, 3])
-  k = tf.transpose(k, [0, 2, 1, 3])
-  v = tf.transpose(v, [0, 2, 1, 3])
-  if attention_mask is not None:
-    attention_mask = tf.reshape(
-        attention_mask, [batch_size, 1, to_seq_length, 1])
-    # 'new_embeddings = [B, N, F, H]'
-  new_embeddings = dot_product_attention(q, k, v, attention_mask,
-                                         attention_probs_dropout_prob)
+  if (from_tensor is to_tensor and len(from_shape) == 3 and
+      query_act is None and key_act is None and value_act is None):
+    # Self-attention projects the queries, keys and values with one matmul.
+    # `q`, `k`, `v` = [B, N, F, H]
+    q, k, v = dense_layer_3d_qkv(from_tensor, num_attention_heads,
+                                 size_per_head,
+                                 create_initializer(initializer_range),
+                                 use_einsum)
+  else:
+    # `query_layer` = [B, F, N, H]
+    q = dense_layer_3d(from_tensor, num_attention_heads, size_per_head,
+                       create_initializer(initializer_range), query_act,
+                       use_einsum, "query")
+
+    # `key_layer` = [B, T, N, H]
+    k = dense_layer_3d(to_tensor, num_attention_heads, size_per_head,
+                       create_initializer(initializer_range), key_act,
+                       use_einsum, "key")
+    # `value_layer` = [B, T, N, H]
+    v = dense_layer_3d(to_tensor, num_attention_heads, size_per_head,
+                       create_initializer(initializer_range), value_act,
+                       use_einsum, "value")
+    q = tf.transpose(q, [0, 2, 1, 3])
+    k = tf.transpose(k, [0, 2, 1, 3])
+    v = tf.transpose(v, [0, 2, 1, 3])
+  if token_indices is not None:
+    # Scatter the packed tokens back to [B, N, F, H] for the attention.
+    q, k, v = [
+        tf.transpose(
+            tf.scatter_nd(token_indices, tf.transpose(x[0], [1, 0, 2]),
+                          padded_shape + [num_attention_heads, size_per_head]),
+            [0, 2, 1, 3]) for x in (q, k, v)
+    ]
+  if attention_bias is None and attention_mask is not None:
+    attention_bias = create_attention_bias(attention_mask)
+  # 'new_embeddings = [B, N, F, H]'
+  if attention_window_size > 0:
+    if attention_mask is not None and attention_mask.shape.ndims == 3:
+      raise ValueError("Sliding-window attention does not support a "
+                       "[batch_size, from_seq_length, to_seq_length] "
+                       "attention mask.")
+    new_embeddings = local_dot_product_attention(
+        q, k, v, attention_mask, attention_window_size, num_global_tokens,
+        attention_probs_dropout_prob)
+  elif attention_chunk_size > 0:
+    new_embeddings = chunked_dot_product_attention(
+        q, k, v, attention_bias, attention_chunk_size,
+        attention_probs_dropout_prob)
+  else:
+    new_embeddings = dot_product_attention(q, k, v, attention_bias,
+                                           attention_probs_dropout_prob)
 
-  return tf.transpose(new_embeddings, [0, 2, 1, 3])
+  new_embeddings = tf.transpose(new_embeddings, [0, 2, 1, 3])
+  if token_indices is not None:
+    new_embeddings = tf.gather_nd(new_embeddings, token_indices)[None]
+  return new_embeddings
 
 
 def attention_ffn_block(layer_input,
@@ -942,17 +1637,24 @@ def attention_ffn_block(layer_input,
                         intermediate_act_fn=None,
                         initializer_range=0.02,
                         hidden_dropout_prob=0.0,
-                        use_einsum=True):
+                        use_einsum=True,
+                        attention_bias=None,
+                        attention_chunk_size=0,
+                        attention_window_size=0,
+                        num_global_tokens=1,
+                        token_indices=None,
+                        padded_shape=None):
   """A network with attention-ffn as sub-block.
 
   Args:
     layer_input: float Tensor of shape [batch_size, from_seq_length,
       from_width].
     hidden_size: (optional) int, size of hidden layer.
-    attention_mask: (optional) int32 Tensor of shape [batch_size, seq_length].
-      The values should be 1 or 0. The attention scores will effectively be set
-      to -infinity for any positions in the mask that are 0, and will be
-      unchanged for positions that are 1.
+    attention_mask: (optional) int32 Tensor of shape [batch_size, seq_length]
+      or [batch_size, seq_length, seq_length]. The values should be 1 or 0.
+      The attention scores will effectively be set to -infinity for any
+      positions in the mask that are 0, and will be unchanged for positions
+      that are 1.
     num_attention_heads: int. Number of attention heads.
     attention_head_size: int. Size of attention head.
     attention_probs_dropout_prob: float. dropout probability for attention_layer
@@ -963,6 +1665,17 @@ def attention_ffn_block(layer_input,
     hidden_dropout_prob: (optional) float. Dropout probability of the hidden
       layer.
     use_einsum: bool. Whether to use einsum or reshape+matmul for dense layers
+    attention_bias: (optional) float Tensor from `create_attention_bias`, used
+      instead of `attention_mask`.
+    attention_chunk_size: int. If positive, the attention is computed over
+      chunks of this size.
+    attention_window_size: int. If positive, use sliding-window attention
+      with blocks of this size.
+    num_global_tokens: int. The number of global tokens of the sliding-window
+      attention.
+    token_indices: (optional) int32 Tensor of shape [num_tokens, 2] of the
+      tokens of a packed `layer_input`; see `attention_layer`.
+    padded_shape: (optional) [batch_size, seq_length] of the packed sequences.
 
   Returns:
     layer output
@@ -977,7 +1690,13 @@ def attention_ffn_block(layer_input,
           num_attention_heads=num_attention_heads,
           attention_probs_dropout_prob=attention_probs_dropout_prob,
           initializer_range=initializer_range,
-          use_einsum=use_einsum)
+          use_einsum=use_einsum,
+          attention_bias=attention_bias,
+          attention_chunk_size=attention_chunk_size,
+          attention_window_size=attention_window_size,
+          num_global_tokens=num_global_tokens,
+          token_indices=token_indices,
+          padded_shape=padded_shape)
 
     # Run a linear projection of `hidden_size` then add a residual
     # with `layer_input`.
@@ -1016,6 +1735,60 @@ def attention_ffn_block(layer_input,
   return ffn_output
 
 
+def recompute_grad(fn, input_tensor):
+  """Calls `fn` without keeping its activations for the backward pass.
+
+  The gradient recomputes `fn` from `input_tensor` once the gradients of its
+  outputs are available (gradient checkpointing), trading compute for
+  activation memory. `fn` must be deterministic, e.g. without dropout, and
+  read its variables with `tf.get_variable` in the current variable scope.
+
+  Args:
+    fn: function from a float Tensor to a list of float Tensors.
+    input_tensor: float Tensor.
+
+  Returns:
+    The list of Tensors returned by `fn`.
+  """
+  variable_scope = tf.get_variable_scope()
+  weights = collections.OrderedDict()
+
+  def record_getter(getter, name, *args, **kwargs):
+    # Shared layers read the same weight several times; every read must map to
+    # the tensor the gradient is taken with respect to.
+    if name not in weights:
+      weights[name] = getter(name, *args, **kwargs)
+    return weights[name]
+
+  with tf.variable_scope(variable_scope, custom_getter=record_getter,
+                         auxiliary_name_scope=False):
+    outputs = fn(input_tensor)
+
+  @tf.custom_gradient
+  def checkpoint(layer_input, *weight_values):
+    """Returns `outputs` with a gradient that recomputes them."""
+
+    def grad(*output_grads):
+      with tf.control_dependencies(output_grads):
+        recompute_input = tf.identity(layer_input)
+      values = dict(zip(weights.keys(), weight_values))
+
+      def substitute_getter(getter, name, *args, **kwargs):
+        if name in values:
+          return values[name]
+        return getter(name, *args, **kwargs)
+
+      with tf.variable_scope(variable_scope, custom_getter=substitute_getter,
+                             auxiliary_name_scope=False):
+        recomputed = fn(recompute_input)
+      return tf.gradients(recomputed, [recompute_input] + list(weight_values),
+                          grad_ys=list(output_grads))
+
+    return list(outputs), grad
+
+  return checkpoint(input_tensor, *weights.values())
+
+
 def transformer_model(input_tensor,
                       attention_mask=None,
                       hidden_size=768,
@@ -1029,7 +1802,14 @@ def transformer_model(input_tensor,
                       attention_probs_dropout_prob=0.1,
                       initializer_range=0.02,
                       do_return_all_layers=False,
-                      use_einsum=True):
+                      use_einsum=True,
+                      attention_chunk_size=0,
+                      attention_window_size=0,
+                      num_global_tokens=1,
+                      use_layer_loop=False,
+                      remove_padding=False,
+                      compute_dtype=tf.float32,
+                      recompute_layers=0):
   """Multi-headed, multi-layer Transformer from "Attention is All You Need".
 
   This is almost an exact implementation of the original Transformer encoder.
@@ -1042,9 +1822,9 @@ def transformer_model(input_tensor,
 
   Args:
     input_tensor: float Tensor of shape [batch_size, seq_length, hidden_size].
-    attention_mask: (optional) int32 Tensor of shape [batch_size, seq_length],
-      with 1 for positions that can be attended to and 0 in positions that
-      should not be.
+    attention_mask: (optional) int32 Tensor of shape [batch_size, seq_length]
+      or [batch_size, seq_length, seq_length], with 1 for positions that can
+      be attended to and 0 in positions that should not be.
     hidden_size: int. Hidden size of the Transformer.
     num_hidden_layers: int. Number of layers (blocks) in the Transformer.
     num_hidden_groups: int. Number of group for the hidden layers, parameters
@@ -1063,6 +1843,26 @@ def transformer_model(input_tensor,
     do_return_all_layers: Whether to also return all layers or just the final
       layer.
     use_einsum: bool. Whether to use einsum or reshape+matmul for dense layers
+    attention_chunk_size: int. If positive, the attention is computed over
+      chunks of this size.
+    attention_window_size: int. If positive, use sliding-window attention
+      with blocks of this size.
+    num_global_tokens: int. The number of global tokens of the sliding-window
+      attention.
+    use_layer_loop: bool. Whether to run the layers in a `tf.while_loop` when
+      they all share their parameters (`num_hidden_groups` == 1), so the
+      graph holds one copy of the layer instead of `num_hidden_layers`. The
+      shared weights are read, and cast to `compute_dtype`, once before the
+      loop.
+    remove_padding: bool. Whether to pack the tokens that `attention_mask`
+      keeps into one sequence for the position-wise layers, so that no work
+      is spent on padding. The outputs at the padded positions are 0.
+    compute_dtype: tf.DType. The dtype the layers compute in. Their variables
+      are float32 (see `float32_variable_getter`) and their outputs are cast
+      back to float32.
+    recompute_layers: int. If positive, the layers run in segments of this
+      many layers whose activations are recomputed in the backward pass (see
+      `recompute_grad`). Needs zero dropout probabilities.
 
   Returns:
     float Tensor of shape [batch_size, seq_length, hidden_size], the final
@@ -1076,10 +1876,31 @@ def transformer_model(input_tensor,
         "The hidden size (%d) is not a multiple of the number of attention "
         "heads (%d)" % (hidden_size, num_attention_heads))
 
+  if recompute_layers > 0:
+    if hidden_dropout_prob or attention_probs_dropout_prob:
+      raise ValueError("`recompute_layers` needs zero dropout probabilities, "
+                       "since the recomputed layers would draw new dropout "
+                       "masks.")
+    if use_layer_loop:
+      raise ValueError("`recompute_layers` is not supported with "
+                       "`use_layer_loop`.")
+
   attention_head_size = hidden_size // num_attention_heads
   input_shape = get_shape_list(input_tensor, expected_rank=3)
   input_width = input_shape[2]
 
+  token_indices = None
+  padded_shape = None
+  if remove_padding and attention_mask is not None:
+    if attention_mask.shape.ndims != 2:
+      raise ValueError("`remove_padding` needs a [batch_size, seq_length] "
+                       "attention mask.")
+    # `input_tensor` = [1, num_tokens, input_width]
+    padded_shape = input_shape[:2]
+    token_indices = tf.cast(tf.where(tf.cast(attention_mask, tf.bool)),
+                            tf.int32)
+    input_tensor = tf.gather_nd(input_tensor, token_indices)[None]
+
   all_layer_outputs = []
   if input_width != hidden_size:
     prev_output = dense_layer_2d(
@@ -1087,28 +1908,107 @@ def transformer_model(input_tensor,
         None, use_einsum=use_einsum, name="embedding_hidden_mapping_in")
   else:
     prev_output = input_tensor
-  with tf.variable_scope("transformer", reuse=tf.AUTO_REUSE):
-    for layer_idx in range(num_hidden_layers):
-      group_idx = int(layer_idx / num_hidden_layers * num_hidden_groups)
-      with tf.variable_scope("group_%d" % group_idx):
-        with tf.name_scope("layer_%d" % layer_idx):
-          layer_output = prev_output
-          for inner_group_idx in range(inner_group_num):
-            with tf.variable_scope("inner_group_%d" % inner_group_idx):
-              layer_output = attention_ffn_block(
-                  layer_input=layer_output,
-                  hidden_size=hidden_size,
-                  attention_mask=attention_mask,
-                  num_attention_heads=num_attention_heads,
-                  attention_head_size=attention_head_size,
-                  attention_probs_dropout_prob=attention_probs_dropout_prob,
-                  intermediate_size=intermediate_size,
-                  intermediate_act_fn=intermediate_act_fn,
-                  initializer_range=initializer_range,
-                  hidden_dropout_prob=hidden_dropout_prob,
-                  use_einsum=use_einsum)
-              prev_output = layer_output
-              all_layer_outputs.append(layer_output)
+  prev_output = tf.cast(prev_output, compute_dtype)
+
+  # The additive attention bias is the same for every layer.
+  attention_bias = None
+  if attention_mask is not None:
+    attention_bias = create_attention_bias(attention_mask)
+
+  def run_layer(layer_input):
+    """Runs the inner groups of a layer and returns all their outputs."""
+    layer_outputs = []
+    layer_output = layer_input
+    for inner_group_idx in range(inner_group_num):
+      with tf.variable_scope("inner_group_%d" % inner_group_idx):
+        layer_output = attention_ffn_block(
+            layer_input=layer_output,
+            hidden_size=hidden_size,
+            attention_mask=attention_mask,
+            attention_bias=attention_bias,
+            num_attention_heads=num_attention_heads,
+            attention_head_size=attention_head_size,
+            attention_probs_dropout_prob=attention_probs_dropout_prob,
+            intermediate_size=intermediate_size,
+            intermediate_act_fn=intermediate_act_fn,
+            initializer_range=initializer_range,
+            hidden_dropout_prob=hidden_dropout_prob,
+            use_einsum=use_einsum,
+            attention_chunk_size=attention_chunk_size,
+            attention_window_size=attention_window_size,
+            num_global_tokens=num_global_tokens,
+            token_indices=token_indices,
+            padded_shape=padded_shape)
+        layer_outputs.append(layer_output)
+    return layer_outputs
+
+  with tf.variable_scope("transformer", reuse=tf.AUTO_REUSE,
+                         custom_getter=float32_variable_getter):
+    if use_layer_loop and num_hidden_groups == 1 and num_hidden_layers > 1:
+      weights = {}
+
+      def outside_loop_getter(getter, name, *args, **kwargs):
+        # The shared weights are created, read and cast before the loop, so
+        # that the iterations reuse them instead of reading them again.
+        if name not in weights:
+          with tf.control_dependencies(None):
+            weights[name] = getter(name, *args, **kwargs)
+        return weights[name]
+
+      num_loop_outputs = num_hidden_layers * inner_group_num
+      loop_outputs = tf.TensorArray(
+          prev_output.dtype, size=num_loop_outputs,
+          element_shape=prev_output.shape)
+
+      def body(layer_idx, layer_input, loop_outputs):
+        with tf.variable_scope("group_0", custom_getter=outside_loop_getter):
+          layer_outputs = run_layer(layer_input)
+        for (inner_group_idx, layer_output) in enumerate(layer_outputs):
+          loop_outputs = loop_outputs.write(
+              layer_idx * inner_group_num + inner_group_idx, layer_output)
+        return layer_idx + 1, layer_outputs[-1], loop_outputs
+
+      _, _, loop_outputs = tf.while_loop(
+          lambda layer_idx, unused_input, unused_outputs: (
+              layer_idx < num_hidden_layers),
+          body, [tf.constant(0), prev_output, loop_outputs],
+          name="layer_loop")
+      all_layer_outputs.extend(
+          tf.unstack(loop_outputs.stack(), num=num_loop_outputs))
+    else:
+
+      def run_layers(layer_input, layer_indices):
+        """Runs consecutive layers and returns all their outputs."""
+        layer_outputs = []
+        for layer_idx in layer_indices:
+          group_idx = int(layer_idx / num_hidden_layers * num_hidden_groups)
+          with tf.variable_scope("group_%d" % group_idx):
+            with tf.name_scope("layer_%d" % layer_idx):
+              layer_outputs.extend(run_layer(layer_input))
+              layer_input = layer_outputs[-1]
+        return layer_outputs
+
+      segment_size = recompute_layers or num_hidden_layers
+      for start_idx in range(0, num_hidden_layers, segment_size):
+        layer_indices = range(start_idx,
+                              min(start_idx + segment_size, num_hidden_layers))
+        if recompute_layers > 0:
+          all_layer_outputs.extend(recompute_grad(
+              lambda x, layer_indices=layer_indices: run_layers(
+                  x, layer_indices), prev_output))
+        else:
+          all_layer_outputs.extend(run_layers(prev_output, layer_indices))
+        prev_output = all_layer_outputs[-1]
+
+  if token_indices is not None:
+    all_layer_outputs = [
+        tf.scatter_nd(token_indices, layer_output[0],
+                      padded_shape + [hidden_size])
+        for layer_output in all_layer_outputs
+    ]
+  all_layer_outputs = [
+      tf.cast(layer_output, tf.float32) for layer_output in all_layer_outputs
+  ]
   if do_return_all_layers:
     return all_layer_outputs
   else:
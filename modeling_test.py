@@ -164,6 +164,454 @@ class AlbertModelTest(tf.test.TestCase):
     ret2 = modeling.einsum_via_matmul(input_tensor, w, 2)
     self.assertAllClose(ret1, ret2)
 
+  def test_attention_mask_and_position_ids(self):
+    batch_size = 3
+    seq_length = 6
+    config = modeling.AlbertConfig(
+        vocab_size=99, embedding_size=8, hidden_size=16, num_hidden_layers=2,
+        num_attention_heads=2, intermediate_size=24)
+    input_ids = AlbertModelTest.ids_tensor([batch_size, seq_length], 99)
+    input_mask = tf.constant([[1] * 6, [1] * 4 + [0] * 2, [1] * 2 + [0] * 4])
+    model = modeling.AlbertModel(
+        config=config, is_training=False, input_ids=input_ids,
+        input_mask=input_mask, scope="bert")
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      model_with_ids = modeling.AlbertModel(
+          config=config, is_training=False, input_ids=input_ids,
+          input_mask=input_mask, scope="bert",
+          position_ids=tf.tile(tf.range(seq_length)[None], [batch_size, 1]),
+          attention_mask=tf.tile(input_mask[:, None], [1, seq_length, 1]))
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      output, output_with_ids = sess.run(
+          [model.get_sequence_output(), model_with_ids.get_sequence_output()])
+    self.assertAllClose(output, output_with_ids)
+
+  def test_shared_context_longer_than_position_embeddings(self):
+    # A context of 3 tokens and two choices of 2 tokens in one sequence of 7
+    # tokens, where each choice is positioned right after the context.
+    config = modeling.AlbertConfig(
+        vocab_size=99, embedding_size=8, hidden_size=16, num_hidden_layers=2,
+        num_attention_heads=2, intermediate_size=24,
+        max_position_embeddings=6)
+    context_ids = AlbertModelTest.ids_tensor([1, 3], 99)
+    choice_ids = [AlbertModelTest.ids_tensor([1, 2], 99) for _ in range(2)]
+    block_ids = np.array([0, 0, 0, 1, 1, 2, 2], dtype=np.int32)
+    block_mask = ((block_ids[None, :] == 0) |
+                  (block_ids[None, :] == block_ids[:, None]))
+    model = modeling.AlbertModel(
+        config=config, is_training=False,
+        input_ids=tf.concat([context_ids] + choice_ids, axis=1),
+        token_type_ids=tf.constant([np.minimum(block_ids, 1)]),
+        position_ids=tf.constant([[0, 1, 2, 3, 4, 3, 4]]),
+        attention_mask=tf.constant(block_mask[None].astype(np.int32)),
+        scope="bert")
+
+    # Each choice encoded alone after the context, which does not attend to
+    # the choice.
+    choice_mask = np.array([[1, 1, 1, 0, 0]] * 3 + [[1] * 5] * 2)
+    choice_models = []
+    for ids in choice_ids:
+      with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        choice_models.append(modeling.AlbertModel(
+            config=config, is_training=False,
+            input_ids=tf.concat([context_ids, ids], axis=1),
+            token_type_ids=tf.constant([[0, 0, 0, 1, 1]]),
+            attention_mask=tf.constant(choice_mask[None].astype(np.int32)),
+            scope="bert"))
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      output, output_a, output_b = sess.run(
+          [model.get_sequence_output()] +
+          [m.get_sequence_output() for m in choice_models])
+    self.assertAllClose(output[:, :3], output_a[:, :3], atol=1e-5)
+    self.assertAllClose(output[:, 3:5], output_a[:, 3:], atol=1e-5)
+    self.assertAllClose(output[:, 5:], output_b[:, 3:], atol=1e-5)
+
+  def test_create_attention_bias(self):
+    mask = tf.constant([[1, 1, 0], [1, 0, 0]])
+    bias = modeling.create_attention_bias(mask)
+    bias_3d = modeling.create_attention_bias(
+        tf.tile(mask[:, None], [1, 4, 1]))
+    self.assertAllEqual(bias.shape, [2, 1, 1, 3])
+    self.assertAllEqual(bias_3d.shape, [2, 1, 4, 3])
+
+    with self.test_session() as sess:
+      bias, bias_3d = sess.run([bias, bias_3d])
+    self.assertAllClose(bias[:, 0, 0], [[0, 0, -10000], [0, -10000, -10000]])
+    self.assertAllClose(bias_3d, np.tile(bias, [1, 1, 4, 1]))
+
+  def test_chunked_dot_product_attention(self):
+    batch_size = 2
+    num_heads = 3
+    seq_length = 11
+    q = tf.constant(np.random.normal(size=[batch_size, num_heads, seq_length,
+                                           4]), dtype=tf.float32)
+    k = tf.constant(np.random.normal(size=[batch_size, num_heads, seq_length,
+                                           4]), dtype=tf.float32)
+    v = tf.constant(np.random.normal(size=[batch_size, num_heads, seq_length,
+                                           5]), dtype=tf.float32)
+    mask = tf.constant([[1] * 11, [1] * 7 + [0] * 4])
+    biases = [
+        None,
+        modeling.create_attention_bias(mask),
+        modeling.create_attention_bias(
+            AlbertModelTest.ids_tensor([batch_size, seq_length, seq_length],
+                                       vocab_size=2)),
+    ]
+
+    ops = []
+    for bias in biases:
+      ops.append((modeling.dot_product_attention(q, k, v, bias),
+                  modeling.chunked_dot_product_attention(q, k, v, bias, 4)))
+    with self.test_session() as sess:
+      for (expected, actual) in sess.run(ops):
+        self.assertAllClose(expected, actual, atol=1e-5)
+
+  def test_chunked_dot_product_attention_gradients(self):
+    batch_size = 2
+    num_heads = 3
+    from_length = 7
+    to_length = 11
+    q = tf.constant(np.random.normal(size=[batch_size, num_heads, from_length,
+                                           4]), dtype=tf.float32)
+    k = tf.constant(np.random.normal(size=[batch_size, num_heads, to_length,
+                                           4]), dtype=tf.float32)
+    v = tf.constant(np.random.normal(size=[batch_size, num_heads, to_length,
+                                           5]), dtype=tf.float32)
+    # Weights the outputs so that the gradients differ per position.
+    weights = tf.constant(np.random.normal(
+        size=[batch_size, num_heads, from_length, 5]), dtype=tf.float32)
+    mask = tf.constant([[1] * 11, [1] * 7 + [0] * 4])
+    biases = [
+        None,
+        modeling.create_attention_bias(mask),
+        modeling.create_attention_bias(
+            AlbertModelTest.ids_tensor([batch_size, from_length, to_length],
+                                       vocab_size=2)),
+    ]
+
+    ops = []
+    for bias in biases:
+      expected = modeling.dot_product_attention(q, k, v, bias)
+      actual = modeling.chunked_dot_product_attention(q, k, v, bias, 4)
+      ops.append((tf.gradients(tf.reduce_sum(expected * weights), [q, k, v]),
+                  tf.gradients(tf.reduce_sum(actual * weights), [q, k, v])))
+    with self.test_session() as sess:
+      for (expected_grads, actual_grads) in sess.run(ops):
+        for (expected, actual) in zip(expected_grads, actual_grads):
+          self.assertAllClose(expected, actual, atol=1e-5)
+
+    with self.assertRaises(ValueError):
+      modeling.chunked_dot_product_attention(q, k, v, None, 4,
+                                             dropout_rate=0.1)
+
+  def test_local_dot_product_attention(self):
+    batch_size = 2
+    num_heads = 3
+    seq_length = 11
+    block_size = 3
+    q = tf.constant(np.random.normal(size=[batch_size, num_heads, seq_length,
+                                           4]), dtype=tf.float32)
+    k = tf.constant(np.random.normal(size=[batch_size, num_heads, seq_length,
+                                           4]), dtype=tf.float32)
+    v = tf.constant(np.random.normal(size=[batch_size, num_heads, seq_length,
+                                           5]), dtype=tf.float32)
+    mask = np.array([[1] * 11, [1] * 7 + [0] * 4])
+
+    ops = []
+    for num_global_tokens in [0, 1, 2]:
+      # The equivalent full attention mask of the sliding window.
+      blocks = np.arange(seq_length) // block_size
+      local_mask = np.abs(blocks[:, None] - blocks[None]) <= 1
+      local_mask[:, :num_global_tokens] = True
+      local_mask[:num_global_tokens] = True
+      full_mask = local_mask[None] * mask[:, None]
+      ops.append((
+          modeling.dot_product_attention(
+              q, k, v, modeling.create_attention_bias(tf.constant(full_mask))),
+          modeling.local_dot_product_attention(
+              q, k, v, tf.constant(mask), block_size, num_global_tokens)))
+    with self.test_session() as sess:
+      for (expected, actual) in sess.run(ops):
+        self.assertAllClose(expected, actual, atol=1e-5)
+
+  def test_fused_qkv_attention_layer(self):
+    input_tensor = tf.constant(np.random.normal(size=[2, 5, 12]),
+                               dtype=tf.float32)
+    mask = tf.constant([[1] * 5, [1] * 3 + [0] * 2])
+    outputs = []
+    for use_einsum in [True, False]:
+      with tf.variable_scope("attention", reuse=tf.AUTO_REUSE):
+        # The same tensor as `from_tensor` and `to_tensor` takes the fused
+        # path, a copy of it the separate dense layers.
+        outputs.append(modeling.attention_layer(
+            input_tensor, input_tensor, mask, num_attention_heads=3,
+            use_einsum=use_einsum))
+        outputs.append(modeling.attention_layer(
+            input_tensor, tf.identity(input_tensor), mask,
+            num_attention_heads=3, use_einsum=use_einsum))
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      outputs = sess.run(outputs)
+    for output in outputs[1:]:
+      self.assertAllClose(outputs[0], output, atol=1e-5)
+
+  def test_layer_loop(self):
+    config = modeling.AlbertConfig(
+        vocab_size=99, embedding_size=8, hidden_size=16, num_hidden_layers=3,
+        num_attention_heads=2, intermediate_size=24, inner_group_num=2)
+    input_ids = AlbertModelTest.ids_tensor([2, 5], 99)
+    input_mask = tf.constant([[1] * 5, [1] * 3 + [0] * 2])
+    model = modeling.AlbertModel(
+        config=config, is_training=False, input_ids=input_ids,
+        input_mask=input_mask, scope="bert")
+    config.use_layer_loop = True
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      loop_model = modeling.AlbertModel(
+          config=config, is_training=False, input_ids=input_ids,
+          input_mask=input_mask, scope="bert")
+    self.assertLen(loop_model.get_all_encoder_layers(), 6)
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      layers, loop_layers = sess.run(
+          [model.get_all_encoder_layers(),
+           loop_model.get_all_encoder_layers()])
+    self.assertAllClose(layers, loop_layers, atol=1e-5)
+
+  def test_layer_loop_creates_variables(self):
+    config = modeling.AlbertConfig(
+        vocab_size=99, embedding_size=8, hidden_size=16, num_hidden_layers=3,
+        num_attention_heads=2, intermediate_size=24, use_layer_loop=True)
+    input_ids = AlbertModelTest.ids_tensor([2, 5], 99)
+    input_mask = tf.constant([[1] * 5, [1] * 3 + [0] * 2])
+    loop_model = modeling.AlbertModel(
+        config=config, is_training=True, input_ids=input_ids,
+        input_mask=input_mask, scope="bert")
+    # The loop model creates the variables and holds a single copy of the
+    # layer.
+    self.assertLen([
+        op for op in tf.get_default_graph().get_operations()
+        if op.name.endswith("attention_probs")
+    ], 1)
+    config.use_layer_loop = False
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      model = modeling.AlbertModel(
+          config=config, is_training=True, input_ids=input_ids,
+          input_mask=input_mask, scope="bert")
+    # The pooler is not part of the loss.
+    tvars = [
+        var for var in tf.trainable_variables() if "pooler" not in var.name
+    ]
+    grads = tf.gradients(
+        tf.reduce_sum(tf.square(model.get_sequence_output())), tvars)
+    loop_grads = tf.gradients(
+        tf.reduce_sum(tf.square(loop_model.get_sequence_output())), tvars)
+    grads = [tf.convert_to_tensor(grad) for grad in grads]
+    loop_grads = [tf.convert_to_tensor(grad) for grad in loop_grads]
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      grads, loop_grads = sess.run([grads, loop_grads])
+    for (grad, loop_grad) in zip(grads, loop_grads):
+      self.assertAllClose(grad, loop_grad, atol=1e-5)
+
+  def test_remove_padding(self):
+    config = modeling.AlbertConfig(
+        vocab_size=99, embedding_size=8, hidden_size=16, num_hidden_layers=2,
+        num_attention_heads=2, intermediate_size=24)
+    input_ids = AlbertModelTest.ids_tensor([2, 5], 99)
+    input_mask = tf.constant([[1] * 5, [1] * 3 + [0] * 2])
+    model = modeling.AlbertModel(
+        config=config, is_training=False, input_ids=input_ids,
+        input_mask=input_mask, scope="bert")
+    config.remove_padding = True
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      packed_model = modeling.AlbertModel(
+          config=config, is_training=False, input_ids=input_ids,
+          input_mask=input_mask, scope="bert")
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      output, packed_output, pooled, packed_pooled = sess.run(
+          [model.get_sequence_output(), packed_model.get_sequence_output(),
+           model.get_pooled_output(), packed_model.get_pooled_output()])
+    self.assertAllClose(output[0], packed_output[0], atol=1e-5)
+    self.assertAllClose(output[1, :3], packed_output[1, :3], atol=1e-5)
+    self.assertAllEqual(packed_output[1, 3:], np.zeros([2, 16]))
+    self.assertAllClose(pooled, packed_pooled, atol=1e-5)
+
+  def _assert_compute_dtype(self, compute_dtype, atol):
+    config = modeling.AlbertConfig(
+        vocab_size=99, embedding_size=8, hidden_size=16, num_hidden_layers=2,
+        num_attention_heads=2, intermediate_size=24)
+    input_ids = AlbertModelTest.ids_tensor([2, 5], 99)
+    input_mask = tf.constant([[1] * 5, [1] * 3 + [0] * 2])
+    model = modeling.AlbertModel(
+        config=config, is_training=False, input_ids=input_ids,
+        input_mask=input_mask, scope="bert")
+    config.compute_dtype = compute_dtype
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      half_model = modeling.AlbertModel(
+          config=config, is_training=False, input_ids=input_ids,
+          input_mask=input_mask, scope="bert")
+    self.assertEqual(half_model.get_sequence_output().dtype, tf.float32)
+    for var in tf.global_variables():
+      self.assertEqual(var.dtype.base_dtype, tf.float32)
+
+    # The matmuls run in `compute_dtype`, the softmax and the layer
+    # normalization in float32.
+    half_ops = [
+        op for op in tf.get_default_graph().get_operations()
+        if op.name.startswith("bert_1/encoder/")
+    ]
+    op_dtypes = collections.defaultdict(set)
+    for op in half_ops:
+      if op.outputs:
+        op_dtypes[op.type].add(op.outputs[0].dtype)
+    self.assertEqual(op_dtypes["Softmax"], {tf.float32})
+    self.assertEqual(op_dtypes["Mean"], {tf.float32})
+    self.assertEqual(op_dtypes["Tanh"], {tf.as_dtype(compute_dtype)})
+    self.assertIn(
+        tf.as_dtype(compute_dtype),
+        op_dtypes["BatchMatMul"] | op_dtypes["BatchMatMulV2"] |
+        op_dtypes["Einsum"])
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      output, half_output = sess.run(
+          [model.get_sequence_output(), half_model.get_sequence_output()])
+    self.assertAllClose(output, half_output, atol=atol)
+
+  def test_compute_dtype(self):
+    self._assert_compute_dtype("float16", atol=1e-2)
+
+  def test_compute_dtype_bfloat16(self):
+    self._assert_compute_dtype("bfloat16", atol=1e-1)
+
+  def test_gelu_bfloat16(self):
+    x = np.linspace(-4.0, 4.0, 17).astype(np.float32)
+    output = modeling.gelu(tf.constant(x))
+    bfloat16_output = modeling.gelu(tf.constant(x, dtype=tf.bfloat16))
+    self.assertEqual(bfloat16_output.dtype, tf.bfloat16)
+
+    with self.test_session() as sess:
+      output, bfloat16_output = sess.run(
+          [output, tf.cast(bfloat16_output, tf.float32)])
+    self.assertAllClose(output, bfloat16_output, atol=5e-2)
+
+  def test_int8_variable_getter(self):
+    weights = np.random.randn(4, 3).astype(np.float32)
+    quantized, scale = modeling.quantize_int8(weights, 0)
+    self.assertEqual(quantized.dtype, np.int8)
+    self.assertEqual(scale.shape, (1, 3))
+    self.assertAllClose(quantized * scale, weights, atol=np.max(scale))
+
+    with tf.variable_scope("bert",
+                           custom_getter=modeling.int8_variable_getter):
+      kernel = tf.get_variable("dense/kernel", shape=[4, 3])
+      tf.get_variable("dense/bias", shape=[3])
+    variables = {var.op.name: var for var in tf.global_variables()}
+    self.assertCountEqual(
+        variables.keys(),
+        ["bert/dense/kernel_int8", "bert/dense/kernel_scale",
+         "bert/dense/bias"])
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      variables["bert/dense/kernel_int8"].load(quantized, sess)
+      variables["bert/dense/kernel_scale"].load(scale, sess)
+      self.assertAllClose(sess.run(kernel), quantized * scale)
+
+  def _assert_recompute_layers_gradients(self, atol, **kwargs):
+    config = modeling.AlbertConfig(
+        vocab_size=99, embedding_size=8, hidden_size=16, num_hidden_layers=3,
+        num_attention_heads=2, intermediate_size=24, **kwargs)
+    input_ids = AlbertModelTest.ids_tensor([2, 5], 99)
+    input_mask = tf.constant([[1] * 5, [1] * 3 + [0] * 2])
+    model = modeling.AlbertModel(
+        config=config, is_training=True, input_ids=input_ids,
+        input_mask=input_mask, scope="bert")
+    config.recompute_layers = 2
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      recompute_model = modeling.AlbertModel(
+          config=config, is_training=True, input_ids=input_ids,
+          input_mask=input_mask, scope="bert")
+    # The pooler is not part of the loss.
+    tvars = [
+        var for var in tf.trainable_variables() if "pooler" not in var.name
+    ]
+    grads = tf.gradients(
+        tf.reduce_sum(tf.square(model.get_sequence_output())), tvars)
+    recompute_grads = tf.gradients(
+        tf.reduce_sum(tf.square(recompute_model.get_sequence_output())), tvars)
+    grads = [tf.convert_to_tensor(grad) for grad in grads]
+    recompute_grads = [tf.convert_to_tensor(grad) for grad in recompute_grads]
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      grads, recompute_grads = sess.run([grads, recompute_grads])
+    for (grad, recompute_grad) in zip(grads, recompute_grads):
+      self.assertAllClose(grad, recompute_grad, atol=atol)
+
+  def test_recompute_layers(self):
+    self._assert_recompute_layers_gradients(atol=1e-5, num_hidden_groups=3)
+
+  def test_recompute_layers_shared(self):
+    self._assert_recompute_layers_gradients(atol=1e-5, num_hidden_groups=1)
+
+  def test_recompute_layers_compute_dtype(self):
+    self._assert_recompute_layers_gradients(
+        atol=1e-2, num_hidden_groups=1, compute_dtype="float16")
+
+  def test_early_exit(self):
+    config = modeling.AlbertConfig(
+        vocab_size=99, embedding_size=8, hidden_size=16, num_hidden_layers=3,
+        num_attention_heads=2, intermediate_size=24)
+    input_ids = AlbertModelTest.ids_tensor([4, 5], 99)
+    input_mask = tf.constant([[1] * 5, [1] * 3 + [0] * 2] * 2)
+    model = modeling.AlbertModel(
+        config=config, is_training=False, input_ids=input_ids,
+        input_mask=input_mask, scope="bert")
+
+    def never_exit(pooled_output):
+      return pooled_output, tf.zeros([tf.shape(pooled_output)[0]], tf.bool)
+
+    def always_exit(pooled_output):
+      return pooled_output, tf.ones([tf.shape(pooled_output)[0]], tf.bool)
+
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+      never_model = modeling.AlbertModel(
+          config=config, is_training=False, input_ids=input_ids,
+          input_mask=input_mask, scope="bert", exit_fn=never_exit)
+      always_model = modeling.AlbertModel(
+          config=config, is_training=False, input_ids=input_ids,
+          input_mask=input_mask, scope="bert", exit_fn=always_exit)
+      config.num_hidden_layers = 1
+      one_layer_model = modeling.AlbertModel(
+          config=config, is_training=False, input_ids=input_ids,
+          input_mask=input_mask, scope="bert")
+
+    with self.test_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      result = sess.run({
+          "pooled": model.get_pooled_output(),
+          "one_layer_pooled": one_layer_model.get_pooled_output(),
+          "never": never_model.get_exit_outputs(),
+          "never_layers": never_model.get_exit_layers(),
+          "always": always_model.get_exit_outputs(),
+          "always_layers": always_model.get_exit_layers(),
+      })
+    self.assertAllClose(result["pooled"], result["never"], atol=1e-5)
+    self.assertAllEqual(result["never_layers"], [3] * 4)
+    self.assertAllClose(result["one_layer_pooled"], result["always"],
+                        atol=1e-5)
+    self.assertAllEqual(result["always_layers"], [1] * 4)
+
   def run_tester(self, tester):
     with self.test_session() as sess:
       ops = tester.create_model()
@@ -28,8 +28,15 @@ from tensorflow.contrib import tpu as contrib_tpu
 
 def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu,
                      optimizer="adamw", poly_power=1.0, start_warmup_step=0,
-                     colocate_gradients_with_ops=False):
-  """Creates an optimizer training op."""
+                     colocate_gradients_with_ops=False, loss_scale=None):
+  """Creates an optimizer training op.
+
+  A `loss_scale`, a number or "dynamic", multiplies the loss before the
+  gradients are computed so that small float16 gradients do not underflow.
+  The gradients are unscaled before they are clipped, and the steps with
+  non-finite gradients are skipped; "dynamic" halves the scale on such steps
+  and grows it again after a run of finite ones.
+  """
   global_step = tf.train.get_or_create_global_step()
 
   learning_rate = tf.constant(value=init_lr, shape=[], dtype=tf.float32)
@@ -96,8 +103,18 @@ def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu,
     optimizer = contrib_tpu.CrossShardOptimizer(optimizer)
 
   tvars = tf.trainable_variables()
-  grads = tf.gradients(
-      loss, tvars, colocate_gradients_with_ops=colocate_gradients_with_ops)
+  if loss_scale is not None:
+    if loss_scale != "dynamic":
+      loss_scale = float(loss_scale)
+    tf.logging.info("using loss scale %s", loss_scale)
+    optimizer = tf.train.experimental.MixedPrecisionLossScaleOptimizer(
+        optimizer, loss_scale)
+    grads_and_vars = optimizer.compute_gradients(
+        loss, tvars, colocate_gradients_with_ops=colocate_gradients_with_ops)
+    grads = [grad for (grad, _) in grads_and_vars]
+  else:
+    grads = tf.gradients(
+        loss, tvars, colocate_gradients_with_ops=colocate_gradients_with_ops)
 
   # This is how the model was pre-trained.
   (grads, _) = tf.clip_by_global_norm(grads, clip_norm=1.0)
@@ -45,6 +45,25 @@ class OptimizationTest(tf.test.TestCase):
       w_np = sess.run(w)
       self.assertAllClose(w_np.flat, [0.4, 0.2, -0.5], rtol=1e-2, atol=1e-2)
 
+  def test_loss_scale_skips_non_finite_steps(self):
+    with self.test_session() as sess:
+      w = tf.get_variable(
+          "w",
+          shape=[3],
+          initializer=tf.constant_initializer([0.1, -0.2, -0.1]))
+      x = tf.placeholder(tf.float32, shape=[3])
+      loss = tf.reduce_mean(tf.square(x - w))
+      train_op = optimization.create_optimizer(
+          loss, init_lr=0.2, num_train_steps=10, num_warmup_steps=0,
+          use_tpu=False, loss_scale="dynamic")
+      init_op = tf.group(tf.global_variables_initializer(),
+                         tf.local_variables_initializer())
+      sess.run(init_op)
+      sess.run(train_op, feed_dict={x: [float("inf"), 0.2, -0.5]})
+      self.assertAllClose(sess.run(w), [0.1, -0.2, -0.1])
+      sess.run(train_op, feed_dict={x: [0.4, 0.2, -0.5]})
+      self.assertNotAllClose(sess.run(w), [0.1, -0.2, -0.1])
+
 
 if __name__ == "__main__":
   tf.test.main()
@@ -0,0 +1,96 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Lint as: python2, python3
+r"""Quantizes the weights of an ALBERT checkpoint to int8 for CPU inference.
+
+The dense kernels and the word embeddings of the model are written as int8
+variables with float32 per-channel scales, and all the other model variables
+are copied. The optimizer slots (`adam_m`, `adam_v`, `lamb_m` and `lamb_v`)
+are dropped since the result is only meant for inference. Models read it with
+`"quantize_weights": true` in the `albert_config_file` JSON; pass
+`run_classifier.py --quantized_checkpoint` instead to compare its accuracy
+and latency with the float model.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from absl import app
+from absl import flags
+from albert import modeling
+import tensorflow.compat.v1 as tf
+
+flags.DEFINE_string("input_checkpoint", None,
+                    "The float checkpoint to quantize, e.g. a fine-tuned "
+                    "model.ckpt-best.")
+
+flags.DEFINE_string("output_checkpoint", None,
+                    "The path of the quantized checkpoint.")
+
+flags.DEFINE_string("scope", "bert",
+                    "The variable scope of the `AlbertModel`. Only its "
+                    "weights are quantized.")
+
+FLAGS = flags.FLAGS
+
+_OPTIMIZER_SLOTS = ("adam_m", "adam_v", "lamb_m", "lamb_v")
+
+
+def quantize_checkpoint(input_checkpoint, output_checkpoint, scope="bert"):
+  """Writes the int8 version of `input_checkpoint` to `output_checkpoint`."""
+  reader = tf.train.load_checkpoint(input_checkpoint)
+  values = {}
+  input_bytes = 0
+  for (name, shape) in tf.train.list_variables(input_checkpoint):
+    value = reader.get_tensor(name)
+    input_bytes += value.nbytes
+    if name.split("/")[-1] in _OPTIMIZER_SLOTS:
+      continue
+    axis = None
+    if name.startswith(scope + "/"):
+      axis = modeling.get_quantization_axis(name, shape)
+    if axis is None:
+      values[name] = value
+    else:
+      (values[name + "_int8"],
+       values[name + "_scale"]) = modeling.quantize_int8(value, axis)
+  output_bytes = sum(value.nbytes for value in values.values())
+  tf.logging.info("Quantized %s: %d bytes -> %d bytes", input_checkpoint,
+                  input_bytes, output_bytes)
+
+  with tf.Graph().as_default():
+    variables = {}
+    for (name, value) in sorted(values.items()):
+      variables[name] = tf.get_variable(
+          name, shape=value.shape, dtype=tf.as_dtype(value.dtype),
+          trainable=False)
+    saver = tf.train.Saver(variables)
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      for (name, variable) in variables.items():
+        variable.load(values[name], sess)
+      saver.save(sess, output_checkpoint, write_meta_graph=False)
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  quantize_checkpoint(FLAGS.input_checkpoint, FLAGS.output_checkpoint,
+                      FLAGS.scope)
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("input_checkpoint")
+  flags.mark_flag_as_required("output_checkpoint")
+  app.run(main)
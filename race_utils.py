@@ -20,13 +20,16 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import itertools
 import json
+import multiprocessing
 import os
 from albert import classifier_utils
 from albert import fine_tuning_utils
 from albert import modeling
 from albert import optimization
 from albert import tokenization
+import numpy as np
 import tensorflow.compat.v1 as tf
 from tensorflow.contrib import tpu as contrib_tpu
 
@@ -91,6 +94,10 @@ class RaceProcessor(object):
     return self.read_examples(
         os.path.join(data_dir, "RACE", "test"))
 
+  def iter_train_examples(self, data_dir):
+    """Yields the `InputExample`s of the train set, see `iter_examples`."""
+    return self.iter_examples(os.path.join(data_dir, "RACE", "train"))
+
   def get_labels(self):
     """Gets the list of labels for this data set."""
     return ["A", "B", "C", "D"]
@@ -103,7 +110,16 @@ class RaceProcessor(object):
 
   def read_examples(self, data_dir):
     """Read examples from RACE json files."""
-    examples = []
+    return list(self.iter_examples(data_dir))
+
+  def iter_examples(self, data_dir):
+    """Yields the examples of the RACE json files, one article at a time.
+
+    Each line of the files holds an article, which is only parsed when its
+    examples are reached. The parallel conversion of
+    `file_based_convert_examples_to_features` hands chunks of this stream to
+    its workers, so the records keep the order of the files.
+    """
     for level in ["middle", "high"]:
       if level == "middle" and self.high_only: continue
       if level == "high" and self.middle_only: continue
@@ -134,22 +150,35 @@ class RaceProcessor(object):
 
               qa_list.append(qa_cat)
 
-            examples.append(
-                InputExample(
-                    example_id=cur_data["id"],
-                    context_sentence=context,
-                    start_ending=None,
-                    endings=[qa_list[0], qa_list[1], qa_list[2], qa_list[3]],
-                    label=label
-                )
+            yield InputExample(
+                example_id=cur_data["id"],
+                context_sentence=context,
+                start_ending=None,
+                endings=[qa_list[0], qa_list[1], qa_list[2], qa_list[3]],
+                label=label
             )
 
-    return examples
+
+def _tokenize_context(tokenizer, context, context_cache):
+  """Tokenizes an article, reusing the tokens of the previous question."""
+  if context_cache is None:
+    return tokenizer.tokenize(context)
+  # The questions of an article are consecutive, so only the tokens of the
+  # last article are kept.
+  if context not in context_cache:
+    context_cache.clear()
+    context_cache[context] = tokenizer.tokenize(context)
+  return context_cache[context]
 
 
 def convert_single_example(example_index, example, label_size, max_seq_length,
-                           tokenizer, max_qa_length):
-  """Loads a data file into a list of `InputBatch`s."""
+                           tokenizer, max_qa_length, context_cache=None):
+  """Loads a data file into a list of `InputBatch`s.
+
+  The features hold [label_size, max_seq_length] int32 arrays. If a
+  `context_cache` dict is given, the article tokens are shared with the
+  previous example when both are questions on the same article.
+  """
 
   # RACE is a multiple choice task. To perform this task using AlBERT,
   # we will use the formatting proposed in "Improving Language
@@ -170,21 +199,23 @@ def convert_single_example(example_index, example, label_size, max_seq_length,
   if isinstance(example, classifier_utils.PaddingInputExample):
     return classifier_utils.InputFeatures(
         example_id=0,
-        input_ids=[[0] * max_seq_length] * label_size,
-        input_mask=[[0] * max_seq_length] * label_size,
-        segment_ids=[[0] * max_seq_length] * label_size,
+        input_ids=np.zeros([label_size, max_seq_length], dtype=np.int32),
+        input_mask=np.zeros([label_size, max_seq_length], dtype=np.int32),
+        segment_ids=np.zeros([label_size, max_seq_length], dtype=np.int32),
         label_id=0,
         is_real_example=False)
   else:
-    context_tokens = tokenizer.tokenize(example.context_sentence)
+    context_tokens = _tokenize_context(
+        tokenizer, example.context_sentence, context_cache)
     if example.start_ending is not None:
       start_ending_tokens = tokenizer.tokenize(example.start_ending)
 
     all_input_tokens = []
-    all_input_ids = []
-    all_input_mask = []
-    all_segment_ids = []
-    for ending in example.endings:
+    all_input_ids = np.zeros(
+        [len(example.endings), max_seq_length], dtype=np.int32)
+    all_input_mask = np.zeros_like(all_input_ids)
+    all_segment_ids = np.zeros_like(all_input_ids)
+    for (choice_idx, ending) in enumerate(example.endings):
       # We create a copy of the context tokens in order to be
       # able to shrink it according to ending_tokens
       context_tokens_choice = context_tokens[:]
@@ -203,26 +234,16 @@ def convert_single_example(example_index, example, label_size, max_seq_length,
             max_seq_length - 3 - len(ending_tokens))]
       tokens = ["[CLS]"] + context_tokens_choice + (
           ["[SEP]"] + ending_tokens + ["[SEP]"])
-      segment_ids = [0] * (len(context_tokens_choice) + 2) + [1] * (
-          len(ending_tokens) + 1)
-
-      input_ids = tokenizer.convert_tokens_to_ids(tokens)
-      input_mask = [1] * len(input_ids)
+      assert len(tokens) <= max_seq_length
 
-      # Zero-pad up to the sequence length.
-      padding = [0] * (max_seq_length - len(input_ids))
-      input_ids += padding
-      input_mask += padding
-      segment_ids += padding
-
-      assert len(input_ids) == max_seq_length
-      assert len(input_mask) == max_seq_length
-      assert len(segment_ids) == max_seq_length
+      # The rows are zero-padded up to the sequence length.
+      all_input_ids[choice_idx, :len(tokens)] = (
+          tokenizer.convert_tokens_to_ids(tokens))
+      all_input_mask[choice_idx, :len(tokens)] = 1
+      all_segment_ids[choice_idx,
+                      len(context_tokens_choice) + 2:len(tokens)] = 1
 
       all_input_tokens.append(tokens)
-      all_input_ids.append(input_ids)
-      all_input_mask.append(input_mask)
-      all_segment_ids.append(segment_ids)
 
     label = example.label
     if example_index < 5:
@@ -249,58 +270,313 @@ def convert_single_example(example_index, example, label_size, max_seq_length,
     )
 
 
-def file_based_convert_examples_to_features(
-    examples, label_list, max_seq_length, tokenizer,
-    output_file, max_qa_length):
-  """Convert a set of `InputExample`s to a TFRecord file."""
+def get_shared_context_lengths(max_seq_length, max_qa_length):
+  """Returns the context and choice lengths of the shared-context layout.
+
+  In this layout an example is a single sequence
+    [CLS] context [SEP] ([CLS] choice_i [SEP])*
+  where the context part is padded to the first returned length and each
+  choice to the second one, so that a choice ends at `max_seq_length` at most
+  when placed right after the (unpadded) context.
+  """
+  choice_length = max_qa_length + 2
+  return max_seq_length - choice_length, choice_length
+
+
+def convert_single_example_shared_context(example_index, example, label_size,
+                                          max_seq_length, tokenizer,
+                                          max_qa_length, context_cache=None):
+  """Converts an example to the shared-context layout.
+
+  The features hold [context_length + label_size * choice_length] int32
+  arrays, see `get_shared_context_lengths`. The choices have their own
+  segment (1), the padding is masked out.
+  """
+  context_length, choice_length = get_shared_context_lengths(
+      max_seq_length, max_qa_length)
+  seq_length = context_length + label_size * choice_length
+  input_ids = np.zeros([seq_length], dtype=np.int32)
+  input_mask = np.zeros_like(input_ids)
+  segment_ids = np.zeros_like(input_ids)
+  if isinstance(example, classifier_utils.PaddingInputExample):
+    return classifier_utils.InputFeatures(
+        example_id=0,
+        input_ids=input_ids,
+        input_mask=input_mask,
+        segment_ids=segment_ids,
+        label_id=0,
+        is_real_example=False)
 
-  writer = tf.python_io.TFRecordWriter(output_file)
+  context_tokens = _tokenize_context(
+      tokenizer, example.context_sentence, context_cache)
+  tokens = ["[CLS]"] + context_tokens[:context_length - 2] + ["[SEP]"]
+  input_ids[:len(tokens)] = tokenizer.convert_tokens_to_ids(tokens)
+  input_mask[:len(tokens)] = 1
+  all_tokens = [tokens]
 
-  for (ex_index, example) in enumerate(examples):
-    if ex_index % 10000 == 0:
-      tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
+  if example.start_ending is not None:
+    start_ending_tokens = tokenizer.tokenize(example.start_ending)
+  for (choice_idx, ending) in enumerate(example.endings):
+    if example.start_ending is not None:
+      ending_tokens = start_ending_tokens + tokenizer.tokenize(ending)
+    else:
+      ending_tokens = tokenizer.tokenize(ending)
+    tokens = ["[CLS]"] + ending_tokens[- max_qa_length:] + ["[SEP]"]
+    start = context_length + choice_idx * choice_length
+    input_ids[start:start + len(tokens)] = (
+        tokenizer.convert_tokens_to_ids(tokens))
+    input_mask[start:start + len(tokens)] = 1
+    segment_ids[start:start + choice_length] = 1
+    all_tokens.append(tokens)
+
+  if example_index < 5:
+    tf.logging.info("*** Example ***")
+    tf.logging.info("id: {}".format(example.example_id))
+    tf.logging.info("tokens: {}".format(
+        " | ".join(" ".join(tokens) for tokens in all_tokens)))
+    tf.logging.info("input_ids: {}".format(" ".join(map(str, input_ids))))
+    tf.logging.info("input_mask: {}".format(" ".join(map(str, input_mask))))
+    tf.logging.info("segment_ids: {}".format(" ".join(map(str, segment_ids))))
+    tf.logging.info("label: {}".format(example.label))
+
+  return classifier_utils.InputFeatures(
+      example_id=example.example_id,
+      input_ids=input_ids,
+      input_mask=input_mask,
+      segment_ids=segment_ids,
+      label_id=example.label)
 
-    feature = convert_single_example(ex_index, example, len(label_list),
-                                     max_seq_length, tokenizer, max_qa_length)
 
-    def create_int_feature(values):
-      f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
-      return f
+def _serialize_feature(feature):
+  """Serializes the features of an example to a tf.train.Example string."""
 
-    features = collections.OrderedDict()
-    features["input_ids"] = create_int_feature(sum(feature.input_ids, []))
-    features["input_mask"] = create_int_feature(sum(feature.input_mask, []))
-    features["segment_ids"] = create_int_feature(sum(feature.segment_ids, []))
-    features["label_ids"] = create_int_feature([feature.label_id])
-    features["is_real_example"] = create_int_feature(
-        [int(feature.is_real_example)])
+  def create_int_feature(values):
+    f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+    return f
 
-    tf_example = tf.train.Example(features=tf.train.Features(feature=features))
-    writer.write(tf_example.SerializeToString())
-  writer.close()
+  features = collections.OrderedDict()
+  features["input_ids"] = create_int_feature(
+      np.ravel(feature.input_ids).tolist())
+  features["input_mask"] = create_int_feature(
+      np.ravel(feature.input_mask).tolist())
+  features["segment_ids"] = create_int_feature(
+      np.ravel(feature.segment_ids).tolist())
+  features["label_ids"] = create_int_feature([feature.label_id])
+  features["is_real_example"] = create_int_feature(
+      [int(feature.is_real_example)])
 
+  tf_example = tf.train.Example(features=tf.train.Features(feature=features))
+  return tf_example.SerializeToString()
+
+
+# The tokenizer of the conversion workers. It is inherited from the parent
+# process when the workers are forked, as it may not be picklable, so the
+# workers must use the fork start method (see `_create_fork_pool`).
+_worker_tokenizer = None
+
+# Number of consecutive examples converted by a worker at a time. Questions
+# on the same article stay together, so their article tokens are shared.
+_CHUNK_SIZE = 256
 
-def create_model(albert_config, is_training, input_ids, input_mask, segment_ids,
-                 labels, num_labels, use_one_hot_embeddings, max_seq_length,
-                 dropout_prob, hub_module):
-  """Creates a classification model."""
-  bsz_per_core = tf.shape(input_ids)[0]
 
-  input_ids = tf.reshape(input_ids, [bsz_per_core * num_labels, max_seq_length])
-  input_mask = tf.reshape(input_mask,
-                          [bsz_per_core * num_labels, max_seq_length])
-  token_type_ids = tf.reshape(segment_ids,
-                              [bsz_per_core * num_labels, max_seq_length])
+def _convert_examples_chunk(args):
+  """Converts a chunk of examples to serialized tf.train.Example strings."""
+  (start_index, examples, label_size, max_seq_length, max_qa_length,
+   shared_context) = args
+  if shared_context:
+    convert_fn = convert_single_example_shared_context
+  else:
+    convert_fn = convert_single_example
+  context_cache = {}
+  return [
+      _serialize_feature(convert_fn(
+          start_index + i, example, label_size, max_seq_length,
+          _worker_tokenizer, max_qa_length, context_cache=context_cache))
+      for (i, example) in enumerate(examples)
+  ]
+
+
+def _iter_chunks(examples, label_size, max_seq_length, max_qa_length,
+                 shared_context):
+  """Yields the arguments of `_convert_examples_chunk` for `examples`."""
+  examples = iter(examples)
+  start = 0
+  while True:
+    chunk = list(itertools.islice(examples, _CHUNK_SIZE))
+    if not chunk:
+      return
+    yield (start, chunk, label_size, max_seq_length, max_qa_length,
+           shared_context)
+    start += len(chunk)
+
+
+def _create_fork_pool(num_workers):
+  """Returns a pool of forked processes, or None if they are not available.
+
+  The workers read `_worker_tokenizer`, which only forked processes inherit:
+  with the spawn start method (the default on macOS and Windows) it would be
+  None in the workers.
+  """
+  if not hasattr(multiprocessing, "get_context"):
+    # Python 2 always forks.
+    return multiprocessing.Pool(num_workers)
+  if "fork" not in multiprocessing.get_all_start_methods():
+    return None
+  return multiprocessing.get_context("fork").Pool(num_workers)
+
+
+def file_based_convert_examples_to_features(
+    examples, label_list, max_seq_length, tokenizer,
+    output_file, max_qa_length, num_workers=1, shared_context=False):
+  """Convert a set of `InputExample`s to a TFRecord file.
+
+  `examples` can be any iterable, e.g. `RaceProcessor.iter_examples`; it is
+  consumed lazily, so only the chunks being converted are held in memory.
+  With `num_workers` > 1 the examples are converted by a pool of forked
+  processes, in chunks of consecutive examples; the records are written in
+  the order of `examples`. Platforms without fork convert them in the
+  current process. With `shared_context` the examples are converted
+  to the layout of `convert_single_example_shared_context`.
+
+  Returns:
+    The number of examples written.
+  """
+  global _worker_tokenizer
 
-  (output_layer, _) = fine_tuning_utils.create_albert(
-      albert_config=albert_config,
+  writer = tf.python_io.TFRecordWriter(output_file)
+  chunks = _iter_chunks(examples, len(label_list), max_seq_length,
+                        max_qa_length, shared_context)
+  num_examples = [0]
+
+  def write_chunk(serialized_examples):
+    if num_examples[0] % 10000 < _CHUNK_SIZE:
+      tf.logging.info("Writing example %d" % num_examples[0])
+    for serialized_example in serialized_examples:
+      writer.write(serialized_example)
+    num_examples[0] += len(serialized_examples)
+
+  _worker_tokenizer = tokenizer
+  pool = None
+  try:
+    if num_workers > 1:
+      pool = _create_fork_pool(num_workers)
+      if pool is None:
+        tf.logging.warning("Processes cannot be forked on this platform, "
+                           "converting the examples in a single process.")
+    if pool is not None:
+      # Reading goes on while the workers convert, with a bounded number of
+      # chunks in flight.
+      pending = collections.deque()
+      for chunk in chunks:
+        pending.append(pool.apply_async(_convert_examples_chunk, (chunk,)))
+        if len(pending) > 2 * num_workers:
+          write_chunk(pending.popleft().get())
+      while pending:
+        write_chunk(pending.popleft().get())
+    else:
+      for chunk in chunks:
+        write_chunk(_convert_examples_chunk(chunk))
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+    _worker_tokenizer = None
+  writer.close()
+  return num_examples[0]
+
+
+def _create_shared_context_albert(albert_config, is_training, input_ids,
+                                  input_mask, segment_ids, num_labels,
+                                  use_one_hot_embeddings, max_seq_length,
+                                  max_qa_length):
+  """Encodes examples in the shared-context layout.
+
+  The context is encoded once: its tokens only attend to the context, while
+  the tokens of a choice attend to the context and to that choice. Each
+  choice is positioned right after the context, as if it were encoded with
+  it alone. Returns the pooled [CLS] outputs of the choices, of shape
+  [batch_size * num_labels, hidden_size].
+  """
+  context_length, choice_length = get_shared_context_lengths(
+      max_seq_length, max_qa_length)
+  # 0 for the context, i + 1 for the i-th choice.
+  block_ids = np.repeat(np.arange(num_labels + 1),
+                        [context_length] + [choice_length] * num_labels)
+  block_mask = ((block_ids[None, :] == 0) |
+                (block_ids[None, :] == block_ids[:, None]))
+  attention_mask = (tf.constant(block_mask, dtype=tf.int32)[None] *
+                    input_mask[:, None, :])
+
+  offsets = np.concatenate(
+      [np.arange(context_length)] +
+      [np.arange(choice_length)] * num_labels)
+  context_lengths = tf.reduce_sum(input_mask[:, :context_length], axis=-1)
+  position_ids = (tf.constant(offsets, dtype=tf.int32)[None] +
+                  tf.constant(block_ids > 0, dtype=tf.int32)[None] *
+                  context_lengths[:, None])
+
+  model = modeling.AlbertModel(
+      config=albert_config,
       is_training=is_training,
       input_ids=input_ids,
       input_mask=input_mask,
-      segment_ids=token_type_ids,
+      token_type_ids=segment_ids,
       use_one_hot_embeddings=use_one_hot_embeddings,
-      use_einsum=True,
-      hub_module=hub_module)
+      position_ids=position_ids,
+      attention_mask=attention_mask)
+
+  # The [CLS] token of each choice goes through the pooler of the model.
+  choice_output = tf.gather(
+      model.get_sequence_output(),
+      context_length + choice_length * np.arange(num_labels), axis=1)
+  hidden_size = albert_config.hidden_size
+  with tf.variable_scope("bert/pooler", reuse=True):
+    pooled_output = tf.layers.dense(
+        tf.reshape(choice_output, [-1, hidden_size]),
+        hidden_size,
+        activation=tf.tanh,
+        kernel_initializer=modeling.create_initializer(
+            albert_config.initializer_range),
+        name="dense")
+  return pooled_output
+
+
+def create_model(albert_config, is_training, input_ids, input_mask, segment_ids,
+                 labels, num_labels, use_one_hot_embeddings, max_seq_length,
+                 dropout_prob, hub_module, shared_context=False,
+                 max_qa_length=None):
+  """Creates a classification model.
+
+  With `shared_context` the inputs are in the layout of
+  `convert_single_example_shared_context` and the context is only encoded
+  once for all the choices.
+  """
+  bsz_per_core = tf.shape(input_ids)[0]
+
+  if shared_context:
+    if hub_module:
+      raise ValueError("The shared-context encoding does not support "
+                       "TF-Hub modules.")
+    output_layer = _create_shared_context_albert(
+        albert_config, is_training, input_ids, input_mask, segment_ids,
+        num_labels, use_one_hot_embeddings, max_seq_length, max_qa_length)
+  else:
+    input_ids = tf.reshape(input_ids,
+                           [bsz_per_core * num_labels, max_seq_length])
+    input_mask = tf.reshape(input_mask,
+                            [bsz_per_core * num_labels, max_seq_length])
+    token_type_ids = tf.reshape(segment_ids,
+                                [bsz_per_core * num_labels, max_seq_length])
+
+    (output_layer, _) = fine_tuning_utils.create_albert(
+        albert_config=albert_config,
+        is_training=is_training,
+        input_ids=input_ids,
+        input_mask=input_mask,
+        segment_ids=token_type_ids,
+        use_one_hot_embeddings=use_one_hot_embeddings,
+        use_einsum=True,
+        hub_module=hub_module)
 
   hidden_size = output_layer.shape[-1].value
 
@@ -337,7 +613,7 @@ def create_model(albert_config, is_training, input_ids, input_mask, segment_ids,
 def model_fn_builder(albert_config, num_labels, init_checkpoint, learning_rate,
                      num_train_steps, num_warmup_steps, use_tpu,
                      use_one_hot_embeddings, max_seq_length, dropout_prob,
-                     hub_module):
+                     hub_module, shared_context=False, max_qa_length=None):
   """Returns `model_fn` closure for TPUEstimator."""
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
@@ -363,7 +639,8 @@ def model_fn_builder(albert_config, num_labels, init_checkpoint, learning_rate,
         create_model(albert_config, is_training, input_ids, input_mask,
                      segment_ids, label_ids, num_labels,
                      use_one_hot_embeddings, max_seq_length, dropout_prob,
-                     hub_module)
+                     hub_module, shared_context=shared_context,
+                     max_qa_length=max_qa_length)
 
     tvars = tf.trainable_variables()
     initialized_variable_names = {}
@@ -18,12 +18,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
 import math
 import os
-import time
 from albert import classifier_utils
+from albert import eval_utils
 from albert import fine_tuning_utils
 from albert import modeling
+import numpy as np
 import tensorflow.compat.v1 as tf
 from tensorflow.contrib import cluster_resolver as contrib_cluster_resolver
 from tensorflow.contrib import tpu as contrib_tpu
@@ -154,6 +156,35 @@ flags.DEFINE_float(
     "https://www.tensorflow.org/guide/saved_model#details_of_the_savedmodel_command_line_interface"
     ") to view the output signature of the threshold.")
 
+flags.DEFINE_float(
+    "early_exit_threshold", 0.0,
+    "If positive, eval, predict and the exported model stop running layers "
+    "for an example once its largest class probability reaches this value. "
+    "Needs a model with a single hidden group, and does not run on TPU.")
+
+flags.DEFINE_bool(
+    "calibrate_early_exit", False,
+    "Whether to simulate early exit on the dev set with model.ckpt-best and "
+    "write the accuracy and mean number of layers of a range of thresholds "
+    "to early_exit_calibration.txt.")
+
+flags.DEFINE_string(
+    "loss_scale", None,
+    "Loss scale for training with a float16 `compute_dtype` in the "
+    "albert_config: a number, or \"dynamic\" to adjust it during training.")
+
+flags.DEFINE_bool(
+    "in_memory_features", False,
+    "Whether to feed the train and dev features from NumPy arrays in memory "
+    "instead of writing TFRecord files. Does not run on TPU.")
+
+flags.DEFINE_string(
+    "quantized_checkpoint", None,
+    "A checkpoint written by quantize_checkpoint.py from model.ckpt-best. If "
+    "set, the dev set is evaluated with both checkpoints and their metric "
+    "and examples per second are written to quantization_report.txt. Does "
+    "not run on TPU.")
+
 
 def _serving_input_receiver_fn():
   """Creates an input function for serving."""
@@ -217,6 +248,28 @@ def main(_):
         "At least one of `do_train`, `do_eval`, `do_predict' or `export_dir` "
         "must be True.")
 
+  if FLAGS.use_tpu and (FLAGS.early_exit_threshold > 0 or
+                        FLAGS.calibrate_early_exit):
+    raise ValueError("Early exit is not supported on TPU.")
+
+  if FLAGS.use_tpu and FLAGS.in_memory_features:
+    raise ValueError("`in_memory_features` is not supported on TPU.")
+
+  if FLAGS.quantized_checkpoint and (FLAGS.use_tpu or
+                                     not FLAGS.albert_config_file):
+    raise ValueError("`quantized_checkpoint` needs `albert_config_file` and "
+                     "does not run on TPU.")
+
+  if FLAGS.quantized_checkpoint:
+    if not tf.train.checkpoint_exists(FLAGS.quantized_checkpoint):
+      raise ValueError("Cannot find `quantized_checkpoint` %s." %
+                       FLAGS.quantized_checkpoint)
+    if not FLAGS.do_eval and not tf.train.checkpoint_exists(
+        os.path.join(FLAGS.output_dir, "model.ckpt-best")):
+      raise ValueError("`quantized_checkpoint` is compared with "
+                       "model.ckpt-best of `output_dir`, which is only "
+                       "written by `do_eval`.")
+
   if not FLAGS.albert_config_file and not FLAGS.albert_hub_module_handle:
     raise ValueError("At least one of `--albert_config_file` and "
                      "`--albert_hub_module_handle` must be set")
@@ -287,7 +340,9 @@ def main(_):
       use_one_hot_embeddings=FLAGS.use_tpu,
       task_name=task_name,
       hub_module=FLAGS.albert_hub_module_handle,
-      optimizer=FLAGS.optimizer)
+      optimizer=FLAGS.optimizer,
+      early_exit_threshold=FLAGS.early_exit_threshold,
+      loss_scale=FLAGS.loss_scale)
 
   if not math.isnan(FLAGS.threshold_to_export):
     model_fn = _add_threshold_to_model_fn(model_fn, FLAGS.threshold_to_export)
@@ -304,26 +359,34 @@ def main(_):
       export_to_tpu=False)  # http://yaqs/4707241341091840
 
   if FLAGS.do_train:
-    cached_dir = FLAGS.cached_dir
-    if not cached_dir:
-      cached_dir = FLAGS.output_dir
-    train_file = os.path.join(cached_dir, task_name + "_train.tf_record")
-    if not tf.gfile.Exists(train_file):
-      classifier_utils.file_based_convert_examples_to_features(
-          train_examples, label_list, FLAGS.max_seq_length, tokenizer,
-          train_file, task_name)
+    if FLAGS.in_memory_features:
+      train_input_fn = classifier_utils.numpy_input_fn_builder(
+          classifier_utils.convert_examples_to_arrays(
+              train_examples, label_list, FLAGS.max_seq_length, tokenizer,
+              task_name),
+          is_training=True,
+          drop_remainder=True)
+    else:
+      cached_dir = FLAGS.cached_dir
+      if not cached_dir:
+        cached_dir = FLAGS.output_dir
+      train_file = os.path.join(cached_dir, task_name + "_train.tf_record")
+      if not tf.gfile.Exists(train_file):
+        classifier_utils.file_based_convert_examples_to_features(
+            train_examples, label_list, FLAGS.max_seq_length, tokenizer,
+            train_file, task_name)
+      train_input_fn = classifier_utils.file_based_input_fn_builder(
+          input_file=train_file,
+          seq_length=FLAGS.max_seq_length,
+          is_training=True,
+          drop_remainder=True,
+          task_name=task_name,
+          use_tpu=FLAGS.use_tpu,
+          bsz=FLAGS.train_batch_size)
     tf.logging.info("***** Running training *****")
     tf.logging.info("  Num examples = %d", len(train_examples))
     tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
     tf.logging.info("  Num steps = %d", FLAGS.train_step)
-    train_input_fn = classifier_utils.file_based_input_fn_builder(
-        input_file=train_file,
-        seq_length=FLAGS.max_seq_length,
-        is_training=True,
-        drop_remainder=True,
-        task_name=task_name,
-        use_tpu=FLAGS.use_tpu,
-        bsz=FLAGS.train_batch_size)
     estimator.train(input_fn=train_input_fn, max_steps=FLAGS.train_step)
 
   if FLAGS.do_eval:
@@ -338,14 +401,30 @@ def main(_):
       while len(eval_examples) % FLAGS.eval_batch_size != 0:
         eval_examples.append(classifier_utils.PaddingInputExample())
 
-    cached_dir = FLAGS.cached_dir
-    if not cached_dir:
-      cached_dir = FLAGS.output_dir
-    eval_file = os.path.join(cached_dir, task_name + "_eval.tf_record")
-    if not tf.gfile.Exists(eval_file):
-      classifier_utils.file_based_convert_examples_to_features(
-          eval_examples, label_list, FLAGS.max_seq_length, tokenizer,
-          eval_file, task_name)
+    if FLAGS.in_memory_features:
+      eval_input_fn = classifier_utils.numpy_input_fn_builder(
+          classifier_utils.convert_examples_to_arrays(
+              eval_examples, label_list, FLAGS.max_seq_length, tokenizer,
+              task_name),
+          is_training=False,
+          drop_remainder=False)
+    else:
+      cached_dir = FLAGS.cached_dir
+      if not cached_dir:
+        cached_dir = FLAGS.output_dir
+      eval_file = os.path.join(cached_dir, task_name + "_eval.tf_record")
+      if not tf.gfile.Exists(eval_file):
+        classifier_utils.file_based_convert_examples_to_features(
+            eval_examples, label_list, FLAGS.max_seq_length, tokenizer,
+            eval_file, task_name)
+      eval_input_fn = classifier_utils.file_based_input_fn_builder(
+          input_file=eval_file,
+          seq_length=FLAGS.max_seq_length,
+          is_training=False,
+          drop_remainder=True if FLAGS.use_tpu else False,
+          task_name=task_name,
+          use_tpu=FLAGS.use_tpu,
+          bsz=FLAGS.eval_batch_size)
 
     tf.logging.info("***** Running evaluation *****")
     tf.logging.info("  Num examples = %d (%d actual, %d padding)",
@@ -361,120 +440,138 @@ def main(_):
       assert len(eval_examples) % FLAGS.eval_batch_size == 0
       eval_steps = int(len(eval_examples) // FLAGS.eval_batch_size)
 
-    eval_drop_remainder = True if FLAGS.use_tpu else False
-    eval_input_fn = classifier_utils.file_based_input_fn_builder(
+    output_eval_file = os.path.join(FLAGS.output_dir, "eval_results.txt")
+
+    if task_name == "sts-b":
+      key_name = "pearson"
+    elif task_name == "cola":
+      key_name = "matthew_corr"
+    else:
+      key_name = "eval_accuracy"
+
+    eval_fns = eval_utils.create_eval_fns(
+        estimator, model_fn, eval_input_fn, tf.estimator.ModeKeys.EVAL,
+        FLAGS.use_tpu, steps=eval_steps, batch_size=FLAGS.eval_batch_size)
+    with tf.gfile.GFile(output_eval_file, "w") as writer:
+      eval_utils.evaluate_checkpoints(
+          FLAGS.output_dir, eval_fns, key_name, FLAGS.train_step, writer)
+
+  if FLAGS.calibrate_early_exit:
+    cached_dir = FLAGS.cached_dir
+    if not cached_dir:
+      cached_dir = FLAGS.output_dir
+    eval_file = os.path.join(cached_dir, task_name + "_eval.tf_record")
+    if not tf.gfile.Exists(eval_file):
+      classifier_utils.file_based_convert_examples_to_features(
+          processor.get_dev_examples(FLAGS.data_dir), label_list,
+          FLAGS.max_seq_length, tokenizer, eval_file, task_name)
+
+    tf.logging.info("***** Calibrating early exit *****")
+    calibration_model_fn = classifier_utils.model_fn_builder(
+        albert_config=albert_config,
+        num_labels=len(label_list),
+        init_checkpoint=None,
+        learning_rate=FLAGS.learning_rate,
+        num_train_steps=FLAGS.train_step,
+        num_warmup_steps=FLAGS.warmup_step,
+        use_tpu=False,
+        use_one_hot_embeddings=False,
+        task_name=task_name,
+        optimizer=FLAGS.optimizer,
+        calibrate_early_exit=True)
+    calibration_estimator = contrib_tpu.TPUEstimator(
+        use_tpu=False,
+        model_fn=calibration_model_fn,
+        config=run_config,
+        predict_batch_size=FLAGS.eval_batch_size)
+    calibration_input_fn = classifier_utils.file_based_input_fn_builder(
         input_file=eval_file,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
-        drop_remainder=eval_drop_remainder,
+        drop_remainder=False,
         task_name=task_name,
-        use_tpu=FLAGS.use_tpu,
+        use_tpu=False,
         bsz=FLAGS.eval_batch_size)
 
-    best_trial_info_file = os.path.join(FLAGS.output_dir, "best_trial.txt")
-
-    def _best_trial_info():
-      """Returns information about which checkpoints have been evaled so far."""
-      if tf.gfile.Exists(best_trial_info_file):
-        with tf.gfile.GFile(best_trial_info_file, "r") as best_info:
-          global_step, best_metric_global_step, metric_value = (
-              best_info.read().split(":"))
-          global_step = int(global_step)
-          best_metric_global_step = int(best_metric_global_step)
-          metric_value = float(metric_value)
-      else:
-        metric_value = -1
-        best_metric_global_step = -1
-        global_step = -1
-      tf.logging.info(
-          "Best trial info: Step: %s, Best Value Step: %s, "
-          "Best Value: %s", global_step, best_metric_global_step, metric_value)
-      return global_step, best_metric_global_step, metric_value
-
-    def _remove_checkpoint(checkpoint_path):
-      for ext in ["meta", "data-00000-of-00001", "index"]:
-        src_ckpt = checkpoint_path + ".{}".format(ext)
-        tf.logging.info("removing {}".format(src_ckpt))
-        tf.gfile.Remove(src_ckpt)
-
-    def _find_valid_cands(curr_step):
-      filenames = tf.gfile.ListDirectory(FLAGS.output_dir)
-      candidates = []
-      for filename in filenames:
-        if filename.endswith(".index"):
-          ckpt_name = filename[:-6]
-          idx = ckpt_name.split("-")[-1]
-          if int(idx) > curr_step:
-            candidates.append(filename)
-      return candidates
-
-    output_eval_file = os.path.join(FLAGS.output_dir, "eval_results.txt")
+    layer_probabilities = []
+    label_ids = []
+    for prediction in calibration_estimator.predict(
+        input_fn=calibration_input_fn,
+        checkpoint_path=os.path.join(FLAGS.output_dir, "model.ckpt-best")):
+      layer_probabilities.append(prediction["layer_probabilities"])
+      label_ids.append(prediction["label_ids"])
+    results = classifier_utils.calibrate_early_exit(
+        np.array(layer_probabilities), np.array(label_ids))
+
+    output_calibration_file = os.path.join(FLAGS.output_dir,
+                                           "early_exit_calibration.txt")
+    with tf.gfile.GFile(output_calibration_file, "w") as writer:
+      writer.write("threshold\taccuracy\tmean_layers\n")
+      for (threshold, accuracy, mean_layers) in results:
+        tf.logging.info("  threshold = %.2f, accuracy = %.4f, layers = %.2f",
+                        threshold, accuracy, mean_layers)
+        writer.write("%s\t%s\t%s\n" % (threshold, accuracy, mean_layers))
+
+  if FLAGS.quantized_checkpoint:
+    dev_examples = processor.get_dev_examples(FLAGS.data_dir)
+    cached_dir = FLAGS.cached_dir
+    if not cached_dir:
+      cached_dir = FLAGS.output_dir
+    eval_file = os.path.join(cached_dir, task_name + "_eval.tf_record")
+    if not tf.gfile.Exists(eval_file):
+      classifier_utils.file_based_convert_examples_to_features(
+          dev_examples, label_list, FLAGS.max_seq_length, tokenizer,
+          eval_file, task_name)
 
+    tf.logging.info("***** Comparing the quantized model *****")
+    report_input_fn = classifier_utils.file_based_input_fn_builder(
+        input_file=eval_file,
+        seq_length=FLAGS.max_seq_length,
+        is_training=False,
+        drop_remainder=False,
+        task_name=task_name,
+        use_tpu=False,
+        bsz=FLAGS.eval_batch_size)
     if task_name == "sts-b":
       key_name = "pearson"
     elif task_name == "cola":
       key_name = "matthew_corr"
     else:
       key_name = "eval_accuracy"
-
-    global_step, best_perf_global_step, best_perf = _best_trial_info()
-    writer = tf.gfile.GFile(output_eval_file, "w")
-    while global_step < FLAGS.train_step:
-      steps_and_files = {}
-      filenames = tf.gfile.ListDirectory(FLAGS.output_dir)
-      for filename in filenames:
-        if filename.endswith(".index"):
-          ckpt_name = filename[:-6]
-          cur_filename = os.path.join(FLAGS.output_dir, ckpt_name)
-          if cur_filename.split("-")[-1] == "best":
-            continue
-          gstep = int(cur_filename.split("-")[-1])
-          if gstep not in steps_and_files:
-            tf.logging.info("Add {} to eval list.".format(cur_filename))
-            steps_and_files[gstep] = cur_filename
-      tf.logging.info("found {} files.".format(len(steps_and_files)))
-      if not steps_and_files:
-        tf.logging.info("found 0 file, global step: {}. Sleeping."
-                        .format(global_step))
-        time.sleep(60)
-      else:
-        for checkpoint in sorted(steps_and_files.items()):
-          step, checkpoint_path = checkpoint
-          if global_step >= step:
-            if (best_perf_global_step != step and
-                len(_find_valid_cands(step)) > 1):
-              _remove_checkpoint(checkpoint_path)
-            continue
-          result = estimator.evaluate(
-              input_fn=eval_input_fn,
-              steps=eval_steps,
-              checkpoint_path=checkpoint_path)
-          global_step = result["global_step"]
-          tf.logging.info("***** Eval results *****")
-          for key in sorted(result.keys()):
-            tf.logging.info("  %s = %s", key, str(result[key]))
-            writer.write("%s = %s\n" % (key, str(result[key])))
-          writer.write("best = {}\n".format(best_perf))
-          if result[key_name] > best_perf:
-            best_perf = result[key_name]
-            best_perf_global_step = global_step
-          elif len(_find_valid_cands(global_step)) > 1:
-            _remove_checkpoint(checkpoint_path)
-          writer.write("=" * 50 + "\n")
-          writer.flush()
-          with tf.gfile.GFile(best_trial_info_file, "w") as best_info:
-            best_info.write("{}:{}:{}".format(
-                global_step, best_perf_global_step, best_perf))
-    writer.close()
-
-    for ext in ["meta", "data-00000-of-00001", "index"]:
-      src_ckpt = "model.ckpt-{}.{}".format(best_perf_global_step, ext)
-      tgt_ckpt = "model.ckpt-best.{}".format(ext)
-      tf.logging.info("saving {} to {}".format(src_ckpt, tgt_ckpt))
-      tf.io.gfile.rename(
-          os.path.join(FLAGS.output_dir, src_ckpt),
-          os.path.join(FLAGS.output_dir, tgt_ckpt),
-          overwrite=True)
+    quantized_config = copy.deepcopy(albert_config)
+    quantized_config.quantize_weights = True
+
+    output_report_file = os.path.join(FLAGS.output_dir,
+                                      "quantization_report.txt")
+    with tf.gfile.GFile(output_report_file, "w") as writer:
+      writer.write("weights\t%s\texamples_per_sec\n" % key_name)
+      for (weights, config, checkpoint_path) in [
+          ("float32", albert_config,
+           os.path.join(FLAGS.output_dir, "model.ckpt-best")),
+          ("int8", quantized_config, FLAGS.quantized_checkpoint)]:
+        report_model_fn = classifier_utils.model_fn_builder(
+            albert_config=config,
+            num_labels=len(label_list),
+            init_checkpoint=None,
+            learning_rate=FLAGS.learning_rate,
+            num_train_steps=FLAGS.train_step,
+            num_warmup_steps=FLAGS.warmup_step,
+            use_tpu=False,
+            use_one_hot_embeddings=False,
+            task_name=task_name,
+            optimizer=FLAGS.optimizer)
+        # Only the inference loop of a warm evaluator is timed, without the
+        # graph construction, session creation and checkpoint restore.
+        evaluator = eval_utils.WarmEvaluator(
+            report_model_fn, report_input_fn, tf.estimator.ModeKeys.EVAL,
+            params={"batch_size": FLAGS.eval_batch_size})
+        result = evaluator.evaluate(checkpoint_path)
+        examples_per_sec = evaluator.benchmark(checkpoint_path)
+        evaluator.close()
+        tf.logging.info("  %s: %s = %.4f, examples/sec = %.2f", weights,
+                        key_name, result[key_name], examples_per_sec)
+        writer.write("%s\t%s\t%s\n" % (weights, result[key_name],
+                                         examples_per_sec))
 
   if FLAGS.do_predict:
     predict_examples = processor.get_test_examples(FLAGS.data_dir)
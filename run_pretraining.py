@@ -83,6 +83,11 @@ flags.DEFINE_integer("num_warmup_steps", 3125, "Number of warmup steps.")
 
 flags.DEFINE_integer("start_warmup_step", 0, "The starting step of warmup.")
 
+flags.DEFINE_string(
+    "loss_scale", None,
+    "Loss scale for training with a float16 `compute_dtype` in the "
+    "albert_config: a number, or \"dynamic\" to adjust it during training.")
+
 flags.DEFINE_integer("save_checkpoints_steps", 5000,
                      "How often to save the model checkpoint.")
 
@@ -132,7 +137,7 @@ flags.DEFINE_float(
 def model_fn_builder(albert_config, init_checkpoint, learning_rate,
                      num_train_steps, num_warmup_steps, use_tpu,
                      use_one_hot_embeddings, optimizer, poly_power,
-                     start_warmup_step):
+                     start_warmup_step, loss_scale=None):
   """Returns `model_fn` closure for TPUEstimator."""
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
@@ -220,7 +225,8 @@ def model_fn_builder(albert_config, init_checkpoint, learning_rate,
     if mode == tf.estimator.ModeKeys.TRAIN:
       train_op = optimization.create_optimizer(
           total_loss, learning_rate, num_train_steps, num_warmup_steps,
-          use_tpu, optimizer, poly_power, start_warmup_step)
+          use_tpu, optimizer, poly_power, start_warmup_step,
+          loss_scale=loss_scale)
 
       output_spec = contrib_tpu.TPUEstimatorSpec(
           mode=mode,
@@ -512,7 +518,8 @@ def main(_):
       use_one_hot_embeddings=FLAGS.use_tpu,
       optimizer=FLAGS.optimizer,
       poly_power=FLAGS.poly_power,
-      start_warmup_step=FLAGS.start_warmup_step)
+      start_warmup_step=FLAGS.start_warmup_step,
+      loss_scale=FLAGS.loss_scale)
 
   # If TPU is not available, this will fall back to normal Estimator on CPU
   # or GPU.
@@ -19,8 +19,8 @@ from __future__ import division
 from __future__ import print_function
 
 import os
-import time
 from albert import classifier_utils
+from albert import eval_utils
 from albert import fine_tuning_utils
 from albert import modeling
 from albert import race_utils
@@ -164,6 +164,17 @@ flags.DEFINE_integer(
     "num_tpu_cores", 8,
     "Only used if `use_tpu` is True. Total number of TPU cores to use.")
 
+flags.DEFINE_bool(
+    "shared_context", False,
+    "Whether to encode the article once for all the choices of a question, "
+    "the choices attending to the article but not the other way around. "
+    "This changes the format of the tfrecord files, which must be "
+    "regenerated when switching.")
+
+flags.DEFINE_integer(
+    "num_conversion_workers", 1,
+    "Number of processes converting the examples to tfrecord files.")
+
 
 def main(_):
   tf.logging.set_verbosity(tf.logging.INFO)
@@ -178,12 +189,26 @@ def main(_):
 
   albert_config = modeling.AlbertConfig.from_json_file(FLAGS.albert_config_file)
 
+  # In the shared-context layout a record is longer than `max_seq_length`,
+  # but every choice is positioned right after the context, so the position
+  # ids stay below `max_seq_length`.
   if FLAGS.max_seq_length > albert_config.max_position_embeddings:
     raise ValueError(
         "Cannot use sequence length %d because the ALBERT model "
         "was only trained up to sequence length %d" %
         (FLAGS.max_seq_length, albert_config.max_position_embeddings))
 
+  if FLAGS.shared_context:
+    if FLAGS.max_seq_length <= FLAGS.max_qa_length + 4:
+      raise ValueError(
+          "With `shared_context`, the max_seq_length (%d) must be greater "
+          "than max_qa_length (%d) + 4" % (FLAGS.max_seq_length,
+                                           FLAGS.max_qa_length))
+    if albert_config.attention_window_size > 0 or albert_config.remove_padding:
+      raise ValueError(
+          "`shared_context` needs a per-query attention mask, which "
+          "`attention_window_size` and `remove_padding` do not support.")
+
   tf.gfile.MakeDirs(FLAGS.output_dir)
 
   task_name = FLAGS.task_name.lower()
@@ -227,10 +252,6 @@ def main(_):
           num_shards=FLAGS.num_tpu_cores,
           per_host_input_for_training=is_per_host))
 
-  train_examples = None
-  if FLAGS.do_train:
-    train_examples = processor.get_train_examples(FLAGS.data_dir)
-
   model_fn = race_utils.model_fn_builder(
       albert_config=albert_config,
       num_labels=len(label_list),
@@ -242,7 +263,20 @@ def main(_):
       use_one_hot_embeddings=FLAGS.use_tpu,
       max_seq_length=FLAGS.max_seq_length,
       dropout_prob=FLAGS.dropout_prob,
-      hub_module=FLAGS.albert_hub_module_handle)
+      hub_module=FLAGS.albert_hub_module_handle,
+      shared_context=FLAGS.shared_context,
+      max_qa_length=FLAGS.max_qa_length)
+
+  # The records hold one sequence per choice, or a single sequence with the
+  # article and all the choices in the shared-context layout.
+  if FLAGS.shared_context:
+    context_length, choice_length = race_utils.get_shared_context_lengths(
+        FLAGS.max_seq_length, FLAGS.max_qa_length)
+    record_seq_length = context_length + len(label_list) * choice_length
+    record_multiple = 1
+  else:
+    record_seq_length = FLAGS.max_seq_length
+    record_multiple = len(label_list)
 
   # If TPU is not available, this will fall back to normal Estimator on CPU
   # or GPU.
@@ -255,23 +289,26 @@ def main(_):
       predict_batch_size=FLAGS.predict_batch_size)
 
   if FLAGS.do_train:
-    if not tf.gfile.Exists(FLAGS.train_file):
-      race_utils.file_based_convert_examples_to_features(
-          train_examples, label_list, FLAGS.max_seq_length, tokenizer,
-          FLAGS.train_file, FLAGS.max_qa_length)
     tf.logging.info("***** Running training *****")
-    tf.logging.info("  Num examples = %d", len(train_examples))
+    if not tf.gfile.Exists(FLAGS.train_file):
+      # The train set is streamed from the json files into the conversion.
+      num_train_examples = race_utils.file_based_convert_examples_to_features(
+          processor.iter_train_examples(FLAGS.data_dir), label_list,
+          FLAGS.max_seq_length, tokenizer, FLAGS.train_file,
+          FLAGS.max_qa_length, num_workers=FLAGS.num_conversion_workers,
+          shared_context=FLAGS.shared_context)
+      tf.logging.info("  Num examples = %d", num_train_examples)
     tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
     tf.logging.info("  Num steps = %d", FLAGS.train_step)
     train_input_fn = classifier_utils.file_based_input_fn_builder(
         input_file=FLAGS.train_file,
-        seq_length=FLAGS.max_seq_length,
+        seq_length=record_seq_length,
         is_training=True,
         drop_remainder=True,
         task_name=task_name,
         use_tpu=FLAGS.use_tpu,
         bsz=FLAGS.train_batch_size,
-        multiple=len(label_list))
+        multiple=record_multiple)
     estimator.train(input_fn=train_input_fn, max_steps=FLAGS.train_step)
 
   if FLAGS.do_eval:
@@ -289,7 +326,9 @@ def main(_):
     if not tf.gfile.Exists(FLAGS.eval_file):
       race_utils.file_based_convert_examples_to_features(
           eval_examples, label_list, FLAGS.max_seq_length, tokenizer,
-          FLAGS.eval_file, FLAGS.max_qa_length)
+          FLAGS.eval_file, FLAGS.max_qa_length,
+          num_workers=FLAGS.num_conversion_workers,
+          shared_context=FLAGS.shared_context)
 
     tf.logging.info("***** Running evaluation *****")
     tf.logging.info("  Num examples = %d (%d actual, %d padding)",
@@ -308,95 +347,24 @@ def main(_):
     eval_drop_remainder = True if FLAGS.use_tpu else False
     eval_input_fn = classifier_utils.file_based_input_fn_builder(
         input_file=FLAGS.eval_file,
-        seq_length=FLAGS.max_seq_length,
+        seq_length=record_seq_length,
         is_training=False,
         drop_remainder=eval_drop_remainder,
         task_name=task_name,
         use_tpu=FLAGS.use_tpu,
         bsz=FLAGS.eval_batch_size,
-        multiple=len(label_list))
-
-    def _find_valid_cands(curr_step):
-      filenames = tf.gfile.ListDirectory(FLAGS.output_dir)
-      candidates = []
-      for filename in filenames:
-        if filename.endswith(".index"):
-          ckpt_name = filename[:-6]
-          idx = ckpt_name.split("-")[-1]
-          if idx != "best" and int(idx) > curr_step:
-            candidates.append(filename)
-      return candidates
+        multiple=record_multiple)
 
     output_eval_file = os.path.join(FLAGS.output_dir, "eval_results.txt")
-    checkpoint_path = os.path.join(FLAGS.output_dir, "model.ckpt-best")
     key_name = "eval_accuracy"
-    if tf.gfile.Exists(checkpoint_path + ".index"):
-      result = estimator.evaluate(
-          input_fn=eval_input_fn,
-          steps=eval_steps,
-          checkpoint_path=checkpoint_path)
-      best_perf = result[key_name]
-      global_step = result["global_step"]
-    else:
-      global_step = -1
-      best_perf = -1
-      checkpoint_path = None
-    writer = tf.gfile.GFile(output_eval_file, "w")
-    while global_step < FLAGS.train_step:
-      steps_and_files = {}
-      filenames = tf.gfile.ListDirectory(FLAGS.output_dir)
-      for filename in filenames:
-        if filename.endswith(".index"):
-          ckpt_name = filename[:-6]
-          cur_filename = os.path.join(FLAGS.output_dir, ckpt_name)
-          if cur_filename.split("-")[-1] == "best":
-            continue
-          gstep = int(cur_filename.split("-")[-1])
-          if gstep not in steps_and_files:
-            tf.logging.info("Add {} to eval list.".format(cur_filename))
-            steps_and_files[gstep] = cur_filename
-      tf.logging.info("found {} files.".format(len(steps_and_files)))
-      # steps_and_files = sorted(steps_and_files, key=lambda x: x[0])
-      if not steps_and_files:
-        tf.logging.info("found 0 file, global step: {}. Sleeping."
-                        .format(global_step))
-        time.sleep(1)
-      else:
-        for ele in sorted(steps_and_files.items()):
-          step, checkpoint_path = ele
-          if global_step >= step:
-            if len(_find_valid_cands(step)) > 1:
-              for ext in ["meta", "data-00000-of-00001", "index"]:
-                src_ckpt = checkpoint_path + ".{}".format(ext)
-                tf.logging.info("removing {}".format(src_ckpt))
-                tf.gfile.Remove(src_ckpt)
-            continue
-          result = estimator.evaluate(
-              input_fn=eval_input_fn,
-              steps=eval_steps,
-              checkpoint_path=checkpoint_path)
-          global_step = result["global_step"]
-          tf.logging.info("***** Eval results *****")
-          for key in sorted(result.keys()):
-            tf.logging.info("  %s = %s", key, str(result[key]))
-            writer.write("%s = %s\n" % (key, str(result[key])))
-          writer.write("best = {}\n".format(best_perf))
-          if result[key_name] > best_perf:
-            best_perf = result[key_name]
-            for ext in ["meta", "data-00000-of-00001", "index"]:
-              src_ckpt = checkpoint_path + ".{}".format(ext)
-              tgt_ckpt = checkpoint_path.rsplit("-", 1)[0] + "-best.{}".format(ext)
-              tf.logging.info("saving {} to {}".format(src_ckpt, tgt_ckpt))
-              tf.gfile.Copy(src_ckpt, tgt_ckpt, overwrite=True)
-              writer.write("saved {} to {}\n".format(src_ckpt, tgt_ckpt))
-
-          if len(_find_valid_cands(global_step)) > 1:
-            for ext in ["meta", "data-00000-of-00001", "index"]:
-              src_ckpt = checkpoint_path + ".{}".format(ext)
-              tf.logging.info("removing {}".format(src_ckpt))
-              tf.gfile.Remove(src_ckpt)
-          writer.write("=" * 50 + "\n")
-    writer.close()
+    eval_fns = eval_utils.create_eval_fns(
+        estimator, model_fn, eval_input_fn, tf.estimator.ModeKeys.EVAL,
+        FLAGS.use_tpu, steps=eval_steps, batch_size=FLAGS.eval_batch_size)
+    with tf.gfile.GFile(output_eval_file, "w") as writer:
+      best_perf, _ = eval_utils.evaluate_checkpoints(
+          FLAGS.output_dir, eval_fns, key_name, FLAGS.train_step, writer,
+          poll_interval_secs=1)
+
   if FLAGS.do_predict:
     predict_examples = processor.get_test_examples(FLAGS.data_dir)
     num_actual_predict_examples = len(predict_examples)
@@ -414,7 +382,9 @@ def main(_):
     race_utils.file_based_convert_examples_to_features(
         predict_examples, label_list,
         FLAGS.max_seq_length, tokenizer,
-        predict_file, FLAGS.max_qa_length)
+        predict_file, FLAGS.max_qa_length,
+        num_workers=FLAGS.num_conversion_workers,
+        shared_context=FLAGS.shared_context)
 
     tf.logging.info("***** Running prediction*****")
     tf.logging.info("  Num examples = %d (%d actual, %d padding)",
@@ -425,13 +395,13 @@ def main(_):
     predict_drop_remainder = True if FLAGS.use_tpu else False
     predict_input_fn = classifier_utils.file_based_input_fn_builder(
         input_file=predict_file,
-        seq_length=FLAGS.max_seq_length,
+        seq_length=record_seq_length,
         is_training=False,
         drop_remainder=predict_drop_remainder,
         task_name=task_name,
         use_tpu=FLAGS.use_tpu,
         bsz=FLAGS.predict_batch_size,
-        multiple=len(label_list))
+        multiple=record_multiple)
 
     checkpoint_path = os.path.join(FLAGS.output_dir, "model.ckpt-best")
     result = estimator.evaluate(
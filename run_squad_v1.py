@@ -23,7 +23,7 @@ from __future__ import print_function
 import json
 import os
 import random
-import time
+from albert import eval_utils
 from albert import fine_tuning_utils
 from albert import modeling
 from albert import squad_utils
@@ -172,6 +172,16 @@ flags.DEFINE_integer(
     "num_tpu_cores", 8,
     "Only used if `use_tpu` is True. Total number of TPU cores to use.")
 
+flags.DEFINE_bool(
+    "bucket_by_length", False,
+    "Whether to batch the prediction features of similar length together "
+    "and pad them to the longest feature of the batch rather than to "
+    "`max_seq_length`. Buckets emit features out of order, so the "
+    "predictions of an example are held in memory until all the features "
+    "before it are predicted, which can be the whole dev set if an early "
+    "feature lands in a rarely filled bucket. Training batches are not "
+    "bucketed. Ignored on TPU.")
+
 flags.DEFINE_bool(
     "use_einsum", True,
     "Whether to use tf.einsum or tf.reshape+tf.matmul for dense layers. Must "
@@ -397,128 +407,57 @@ def main(_):
         drop_remainder=False,
         use_tpu=FLAGS.use_tpu,
         bsz=FLAGS.predict_batch_size,
-        is_v2=False)
+        is_v2=False,
+        bucket_by_length=FLAGS.bucket_by_length)
+
+    # The predictions are written to fixed paths, so checkpoints are
+    # evaluated one at a time.
+    predict_fn = eval_utils.create_eval_fns(
+        estimator, model_fn, predict_input_fn, tf.estimator.ModeKeys.PREDICT,
+        FLAGS.use_tpu, devices=eval_utils.get_eval_devices()[:1],
+        batch_size=FLAGS.predict_batch_size)[0]
 
     def get_result(checkpoint):
       """Evaluate the checkpoint on SQuAD 1.0."""
       # If running eval on the TPU, you will need to specify the number of
       # steps.
-      reader = tf.train.NewCheckpointReader(checkpoint)
-      global_step = reader.get_tensor(tf.GraphKeys.GLOBAL_STEP)
-      all_results = []
-      for result in estimator.predict(
-          predict_input_fn, yield_single_examples=True,
-          checkpoint_path=checkpoint):
-        if len(all_results) % 1000 == 0:
-          tf.logging.info("Processing example: %d" % (len(all_results)))
-        unique_id = int(result["unique_ids"])
-        start_log_prob = [float(x) for x in result["start_log_prob"].flat]
-        end_log_prob = [float(x) for x in result["end_log_prob"].flat]
-        all_results.append(
-            squad_utils.RawResult(
-                unique_id=unique_id,
-                start_log_prob=start_log_prob,
-                end_log_prob=end_log_prob))
-
       output_prediction_file = os.path.join(
           FLAGS.output_dir, "predictions.json")
       output_nbest_file = os.path.join(
           FLAGS.output_dir, "nbest_predictions.json")
 
-      result_dict = {}
-      squad_utils.accumulate_predictions_v1(
-          result_dict, eval_examples, eval_features,
-          all_results, FLAGS.n_best_size, FLAGS.max_answer_length)
-      predictions = squad_utils.write_predictions_v1(
-          result_dict, eval_examples, eval_features, all_results,
-          FLAGS.n_best_size, FLAGS.max_answer_length,
-          output_prediction_file, output_nbest_file)
+      prediction_writer = squad_utils.StreamingPredictionWriter(
+          eval_examples, eval_features, FLAGS.n_best_size,
+          FLAGS.max_answer_length, output_prediction_file, output_nbest_file)
+      num_results = 0
+      for result in predict_fn(checkpoint):
+        if num_results % 1000 == 0:
+          tf.logging.info("Processing example: %d" % (num_results))
+        prediction_writer.process_result(
+            squad_utils.RawResult(
+                unique_id=int(result["unique_ids"]),
+                start_log_prob=result["start_log_prob"],
+                end_log_prob=result["end_log_prob"]))
+        num_results += 1
+      predictions = prediction_writer.close()
 
       return squad_utils.evaluate_v1(
-          prediction_json, predictions), int(global_step)
-
-    def _find_valid_cands(curr_step):
-      filenames = tf.gfile.ListDirectory(FLAGS.output_dir)
-      candidates = []
-      for filename in filenames:
-        if filename.endswith(".index"):
-          ckpt_name = filename[:-6]
-          idx = ckpt_name.split("-")[-1]
-          if idx != "best" and int(idx) > curr_step:
-            candidates.append(filename)
-      return candidates
+          prediction_json, predictions)
 
     output_eval_file = os.path.join(FLAGS.output_dir, "eval_results.txt")
-    checkpoint_path = os.path.join(FLAGS.output_dir, "model.ckpt-best")
     key_name = "f1"
     writer = tf.gfile.GFile(output_eval_file, "w")
-    if tf.gfile.Exists(checkpoint_path + ".index"):
-      result = get_result(checkpoint_path)
-      best_perf = result[0][key_name]
-      global_step = result[1]
-    else:
-      global_step = -1
-      best_perf = -1
-      checkpoint_path = None
-    while global_step < num_train_steps:
-      steps_and_files = {}
-      filenames = tf.gfile.ListDirectory(FLAGS.output_dir)
-      for filename in filenames:
-        if filename.endswith(".index"):
-          ckpt_name = filename[:-6]
-          cur_filename = os.path.join(FLAGS.output_dir, ckpt_name)
-          if cur_filename.split("-")[-1] == "best":
-            continue
-          gstep = int(cur_filename.split("-")[-1])
-          if gstep not in steps_and_files:
-            tf.logging.info("Add {} to eval list.".format(cur_filename))
-            steps_and_files[gstep] = cur_filename
-      tf.logging.info("found {} files.".format(len(steps_and_files)))
-      if not steps_and_files:
-        tf.logging.info("found 0 file, global step: {}. Sleeping."
-                        .format(global_step))
-        time.sleep(60)
-      else:
-        for ele in sorted(steps_and_files.items()):
-          step, checkpoint_path = ele
-          if global_step >= step:
-            if len(_find_valid_cands(step)) > 1:
-              for ext in ["meta", "data-00000-of-00001", "index"]:
-                src_ckpt = checkpoint_path + ".{}".format(ext)
-                tf.logging.info("removing {}".format(src_ckpt))
-                tf.gfile.Remove(src_ckpt)
-            continue
-          result, global_step = get_result(checkpoint_path)
-          tf.logging.info("***** Eval results *****")
-          for key in sorted(result.keys()):
-            tf.logging.info("  %s = %s", key, str(result[key]))
-            writer.write("%s = %s\n" % (key, str(result[key])))
-          if result[key_name] > best_perf:
-            best_perf = result[key_name]
-            for ext in ["meta", "data-00000-of-00001", "index"]:
-              src_ckpt = checkpoint_path + ".{}".format(ext)
-              tgt_ckpt = checkpoint_path.rsplit(
-                  "-", 1)[0] + "-best.{}".format(ext)
-              tf.logging.info("saving {} to {}".format(src_ckpt, tgt_ckpt))
-              tf.gfile.Copy(src_ckpt, tgt_ckpt, overwrite=True)
-              writer.write("saved {} to {}\n".format(src_ckpt, tgt_ckpt))
-          writer.write("best {} = {}\n".format(key_name, best_perf))
-          tf.logging.info("  best {} = {}\n".format(key_name, best_perf))
-
-          if len(_find_valid_cands(global_step)) > 2:
-            for ext in ["meta", "data-00000-of-00001", "index"]:
-              src_ckpt = checkpoint_path + ".{}".format(ext)
-              tf.logging.info("removing {}".format(src_ckpt))
-              tf.gfile.Remove(src_ckpt)
-          writer.write("=" * 50 + "\n")
+    _, best_global_step = eval_utils.evaluate_checkpoints(
+        FLAGS.output_dir, [get_result], key_name, num_train_steps, writer)
 
     checkpoint_path = os.path.join(FLAGS.output_dir, "model.ckpt-best")
-    result, global_step = get_result(checkpoint_path)
+    result = get_result(checkpoint_path)
     tf.logging.info("***** Final Eval results *****")
     for key in sorted(result.keys()):
       tf.logging.info("  %s = %s", key, str(result[key]))
       writer.write("%s = %s\n" % (key, str(result[key])))
-    writer.write("best perf happened at step: {}".format(global_step))
+    writer.write("best perf happened at step: {}".format(best_global_step))
+    writer.close()
 
   if FLAGS.export_dir:
     tf.gfile.MakeDirs(FLAGS.export_dir)
@@ -20,11 +20,13 @@ from __future__ import division
 from __future__ import print_function
 
 
+import copy
 import json
 import os
 import random
 import time
 
+from albert import eval_utils
 from albert import fine_tuning_utils
 from albert import modeling
 from albert import squad_utils
@@ -173,6 +175,28 @@ flags.DEFINE_integer(
     "num_tpu_cores", 8,
     "Only used if `use_tpu` is True. Total number of TPU cores to use.")
 
+flags.DEFINE_bool(
+    "bucket_by_length", False,
+    "Whether to batch the prediction features of similar length together "
+    "and pad them to the longest feature of the batch rather than to "
+    "`max_seq_length`. Buckets emit features out of order, so the "
+    "predictions of an example are held in memory until all the features "
+    "before it are predicted, which can be the whole dev set if an early "
+    "feature lands in a rarely filled bucket. Training batches are not "
+    "bucketed. Ignored on TPU.")
+
+
+flags.DEFINE_integer(
+    "span_filter_layers", 0,
+    "If positive, a first prediction pass with only this many transformer "
+    "layers scores the doc spans of each question with the answerability "
+    "head, and only the `span_filter_top_k` most promising spans are run "
+    "through the full model. Needs `num_hidden_groups` = 1.")
+
+flags.DEFINE_integer(
+    "span_filter_top_k", 2,
+    "Number of doc spans per question kept by the `span_filter_layers` pass. "
+    "Lower values trade recall for latency.")
 
 flags.DEFINE_integer("start_n_top", 5, "beam size for the start positions.")
 
@@ -215,6 +239,24 @@ def validate_flags_or_throw(albert_config):
         "The max_seq_length (%d) must be greater than max_query_length "
         "(%d) + 3" % (FLAGS.max_seq_length, FLAGS.max_query_length))
 
+  if FLAGS.span_filter_layers:
+    if FLAGS.albert_hub_module_handle:
+      raise ValueError(
+          "`span_filter_layers` requires the model to be built from "
+          "`albert_config_file`, not from a TF-Hub module.")
+    if FLAGS.span_filter_layers >= albert_config.num_hidden_layers:
+      raise ValueError(
+          "`span_filter_layers` (%d) must be smaller than the number of "
+          "hidden layers (%d)" % (FLAGS.span_filter_layers,
+                                  albert_config.num_hidden_layers))
+    if albert_config.num_hidden_groups != 1:
+      raise ValueError(
+          "`span_filter_layers` needs a model whose layers are all shared "
+          "(num_hidden_groups = 1), got %d hidden groups." %
+          albert_config.num_hidden_groups)
+    if FLAGS.span_filter_top_k < 1:
+      raise ValueError("`span_filter_top_k` must be positive.")
+
 
 def main(_):
   tf.logging.set_verbosity(tf.logging.INFO)
@@ -373,21 +415,112 @@ def main(_):
         drop_remainder=False,
         use_tpu=FLAGS.use_tpu,
         bsz=FLAGS.predict_batch_size,
-        is_v2=True)
+        is_v2=True,
+        bucket_by_length=FLAGS.bucket_by_length)
+
+    # Gold answers are normalized once and shared by all checkpoints.
+    squad_metrics = squad_utils.SquadV2Metrics(prediction_json)
+
+    # The predictions are written to fixed paths, so checkpoints are
+    # evaluated one at a time.
+    eval_devices = eval_utils.get_eval_devices()[:1]
+    if FLAGS.span_filter_layers:
+      # The transformer layers are shared, so a model with fewer layers can
+      # be restored from the same checkpoints.
+      filter_config = copy.deepcopy(albert_config)
+      filter_config.num_hidden_layers = FLAGS.span_filter_layers
+      filter_model_fn = squad_utils.v2_model_fn_builder(
+          albert_config=filter_config,
+          init_checkpoint=None,
+          learning_rate=FLAGS.learning_rate,
+          num_train_steps=num_train_steps,
+          num_warmup_steps=num_warmup_steps,
+          use_tpu=FLAGS.use_tpu,
+          use_one_hot_embeddings=FLAGS.use_tpu,
+          max_seq_length=FLAGS.max_seq_length,
+          start_n_top=FLAGS.start_n_top,
+          end_n_top=FLAGS.end_n_top,
+          dropout_prob=FLAGS.dropout_prob,
+          hub_module=None)
+      filter_estimator = contrib_tpu.TPUEstimator(
+          use_tpu=FLAGS.use_tpu,
+          model_fn=filter_model_fn,
+          config=run_config,
+          train_batch_size=FLAGS.train_batch_size,
+          predict_batch_size=FLAGS.predict_batch_size)
+      filter_fn = eval_utils.create_eval_fns(
+          filter_estimator, filter_model_fn, predict_input_fn,
+          tf.estimator.ModeKeys.PREDICT, FLAGS.use_tpu,
+          devices=eval_devices, batch_size=FLAGS.predict_batch_size)[0]
+
+      # The spans kept for each checkpoint are written to their own file.
+      filtered_feature_file = FLAGS.predict_feature_file + ".filtered"
+      predict_input_fn = squad_utils.input_fn_builder(
+          input_file=filtered_feature_file,
+          seq_length=FLAGS.max_seq_length,
+          is_training=False,
+          drop_remainder=False,
+          use_tpu=FLAGS.use_tpu,
+          bsz=FLAGS.predict_batch_size,
+          is_v2=True,
+          bucket_by_length=FLAGS.bucket_by_length)
+
+      def filter_spans(checkpoint):
+        """Writes and returns the most promising doc spans of each question."""
+        unique_id_to_cls_logits = {}
+        for result in filter_fn(checkpoint):
+          unique_id_to_cls_logits[int(result["unique_ids"])] = float(
+              result["cls_logits"].flat[0])
+        features = squad_utils.select_top_spans(
+            eval_features, unique_id_to_cls_logits, FLAGS.span_filter_top_k)
+        feature_writer = squad_utils.FeatureWriter(
+            filename=filtered_feature_file, is_training=False)
+        for feature in features:
+          feature_writer.process_feature(feature)
+        feature_writer.close()
+        tf.logging.info("Kept %d of %d doc spans.", len(features),
+                        len(eval_features))
+        return features
+
+    predict_fn = eval_utils.create_eval_fns(
+        estimator, model_fn, predict_input_fn, tf.estimator.ModeKeys.PREDICT,
+        FLAGS.use_tpu, devices=eval_devices,
+        batch_size=FLAGS.predict_batch_size)[0]
 
     def get_result(checkpoint):
       """Evaluate the checkpoint on SQuAD v2.0."""
       # If running eval on the TPU, you will need to specify the number of
       # steps.
-      reader = tf.train.NewCheckpointReader(checkpoint)
-      global_step = reader.get_tensor(tf.GraphKeys.GLOBAL_STEP)
-      all_results = []
-      for result in estimator.predict(
-          predict_input_fn, yield_single_examples=True,
-          checkpoint_path=checkpoint):
-        if len(all_results) % 1000 == 0:
-          tf.logging.info("Processing example: %d" % (len(all_results)))
-        unique_id = int(result["unique_ids"])
+      output_prediction_file = os.path.join(
+          FLAGS.output_dir, "predictions.json")
+      output_nbest_file = os.path.join(
+          FLAGS.output_dir, "nbest_predictions.json")
+      output_null_log_odds_file = os.path.join(
+          FLAGS.output_dir, "null_odds.json")
+
+      # The timings and the fraction of doc spans kept are reported along
+      # with the metrics to show the speed/F1 tradeoff of the span filter.
+      timings = {}
+      features = eval_features
+      if FLAGS.span_filter_layers:
+        start_time = time.time()
+        features = filter_spans(checkpoint)
+        timings["span_filter_secs"] = time.time() - start_time
+        timings["span_filter_kept"] = len(features) / len(eval_features)
+      start_time = time.time()
+
+      # Predictions are written by `evaluate_v2_predictions` once the null
+      # score threshold is known.
+      prediction_writer = squad_utils.StreamingPredictionWriter(
+          eval_examples, features, FLAGS.n_best_size,
+          FLAGS.max_answer_length, None, output_nbest_file,
+          output_null_log_odds_file=output_null_log_odds_file,
+          start_n_top=FLAGS.start_n_top, end_n_top=FLAGS.end_n_top,
+          is_v2=True)
+      num_results = 0
+      for result in predict_fn(checkpoint):
+        if num_results % 1000 == 0:
+          tf.logging.info("Processing example: %d" % (num_results))
         start_top_log_probs = (
             [float(x) for x in result["start_top_log_probs"].flat])
         start_top_index = [int(x) for x in result["start_top_index"].flat]
@@ -396,117 +529,38 @@ def main(_):
         end_top_index = [int(x) for x in result["end_top_index"].flat]
 
         cls_logits = float(result["cls_logits"].flat[0])
-        all_results.append(
+        prediction_writer.process_result(
             squad_utils.RawResultV2(
-                unique_id=unique_id,
+                unique_id=int(result["unique_ids"]),
                 start_top_log_probs=start_top_log_probs,
                 start_top_index=start_top_index,
                 end_top_log_probs=end_top_log_probs,
                 end_top_index=end_top_index,
                 cls_logits=cls_logits))
+        num_results += 1
+      predictions, na_probs = prediction_writer.close()
+      timings["predict_secs"] = time.time() - start_time
 
-      output_prediction_file = os.path.join(
-          FLAGS.output_dir, "predictions.json")
-      output_nbest_file = os.path.join(
-          FLAGS.output_dir, "nbest_predictions.json")
-      output_null_log_odds_file = os.path.join(
-          FLAGS.output_dir, "null_odds.json")
-
-      result_dict = {}
-      cls_dict = {}
-      squad_utils.accumulate_predictions_v2(
-          result_dict, cls_dict, eval_examples, eval_features,
-          all_results, FLAGS.n_best_size, FLAGS.max_answer_length,
-          FLAGS.start_n_top, FLAGS.end_n_top)
-
-      return squad_utils.evaluate_v2(
-          result_dict, cls_dict, prediction_json, eval_examples,
-          eval_features, all_results, FLAGS.n_best_size,
-          FLAGS.max_answer_length, output_prediction_file, output_nbest_file,
-          output_null_log_odds_file), int(global_step)
-
-    def _find_valid_cands(curr_step):
-      filenames = tf.gfile.ListDirectory(FLAGS.output_dir)
-      candidates = []
-      for filename in filenames:
-        if filename.endswith(".index"):
-          ckpt_name = filename[:-6]
-          idx = ckpt_name.split("-")[-1]
-          if idx != "best" and int(idx) > curr_step:
-            candidates.append(filename)
-      return candidates
+      result = squad_utils.evaluate_v2_predictions(
+          prediction_json, predictions, na_probs, output_prediction_file,
+          metrics=squad_metrics)
+      result.update(timings)
+      return result
 
     output_eval_file = os.path.join(FLAGS.output_dir, "eval_results.txt")
-    checkpoint_path = os.path.join(FLAGS.output_dir, "model.ckpt-best")
     key_name = "f1"
     writer = tf.gfile.GFile(output_eval_file, "w")
-    if tf.gfile.Exists(checkpoint_path + ".index"):
-      result = get_result(checkpoint_path)
-      best_perf = result[0][key_name]
-      global_step = result[1]
-    else:
-      global_step = -1
-      best_perf = -1
-      checkpoint_path = None
-    while global_step < num_train_steps:
-      steps_and_files = {}
-      filenames = tf.gfile.ListDirectory(FLAGS.output_dir)
-      for filename in filenames:
-        if filename.endswith(".index"):
-          ckpt_name = filename[:-6]
-          cur_filename = os.path.join(FLAGS.output_dir, ckpt_name)
-          if cur_filename.split("-")[-1] == "best":
-            continue
-          gstep = int(cur_filename.split("-")[-1])
-          if gstep not in steps_and_files:
-            tf.logging.info("Add {} to eval list.".format(cur_filename))
-            steps_and_files[gstep] = cur_filename
-      tf.logging.info("found {} files.".format(len(steps_and_files)))
-      if not steps_and_files:
-        tf.logging.info("found 0 file, global step: {}. Sleeping."
-                        .format(global_step))
-        time.sleep(60)
-      else:
-        for ele in sorted(steps_and_files.items()):
-          step, checkpoint_path = ele
-          if global_step >= step:
-            if len(_find_valid_cands(step)) > 1:
-              for ext in ["meta", "data-00000-of-00001", "index"]:
-                src_ckpt = checkpoint_path + ".{}".format(ext)
-                tf.logging.info("removing {}".format(src_ckpt))
-                tf.gfile.Remove(src_ckpt)
-            continue
-          result, global_step = get_result(checkpoint_path)
-          tf.logging.info("***** Eval results *****")
-          for key in sorted(result.keys()):
-            tf.logging.info("  %s = %s", key, str(result[key]))
-            writer.write("%s = %s\n" % (key, str(result[key])))
-          if result[key_name] > best_perf:
-            best_perf = result[key_name]
-            for ext in ["meta", "data-00000-of-00001", "index"]:
-              src_ckpt = checkpoint_path + ".{}".format(ext)
-              tgt_ckpt = checkpoint_path.rsplit(
-                  "-", 1)[0] + "-best.{}".format(ext)
-              tf.logging.info("saving {} to {}".format(src_ckpt, tgt_ckpt))
-              tf.gfile.Copy(src_ckpt, tgt_ckpt, overwrite=True)
-              writer.write("saved {} to {}\n".format(src_ckpt, tgt_ckpt))
-          writer.write("best {} = {}\n".format(key_name, best_perf))
-          tf.logging.info("  best {} = {}\n".format(key_name, best_perf))
-
-          if len(_find_valid_cands(global_step)) > 2:
-            for ext in ["meta", "data-00000-of-00001", "index"]:
-              src_ckpt = checkpoint_path + ".{}".format(ext)
-              tf.logging.info("removing {}".format(src_ckpt))
-              tf.gfile.Remove(src_ckpt)
-          writer.write("=" * 50 + "\n")
+    _, best_global_step = eval_utils.evaluate_checkpoints(
+        FLAGS.output_dir, [get_result], key_name, num_train_steps, writer)
 
     checkpoint_path = os.path.join(FLAGS.output_dir, "model.ckpt-best")
-    result, global_step = get_result(checkpoint_path)
+    result = get_result(checkpoint_path)
     tf.logging.info("***** Final Eval results *****")
     for key in sorted(result.keys()):
       tf.logging.info("  %s = %s", key, str(result[key]))
       writer.write("%s = %s\n" % (key, str(result[key])))
-    writer.write("best perf happened at step: {}".format(global_step))
+    writer.write("best perf happened at step: {}".format(best_global_step))
+    writer.close()
 
 
 if __name__ == "__main__":
@@ -56,6 +56,11 @@ RawResultV2 = collections.namedtuple(
     ["unique_id", "start_top_log_probs", "start_top_index",
      "end_top_log_probs", "end_top_index", "cls_logits"])
 
+# Features padded to `max_seq_length` in the TFRecords, and the width of the
+# length buckets used when batching them by length.
+_SEQUENCE_FEATURES = ("input_ids", "input_mask", "segment_ids", "p_mask")
+_BUCKET_WIDTH = 64
+
 
 class SquadExample(object):
   """A single training/test example for simple sequence classification.
@@ -575,14 +580,28 @@ def _check_is_max_context(doc_spans, cur_span_index, position):
 
 
 def _get_best_indexes(logits, n_best_size):
-  """Get the n-best logits from a list."""
-  index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
+  """Get the n-best indexes of every row of a [num_rows, seq_length] array.
 
-  best_indexes = []
-  for i in range(len(index_and_score)):
-    if i >= n_best_size:
-      break
-    best_indexes.append(index_and_score[i][0])
+  Ties are broken towards the lower index, so the result is identical to a
+  stable descending sort of each row truncated to `n_best_size`.
+  """
+  logits = np.asarray(logits)
+  seq_length = logits.shape[1]
+  k = min(n_best_size, seq_length)
+  if k == seq_length:
+    return np.argsort(-logits, axis=1, kind="stable")
+
+  cand = np.sort(np.argpartition(-logits, k - 1, axis=1)[:, :k], axis=1)
+  cand_logits = np.take_along_axis(logits, cand, axis=1)
+  order = np.argsort(-cand_logits, axis=1, kind="stable")
+  best_indexes = np.take_along_axis(cand, order, axis=1)
+
+  # `argpartition` picks an arbitrary subset when several positions tie with
+  # the k-th best score, so fall back to a full sort for those (rare) rows.
+  kth_logits = cand_logits.min(axis=1)
+  num_ge_kth = np.sum(logits >= kth_logits[:, None], axis=1)
+  for row in np.flatnonzero(num_ge_kth > k):
+    best_indexes[row] = np.argsort(-logits[row], kind="stable")[:k]
   return best_indexes
 
 
@@ -650,8 +669,17 @@ class FeatureWriter(object):
 
 
 def input_fn_builder(input_file, seq_length, is_training,
-                     drop_remainder, use_tpu, bsz, is_v2):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
+                     drop_remainder, use_tpu, bsz, is_v2,
+                     bucket_by_length=False):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  With `bucket_by_length` the padding of the features is stripped and they
+  are batched with features of similar length, each batch being padded to
+  its longest feature only. The features then come out of order, so a
+  `StreamingPredictionWriter` may hold many results before it can write them.
+  The TPU needs static shapes, so features are always padded to `seq_length`
+  there.
+  """
 
   name_to_features = {
       "unique_ids": tf.FixedLenFeature([], tf.int64),
@@ -682,6 +710,14 @@ def input_fn_builder(input_file, seq_length, is_training,
 
     return example
 
+  def _strip_padding(example):
+    """Strips the padding of the sequence features."""
+    length = tf.reduce_sum(example["input_mask"])
+    for name in _SEQUENCE_FEATURES:
+      if name in example:
+        example[name] = example[name][:length]
+    return example
+
   def input_fn(params):
     """The actual input function."""
     if use_tpu:
@@ -696,6 +732,24 @@ def input_fn_builder(input_file, seq_length, is_training,
       d = d.repeat()
       d = d.shuffle(buffer_size=100)
 
+    if bucket_by_length and not use_tpu:
+      d = d.map(lambda record: _strip_padding(
+          _decode_record(record, name_to_features)))
+      bucket_boundaries = list(
+          range(_BUCKET_WIDTH, seq_length, _BUCKET_WIDTH))
+      # Padded positions are masked out of p_mask, everything else pads to 0.
+      padding_values = {name: 0 for name in name_to_features}
+      if is_v2:
+        padding_values["p_mask"] = 1
+      d = d.apply(
+          tf.data.experimental.bucket_by_sequence_length(
+              lambda example: tf.shape(example["input_ids"])[0],
+              bucket_boundaries,
+              [batch_size] * (len(bucket_boundaries) + 1),
+              padding_values=padding_values,
+              drop_remainder=drop_remainder))
+      return d
+
     d = d.apply(
         contrib_data.map_and_batch(
             lambda record: _decode_record(record, name_to_features),
@@ -865,49 +919,167 @@ def accumulate_predictions_v1(result_dict, all_examples, all_features,
   for result in all_results:
     unique_id_to_result[result.unique_id] = result
 
-  all_predictions = collections.OrderedDict()
-  all_nbest_json = collections.OrderedDict()
-  scores_diff_json = collections.OrderedDict()
-
+  features = []
   for (example_index, example) in enumerate(all_examples):
     if example_index not in result_dict:
       result_dict[example_index] = {}
-    features = example_index_to_features[example_index]
+    features.extend(example_index_to_features[example_index])
+
+  _accumulate_features_v1(result_dict, features, unique_id_to_result,
+                          n_best_size, max_answer_length)
+
+
+def _stack_log_probs(log_probs):
+  """Stacks per-feature logits, which differ in length when bucketed."""
+  seq_length = max(len(x) for x in log_probs)
+  stacked = np.full([len(log_probs), seq_length], -np.inf)
+  for (i, x) in enumerate(log_probs):
+    stacked[i, :len(x)] = x
+  return stacked
+
+
+def _accumulate_features_v1(result_dict, features, unique_id_to_result,
+                            n_best_size, max_answer_length):
+  """Accumulates the valid n-best spans of a batch of features."""
+  for feature in features:
+    if feature.unique_id not in result_dict[feature.example_index]:
+      result_dict[feature.example_index][feature.unique_id] = {}
+  if not features:
+    return
+
+  start_log_probs = _stack_log_probs(
+      [unique_id_to_result[f.unique_id].start_log_prob for f in features])
+  end_log_probs = _stack_log_probs(
+      [unique_id_to_result[f.unique_id].end_log_prob for f in features])
+  seq_length = start_log_probs.shape[1]
+
+  # Per-feature validity information as [num_features, ...] arrays.
+  doc_offset = np.array([f.tokens.index("[SEP]") + 1 for f in features])
+  doc_end = doc_offset + np.array(
+      [len(f.tok_start_to_orig_index) for f in features])
+  is_max_context = np.zeros([len(features), seq_length], dtype=np.bool_)
+  for (feature_index, feature) in enumerate(features):
+    for (position, value) in six.iteritems(feature.token_is_max_context):
+      if value and position < seq_length:
+        is_max_context[feature_index, position] = True
+
+  start_indexes = _get_best_indexes(start_log_probs, n_best_size)
+  end_indexes = _get_best_indexes(end_log_probs, n_best_size)
+
+  # [num_features, n_best_size, n_best_size] grid of candidate spans.
+  start_grid = start_indexes[:, :, None]
+  end_grid = end_indexes[:, None, :]
+  # We could hypothetically create invalid predictions, e.g., predict
+  # that the start of the span is in the question. We throw out all
+  # invalid predictions.
+  valid = ((start_grid < doc_end[:, None, None]) &
+           (end_grid < doc_end[:, None, None]) &
+           np.take_along_axis(is_max_context, start_indexes,
+                              axis=1)[:, :, None] &
+           (end_grid >= start_grid) &
+           (end_grid - start_grid + 1 <= max_answer_length))
+
+  # `np.nonzero` walks the grid in row-major order, so candidates are
+  # accumulated in the same order as the nested start/end loops did.
+  for (feature_index, i, j) in zip(*np.nonzero(valid)):
+    feature = features[feature_index]
+    start_index = start_indexes[feature_index, i]
+    end_index = end_indexes[feature_index, j]
+    start_log_prob = float(start_log_probs[feature_index, start_index])
+    end_log_prob = float(end_log_probs[feature_index, end_index])
+    start_idx = int(start_index - doc_offset[feature_index])
+    end_idx = int(end_index - doc_offset[feature_index])
+    feature_dict = result_dict[feature.example_index][feature.unique_id]
+    if (start_idx, end_idx) not in feature_dict:
+      feature_dict[(start_idx, end_idx)] = []
+    feature_dict[(start_idx, end_idx)].append((start_log_prob, end_log_prob))
+
+
+def _get_prelim_predictions(example_result_dict, features):
+  """Averages the accumulated log-probs of every span of an example."""
+  prelim_predictions = []
+  for (feature_index, feature) in enumerate(features):
+    for ((start_idx, end_idx), logprobs) in \
+      example_result_dict[feature.unique_id].items():
+      start_log_prob = 0
+      end_log_prob = 0
+      for logprob in logprobs:
+        start_log_prob += logprob[0]
+        end_log_prob += logprob[1]
+      prelim_predictions.append(
+          _PrelimPrediction(
+              feature_index=feature_index,
+              start_index=start_idx,
+              end_index=end_idx,
+              start_log_prob=start_log_prob / len(logprobs),
+              end_log_prob=end_log_prob / len(logprobs)))
+
+  return sorted(
+      prelim_predictions,
+      key=lambda x: (x.start_log_prob + x.end_log_prob),
+      reverse=True)
+
+
+def _get_nbest_json(nbest):
+  """Converts a list of `_NbestPrediction` into json-serializable dicts."""
+  total_scores = []
+  for entry in nbest:
+    total_scores.append(entry.start_log_prob + entry.end_log_prob)
+
+  probs = _compute_softmax(total_scores)
+
+  nbest_json = []
+  for (i, entry) in enumerate(nbest):
+    output = collections.OrderedDict()
+    output["text"] = entry.text
+    output["probability"] = probs[i]
+    output["start_log_prob"] = entry.start_log_prob
+    output["end_log_prob"] = entry.end_log_prob
+    nbest_json.append(output)
+
+  assert len(nbest_json) >= 1
+  return nbest_json
+
+
+def _compute_nbest_v1(example, features, example_result_dict, n_best_size):
+  """Computes the n-best json entries of a single SQuAD v1.1 example."""
+  prelim_predictions = _get_prelim_predictions(example_result_dict, features)
+
+  seen_predictions = {}
+  nbest = []
+  for pred in prelim_predictions:
+    if len(nbest) >= n_best_size:
+      break
+    feature = features[pred.feature_index]
+    if pred.start_index >= 0:  # this is a non-null prediction
+      tok_start_to_orig_index = feature.tok_start_to_orig_index
+      tok_end_to_orig_index = feature.tok_end_to_orig_index
+      start_orig_pos = tok_start_to_orig_index[pred.start_index]
+      end_orig_pos = tok_end_to_orig_index[pred.end_index]
+
+      paragraph_text = example.paragraph_text
+      final_text = paragraph_text[start_orig_pos: end_orig_pos + 1].strip()
+      if final_text in seen_predictions:
+        continue
+
+      seen_predictions[final_text] = True
+    else:
+      final_text = ""
+      seen_predictions[final_text] = True
+
+    nbest.append(
+        _NbestPrediction(
+            text=final_text,
+            start_log_prob=pred.start_log_prob,
+            end_log_prob=pred.end_log_prob))
 
-    prelim_predictions = []
-    min_null_feature_index = 0  # the paragraph slice with min mull score
-    null_start_logit = 0  # the start logit at the slice with min null score
-    null_end_logit = 0  # the end logit at the slice with min null score
-    for (feature_index, feature) in enumerate(features):
-      if feature.unique_id not in result_dict[example_index]:
-        result_dict[example_index][feature.unique_id] = {}
-      result = unique_id_to_result[feature.unique_id]
-      start_indexes = _get_best_indexes(result.start_log_prob, n_best_size)
-      end_indexes = _get_best_indexes(result.end_log_prob, n_best_size)
-      for start_index in start_indexes:
-        for end_index in end_indexes:
-          doc_offset = feature.tokens.index("[SEP]") + 1
-          # We could hypothetically create invalid predictions, e.g., predict
-          # that the start of the span is in the question. We throw out all
-          # invalid predictions.
-          if start_index - doc_offset >= len(feature.tok_start_to_orig_index):
-            continue
-          if end_index - doc_offset >= len(feature.tok_end_to_orig_index):
-            continue
-          if not feature.token_is_max_context.get(start_index, False):
-            continue
-          if end_index < start_index:
-            continue
-          length = end_index - start_index + 1
-          if length > max_answer_length:
-            continue
-          start_log_prob = result.start_log_prob[start_index]
-          end_log_prob = result.end_log_prob[end_index]
-          start_idx = start_index - doc_offset
-          end_idx = end_index - doc_offset
-          if (start_idx, end_idx) not in result_dict[example_index][feature.unique_id]:
-            result_dict[example_index][feature.unique_id][(start_idx, end_idx)] = []
-          result_dict[example_index][feature.unique_id][(start_idx, end_idx)].append((start_log_prob, end_log_prob))
+  # In very rare edge cases we could have no valid predictions. So we
+  # just create a nonce prediction in this case to avoid failure.
+  if not nbest:
+    nbest.append(
+        _NbestPrediction(text="empty", start_log_prob=0.0, end_log_prob=0.0))
+
+  return _get_nbest_json(nbest)
 
 
 def write_predictions_v1(result_dict, all_examples, all_features,
@@ -921,100 +1093,13 @@ def write_predictions_v1(result_dict, all_examples, all_features,
   for feature in all_features:
     example_index_to_features[feature.example_index].append(feature)
 
-  unique_id_to_result = {}
-  for result in all_results:
-    unique_id_to_result[result.unique_id] = result
-
   all_predictions = collections.OrderedDict()
   all_nbest_json = collections.OrderedDict()
-  scores_diff_json = collections.OrderedDict()
 
   for (example_index, example) in enumerate(all_examples):
     features = example_index_to_features[example_index]
-
-    prelim_predictions = []
-    # keep track of the minimum score of null start+end of position 0
-    score_null = 1000000  # large and positive
-    min_null_feature_index = 0  # the paragraph slice with min mull score
-    null_start_logit = 0  # the start logit at the slice with min null score
-    null_end_logit = 0  # the end logit at the slice with min null score
-    for (feature_index, feature) in enumerate(features):
-      for ((start_idx, end_idx), logprobs) in \
-        result_dict[example_index][feature.unique_id].items():
-        start_log_prob = 0
-        end_log_prob = 0
-        for logprob in logprobs:
-          start_log_prob += logprob[0]
-          end_log_prob += logprob[1]
-        prelim_predictions.append(
-            _PrelimPrediction(
-                feature_index=feature_index,
-                start_index=start_idx,
-                end_index=end_idx,
-                start_log_prob=start_log_prob / len(logprobs),
-                end_log_prob=end_log_prob / len(logprobs)))
-
-    prelim_predictions = sorted(
-        prelim_predictions,
-        key=lambda x: (x.start_log_prob + x.end_log_prob),
-        reverse=True)
-
-    seen_predictions = {}
-    nbest = []
-    for pred in prelim_predictions:
-      if len(nbest) >= n_best_size:
-        break
-      feature = features[pred.feature_index]
-      if pred.start_index >= 0:  # this is a non-null prediction
-        tok_start_to_orig_index = feature.tok_start_to_orig_index
-        tok_end_to_orig_index = feature.tok_end_to_orig_index
-        start_orig_pos = tok_start_to_orig_index[pred.start_index]
-        end_orig_pos = tok_end_to_orig_index[pred.end_index]
-
-        paragraph_text = example.paragraph_text
-        final_text = paragraph_text[start_orig_pos: end_orig_pos + 1].strip()
-        if final_text in seen_predictions:
-          continue
-
-        seen_predictions[final_text] = True
-      else:
-        final_text = ""
-        seen_predictions[final_text] = True
-
-      nbest.append(
-          _NbestPrediction(
-              text=final_text,
-              start_log_prob=pred.start_log_prob,
-              end_log_prob=pred.end_log_prob))
-
-    # In very rare edge cases we could have no valid predictions. So we
-    # just create a nonce prediction in this case to avoid failure.
-    if not nbest:
-      nbest.append(
-          _NbestPrediction(text="empty", start_log_prob=0.0, end_log_prob=0.0))
-
-    assert len(nbest) >= 1
-
-    total_scores = []
-    best_non_null_entry = None
-    for entry in nbest:
-      total_scores.append(entry.start_log_prob + entry.end_log_prob)
-      if not best_non_null_entry:
-        if entry.text:
-          best_non_null_entry = entry
-
-    probs = _compute_softmax(total_scores)
-
-    nbest_json = []
-    for (i, entry) in enumerate(nbest):
-      output = collections.OrderedDict()
-      output["text"] = entry.text
-      output["probability"] = probs[i]
-      output["start_log_prob"] = entry.start_log_prob
-      output["end_log_prob"] = entry.end_log_prob
-      nbest_json.append(output)
-
-    assert len(nbest_json) >= 1
+    nbest_json = _compute_nbest_v1(example, features,
+                                   result_dict[example_index], n_best_size)
 
     all_predictions[example.qas_id] = nbest_json[0]["text"]
     all_nbest_json[example.qas_id] = nbest_json
@@ -1229,6 +1314,156 @@ def merge_eval(main_eval, new_eval, prefix):
 
 ####### above are from official SQuAD v2.0 evaluation scripts
 
+class SquadV2Metrics(object):
+  """Batched SQuAD v2.0 metrics over a fixed evaluation dataset.
+
+  Gold answers are normalized and mapped to token ids once, and predictions
+  are cached by text, so scoring the predictions of every new checkpoint only
+  normalizes answers that were not seen before. Scores and thresholds are
+  identical to the ones of the official evaluation script above.
+  """
+
+  def __init__(self, dataset):
+    self.qid_to_has_ans = make_qid_to_has_ans(dataset)
+    self.qids = []
+    self._token_to_id = {}
+    self._answer_to_id = {}
+    self._prediction_cache = {}
+
+    gold_starts, gold_answer_ids, gold_lens = [], [], []
+    bag_gold, bag_tokens, bag_counts = [], [], []
+    for article in dataset:
+      for p in article['paragraphs']:
+        for qa in p['qas']:
+          self.qids.append(qa['id'])
+          gold_starts.append(len(gold_answer_ids))
+          gold_answers = [normalize_answer_v2(a['text']) for a in qa['answers']]
+          # For unanswerable questions, only correct answer is empty string
+          gold_answers = [a for a in gold_answers if a] or ['']
+          for answer in gold_answers:
+            answer_id, tokens, counts = self._encode(answer)
+            bag_gold.extend([len(gold_answer_ids)] * len(tokens))
+            bag_tokens.extend(tokens)
+            bag_counts.extend(counts)
+            gold_answer_ids.append(answer_id)
+            gold_lens.append(sum(counts))
+
+    self._gold_starts = np.array(gold_starts, dtype=np.int64)
+    self._gold_answer_ids = np.array(gold_answer_ids, dtype=np.int64)
+    self._gold_lens = np.array(gold_lens, dtype=np.int64)
+    self._gold_questions = np.repeat(
+        np.arange(len(self.qids)),
+        np.diff(np.append(self._gold_starts, len(gold_answer_ids))))
+    self._bag_gold = np.array(bag_gold, dtype=np.int64)
+    self._bag_tokens = np.array(bag_tokens, dtype=np.int64)
+    self._bag_counts = np.array(bag_counts, dtype=np.int64)
+
+    # An empty prediction is only correct if there is no (non-empty) answer.
+    empty_id = self._encode('')[0]
+    self.null_scores = dict(zip(self.qids, (
+        self._gold_answer_ids[self._gold_starts] == empty_id).astype(
+            np.int64).tolist()))
+
+  def _encode(self, normalized_answer):
+    """Maps a normalized answer to its id and bag of token ids."""
+    answer_id = self._answer_to_id.setdefault(
+        normalized_answer, len(self._answer_to_id))
+    counter = collections.Counter(
+        self._token_to_id.setdefault(token, len(self._token_to_id))
+        for token in normalized_answer.split())
+    return answer_id, list(counter.keys()), list(counter.values())
+
+  def _encode_prediction(self, prediction):
+    if prediction not in self._prediction_cache:
+      self._prediction_cache[prediction] = self._encode(
+          normalize_answer_v2(prediction))
+    return self._prediction_cache[prediction]
+
+  def get_raw_scores(self, preds):
+    """Computes the exact and f1 scores of all predictions in a batch."""
+    has_pred = np.zeros([len(self.qids)], dtype=np.bool_)
+    pred_answer_ids = np.full([len(self.qids)], -1, dtype=np.int64)
+    pred_lens = np.zeros([len(self.qids)], dtype=np.int64)
+    bag_questions, bag_tokens, bag_counts = [], [], []
+    for (question_index, qid) in enumerate(self.qids):
+      if qid not in preds:
+        print('Missing prediction for %s' % qid)
+        continue
+      answer_id, tokens, counts = self._encode_prediction(preds[qid])
+      has_pred[question_index] = True
+      pred_answer_ids[question_index] = answer_id
+      pred_lens[question_index] = sum(counts)
+      bag_questions.extend([question_index] * len(tokens))
+      bag_tokens.extend(tokens)
+      bag_counts.extend(counts)
+
+    # Look up the predicted count of every gold (question, token) pair.
+    vocab_size = len(self._token_to_id)
+    pred_keys = (np.array(bag_questions, dtype=np.int64) * vocab_size +
+                 np.array(bag_tokens, dtype=np.int64))
+    pred_order = np.argsort(pred_keys)
+    # A trailing sentinel keeps every lookup position in range.
+    pred_keys = np.append(pred_keys[pred_order], np.iinfo(np.int64).max)
+    pred_counts = np.append(
+        np.array(bag_counts, dtype=np.int64)[pred_order], 0)
+    gold_keys = (self._gold_questions[self._bag_gold] * vocab_size +
+                 self._bag_tokens)
+    positions = np.searchsorted(pred_keys, gold_keys)
+    common = np.where(pred_keys[positions] == gold_keys,
+                      np.minimum(self._bag_counts, pred_counts[positions]), 0)
+    num_same = np.bincount(self._bag_gold, weights=common,
+                           minlength=len(self._gold_answer_ids))
+
+    # Per gold answer scores, following `compute_exact` and `compute_f1`.
+    gold_pred_lens = pred_lens[self._gold_questions]
+    exact = (self._gold_answer_ids ==
+             pred_answer_ids[self._gold_questions]).astype(np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      precision = 1.0 * num_same / gold_pred_lens
+      recall = 1.0 * num_same / self._gold_lens
+      f1 = (2 * precision * recall) / (precision + recall)
+    f1 = np.where(num_same == 0, 0.0, f1)
+    # If either is no-answer, then F1 is 1 if they agree, 0 otherwise
+    f1 = np.where((self._gold_lens == 0) | (gold_pred_lens == 0),
+                  ((self._gold_lens == 0) & (gold_pred_lens == 0)).astype(
+                      np.float64), f1)
+
+    # Take max over all gold answers
+    exact = np.maximum.reduceat(exact, self._gold_starts).tolist()
+    f1 = np.maximum.reduceat(f1, self._gold_starts).tolist()
+    exact_scores = {}
+    f1_scores = {}
+    for question_index in np.flatnonzero(has_pred):
+      qid = self.qids[question_index]
+      exact_scores[qid] = exact[question_index]
+      f1_scores[qid] = f1[question_index]
+    return exact_scores, f1_scores
+
+  def find_best_thresh(self, preds, scores, na_probs):
+    """Sweeps the null threshold with a sorted cumulative sum."""
+    qid_list = list(na_probs)
+    diffs = [0.0] * len(qid_list)
+    for (i, qid) in enumerate(qid_list):
+      if qid not in scores:
+        continue
+      if self.qid_to_has_ans[qid]:
+        diffs[i] = scores[qid]
+      elif preds[qid]:
+        diffs[i] = -1
+    na_values = np.array([na_probs[qid] for qid in qid_list], dtype=np.float64)
+    order = np.argsort(na_values, kind='stable')
+
+    num_no_ans = sum(1 for k in self.qid_to_has_ans
+                     if not self.qid_to_has_ans[k])
+    # The first entry is the score when every question is predicted null.
+    cur_scores = np.cumsum(
+        np.concatenate([[num_no_ans], np.array(diffs)[order]]))
+    best_index = int(np.argmax(cur_scores))
+    best_thresh = 0.0 if best_index == 0 else float(
+        na_values[order[best_index - 1]])
+    return 100.0 * cur_scores[best_index] / len(scores), best_thresh
+
+
 def accumulate_predictions_v2(result_dict, cls_dict, all_examples,
                               all_features, all_results, n_best_size,
                               max_answer_length, start_n_top, end_n_top):
@@ -1242,62 +1477,118 @@ def accumulate_predictions_v2(result_dict, cls_dict, all_examples,
   for result in all_results:
     unique_id_to_result[result.unique_id] = result
 
-  all_predictions = collections.OrderedDict()
-  all_nbest_json = collections.OrderedDict()
-  scores_diff_json = collections.OrderedDict()
-
   for (example_index, example) in enumerate(all_examples):
-    if example_index not in result_dict:
-      result_dict[example_index] = {}
-    features = example_index_to_features[example_index]
+    _accumulate_example_v2(
+        result_dict, cls_dict, example_index,
+        example_index_to_features[example_index], unique_id_to_result,
+        max_answer_length, start_n_top, end_n_top)
+
+
+def _accumulate_example_v2(result_dict, cls_dict, example_index, features,
+                           unique_id_to_result, max_answer_length,
+                           start_n_top, end_n_top):
+  """Accumulates the valid beam-search spans of a single example."""
+  if example_index not in result_dict:
+    result_dict[example_index] = {}
+
+  # keep track of the minimum score of null start+end of position 0
+  score_null = 1000000  # large and positive
+
+  for feature in features:
+    if feature.unique_id not in result_dict[example_index]:
+      result_dict[example_index][feature.unique_id] = {}
+    result = unique_id_to_result[feature.unique_id]
+    cur_null_score = result.cls_logits
+
+    # if we could have irrelevant answers, get the min score of irrelevant
+    score_null = min(score_null, cur_null_score)
+
+    doc_offset = feature.tokens.index("[SEP]") + 1
+    for i in range(start_n_top):
+      for j in range(end_n_top):
+        start_log_prob = result.start_top_log_probs[i]
+        start_index = result.start_top_index[i]
+
+        j_index = i * end_n_top + j
+
+        end_log_prob = result.end_top_log_probs[j_index]
+        end_index = result.end_top_index[j_index]
+        # We could hypothetically create invalid predictions, e.g., predict
+        # that the start of the span is in the question. We throw out all
+        # invalid predictions.
+        if start_index - doc_offset >= len(feature.tok_start_to_orig_index):
+          continue
+        if start_index - doc_offset < 0:
+          continue
+        if end_index - doc_offset >= len(feature.tok_end_to_orig_index):
+          continue
+        if not feature.token_is_max_context.get(start_index, False):
+          continue
+        if end_index < start_index:
+          continue
+        length = end_index - start_index + 1
+        if length > max_answer_length:
+          continue
+        start_idx = start_index - doc_offset
+        end_idx = end_index - doc_offset
+        if (start_idx, end_idx) not in result_dict[example_index][feature.unique_id]:
+          result_dict[example_index][feature.unique_id][(start_idx, end_idx)] = []
+        result_dict[example_index][feature.unique_id][(start_idx, end_idx)].append((start_log_prob, end_log_prob))
+  if example_index not in cls_dict:
+    cls_dict[example_index] = []
+  cls_dict[example_index].append(score_null)
+
+
+def _compute_nbest_v2(example, features, example_result_dict, example_cls,
+                      n_best_size):
+  """Computes the n-best entries and null score of a SQuAD v2.0 example.
+
+  Returns:
+    A tuple of the n-best json entries, the text of the best non-null answer
+    and the null score difference of the example.
+  """
+  prelim_predictions = _get_prelim_predictions(example_result_dict, features)
+
+  seen_predictions = {}
+  nbest = []
+  for pred in prelim_predictions:
+    if len(nbest) >= n_best_size:
+      break
+    feature = features[pred.feature_index]
+
+    tok_start_to_orig_index = feature.tok_start_to_orig_index
+    tok_end_to_orig_index = feature.tok_end_to_orig_index
+    start_orig_pos = tok_start_to_orig_index[pred.start_index]
+    end_orig_pos = tok_end_to_orig_index[pred.end_index]
+
+    paragraph_text = example.paragraph_text
+    final_text = paragraph_text[start_orig_pos: end_orig_pos + 1].strip()
+
+    if final_text in seen_predictions:
+      continue
+
+    seen_predictions[final_text] = True
+
+    nbest.append(
+        _NbestPrediction(
+            text=final_text,
+            start_log_prob=pred.start_log_prob,
+            end_log_prob=pred.end_log_prob))
+
+  # In very rare edge cases we could have no valid predictions. So we
+  # just create a nonce prediction in this case to avoid failure.
+  if not nbest:
+    nbest.append(
+        _NbestPrediction(
+            text="",
+            start_log_prob=-1e6,
+            end_log_prob=-1e6))
+
+  best_non_null_entry = nbest[0]
+  nbest_json = _get_nbest_json(nbest)
 
-    prelim_predictions = []
-    # keep track of the minimum score of null start+end of position 0
-    score_null = 1000000  # large and positive
-
-    for (feature_index, feature) in enumerate(features):
-      if feature.unique_id not in result_dict[example_index]:
-        result_dict[example_index][feature.unique_id] = {}
-      result = unique_id_to_result[feature.unique_id]
-      cur_null_score = result.cls_logits
-
-      # if we could have irrelevant answers, get the min score of irrelevant
-      score_null = min(score_null, cur_null_score)
-
-      doc_offset = feature.tokens.index("[SEP]") + 1
-      for i in range(start_n_top):
-        for j in range(end_n_top):
-          start_log_prob = result.start_top_log_probs[i]
-          start_index = result.start_top_index[i]
-
-          j_index = i * end_n_top + j
-
-          end_log_prob = result.end_top_log_probs[j_index]
-          end_index = result.end_top_index[j_index]
-          # We could hypothetically create invalid predictions, e.g., predict
-          # that the start of the span is in the question. We throw out all
-          # invalid predictions.
-          if start_index - doc_offset >= len(feature.tok_start_to_orig_index):
-            continue
-          if start_index - doc_offset < 0:
-            continue
-          if end_index - doc_offset >= len(feature.tok_end_to_orig_index):
-            continue
-          if not feature.token_is_max_context.get(start_index, False):
-            continue
-          if end_index < start_index:
-            continue
-          length = end_index - start_index + 1
-          if length > max_answer_length:
-            continue
-          start_idx = start_index - doc_offset
-          end_idx = end_index - doc_offset
-          if (start_idx, end_idx) not in result_dict[example_index][feature.unique_id]:
-            result_dict[example_index][feature.unique_id][(start_idx, end_idx)] = []
-          result_dict[example_index][feature.unique_id][(start_idx, end_idx)].append((start_log_prob, end_log_prob))
-    if example_index not in cls_dict:
-      cls_dict[example_index] = []
-    cls_dict[example_index].append(score_null)
+  score_diff = sum(example_cls) / len(example_cls)
+  return nbest_json, best_non_null_entry.text, score_diff
 
 
 def write_predictions_v2(result_dict, cls_dict, all_examples, all_features,
@@ -1305,119 +1596,40 @@ def write_predictions_v2(result_dict, cls_dict, all_examples, all_features,
                          output_prediction_file,
                          output_nbest_file, output_null_log_odds_file,
                          null_score_diff_threshold):
-  """Write final predictions to the json file and log-odds of null if needed."""
-  tf.logging.info("Writing predictions to: %s" % (output_prediction_file))
+  """Write final predictions to the json file and log-odds of null if needed.
+
+  Writing the predictions is skipped if `output_prediction_file` is None.
+  """
+  if output_prediction_file is not None:
+    tf.logging.info("Writing predictions to: %s" % (output_prediction_file))
   tf.logging.info("Writing nbest to: %s" % (output_nbest_file))
 
   example_index_to_features = collections.defaultdict(list)
   for feature in all_features:
     example_index_to_features[feature.example_index].append(feature)
 
-  unique_id_to_result = {}
-  for result in all_results:
-    unique_id_to_result[result.unique_id] = result
-
   all_predictions = collections.OrderedDict()
   all_nbest_json = collections.OrderedDict()
   scores_diff_json = collections.OrderedDict()
 
   for (example_index, example) in enumerate(all_examples):
     features = example_index_to_features[example_index]
+    nbest_json, best_text, score_diff = _compute_nbest_v2(
+        example, features, result_dict[example_index],
+        cls_dict[example_index], n_best_size)
 
-    prelim_predictions = []
-    # keep track of the minimum score of null start+end of position 0
-    # score_null = 1000000  # large and positive
-
-    for (feature_index, feature) in enumerate(features):
-      for ((start_idx, end_idx), logprobs) in \
-        result_dict[example_index][feature.unique_id].items():
-        start_log_prob = 0
-        end_log_prob = 0
-        for logprob in logprobs:
-          start_log_prob += logprob[0]
-          end_log_prob += logprob[1]
-        prelim_predictions.append(
-            _PrelimPrediction(
-                feature_index=feature_index,
-                start_index=start_idx,
-                end_index=end_idx,
-                start_log_prob=start_log_prob / len(logprobs),
-                end_log_prob=end_log_prob / len(logprobs)))
-
-    prelim_predictions = sorted(
-        prelim_predictions,
-        key=lambda x: (x.start_log_prob + x.end_log_prob),
-        reverse=True)
-
-    seen_predictions = {}
-    nbest = []
-    for pred in prelim_predictions:
-      if len(nbest) >= n_best_size:
-        break
-      feature = features[pred.feature_index]
-
-      tok_start_to_orig_index = feature.tok_start_to_orig_index
-      tok_end_to_orig_index = feature.tok_end_to_orig_index
-      start_orig_pos = tok_start_to_orig_index[pred.start_index]
-      end_orig_pos = tok_end_to_orig_index[pred.end_index]
-
-      paragraph_text = example.paragraph_text
-      final_text = paragraph_text[start_orig_pos: end_orig_pos + 1].strip()
-
-      if final_text in seen_predictions:
-        continue
-
-      seen_predictions[final_text] = True
-
-      nbest.append(
-          _NbestPrediction(
-              text=final_text,
-              start_log_prob=pred.start_log_prob,
-              end_log_prob=pred.end_log_prob))
-
-    # In very rare edge cases we could have no valid predictions. So we
-    # just create a nonce prediction in this case to avoid failure.
-    if not nbest:
-      nbest.append(
-          _NbestPrediction(
-              text="",
-              start_log_prob=-1e6,
-              end_log_prob=-1e6))
-
-    total_scores = []
-    best_non_null_entry = None
-    for entry in nbest:
-      total_scores.append(entry.start_log_prob + entry.end_log_prob)
-      if not best_non_null_entry:
-        best_non_null_entry = entry
-
-    probs = _compute_softmax(total_scores)
-
-    nbest_json = []
-    for (i, entry) in enumerate(nbest):
-      output = collections.OrderedDict()
-      output["text"] = entry.text
-      output["probability"] = probs[i]
-      output["start_log_prob"] = entry.start_log_prob
-      output["end_log_prob"] = entry.end_log_prob
-      nbest_json.append(output)
-
-    assert len(nbest_json) >= 1
-    assert best_non_null_entry is not None
-
-    score_diff = sum(cls_dict[example_index]) / len(cls_dict[example_index])
     scores_diff_json[example.qas_id] = score_diff
     # predict null answers when null threshold is provided
     if null_score_diff_threshold is None or score_diff < null_score_diff_threshold:
-      all_predictions[example.qas_id] = best_non_null_entry.text
+      all_predictions[example.qas_id] = best_text
     else:
       all_predictions[example.qas_id] = ""
 
     all_nbest_json[example.qas_id] = nbest_json
-    assert len(nbest_json) >= 1
 
-  with tf.gfile.GFile(output_prediction_file, "w") as writer:
-    writer.write(json.dumps(all_predictions, indent=4) + "\n")
+  if output_prediction_file is not None:
+    with tf.gfile.GFile(output_prediction_file, "w") as writer:
+      writer.write(json.dumps(all_predictions, indent=4) + "\n")
 
   with tf.gfile.GFile(output_nbest_file, "w") as writer:
     writer.write(json.dumps(all_nbest_json, indent=4) + "\n")
@@ -1427,6 +1639,169 @@ def write_predictions_v2(result_dict, cls_dict, all_examples, all_features,
   return all_predictions, scores_diff_json
 
 
+class _JsonDictWriter(object):
+  """Incrementally writes a dict in the layout of `json.dumps(indent=4)`."""
+
+  def __init__(self, filename):
+    self.num_entries = 0
+    self._writer = tf.gfile.GFile(filename, "w")
+
+  def write(self, key, value):
+    prefix = "{\n" if self.num_entries == 0 else ",\n"
+    value = json.dumps(value, indent=4).replace("\n", "\n    ")
+    self._writer.write("%s    %s: %s" % (prefix, json.dumps(key), value))
+    self.num_entries += 1
+
+  def close(self):
+    self._writer.write("{}\n" if self.num_entries == 0 else "\n}\n")
+    self._writer.close()
+
+
+class StreamingPredictionWriter(object):
+  """Writes SQuAD predictions while `estimator.predict` results arrive.
+
+  An example is decoded and written out as soon as the results of all of its
+  features have been processed, so only the results of pending examples are
+  kept in memory. The output files are identical to the ones written by
+  `write_predictions_v1` and `write_predictions_v2` (without threshold).
+  Writing the predictions is skipped if `output_prediction_file` is None.
+  """
+
+  def __init__(self, all_examples, all_features, n_best_size,
+               max_answer_length, output_prediction_file, output_nbest_file,
+               output_null_log_odds_file=None, start_n_top=None,
+               end_n_top=None, is_v2=False):
+    if output_prediction_file is not None:
+      tf.logging.info("Writing predictions to: %s" % (output_prediction_file))
+    tf.logging.info("Writing nbest to: %s" % (output_nbest_file))
+    self.all_examples = all_examples
+    self.n_best_size = n_best_size
+    self.max_answer_length = max_answer_length
+    self.start_n_top = start_n_top
+    self.end_n_top = end_n_top
+    self.is_v2 = is_v2
+
+    self._example_index_to_features = collections.defaultdict(list)
+    self._unique_id_to_feature = {}
+    for feature in all_features:
+      self._example_index_to_features[feature.example_index].append(feature)
+      self._unique_id_to_feature[feature.unique_id] = feature
+
+    self._pending_results = collections.defaultdict(dict)
+    self._next_example_index = 0
+    self._predictions = collections.OrderedDict()
+    self._scores_diff_json = collections.OrderedDict()
+
+    self._prediction_writer = None
+    if output_prediction_file is not None:
+      self._prediction_writer = _JsonDictWriter(output_prediction_file)
+    self._nbest_writer = _JsonDictWriter(output_nbest_file)
+    if is_v2:
+      self._null_odds_writer = _JsonDictWriter(output_null_log_odds_file)
+
+  def process_result(self, result):
+    """Adds a `RawResult` or `RawResultV2` and flushes finished examples."""
+    feature = self._unique_id_to_feature[result.unique_id]
+    self._pending_results[feature.example_index][result.unique_id] = result
+    self._flush()
+
+  def _flush(self):
+    """Writes out the leading examples whose results are all available."""
+    while self._next_example_index < len(self.all_examples):
+      example_index = self._next_example_index
+      features = self._example_index_to_features[example_index]
+      if len(self._pending_results.get(example_index, {})) < len(features):
+        break
+      self._write_example(example_index, features,
+                          self._pending_results.pop(example_index, {}))
+      self._next_example_index += 1
+
+  def _write_example(self, example_index, features, unique_id_to_result):
+    """Decodes a single example whose feature results are all available."""
+    example = self.all_examples[example_index]
+    result_dict = {example_index: {}}
+    if self.is_v2:
+      cls_dict = {}
+      _accumulate_example_v2(
+          result_dict, cls_dict, example_index, features, unique_id_to_result,
+          self.max_answer_length, self.start_n_top, self.end_n_top)
+      nbest_json, best_text, score_diff = _compute_nbest_v2(
+          example, features, result_dict[example_index],
+          cls_dict[example_index], self.n_best_size)
+      self._scores_diff_json[example.qas_id] = score_diff
+      self._null_odds_writer.write(example.qas_id, score_diff)
+    else:
+      _accumulate_features_v1(result_dict, features, unique_id_to_result,
+                              self.n_best_size, self.max_answer_length)
+      nbest_json = _compute_nbest_v1(example, features,
+                                     result_dict[example_index],
+                                     self.n_best_size)
+      best_text = nbest_json[0]["text"]
+    self._predictions[example.qas_id] = best_text
+    if self._prediction_writer is not None:
+      self._prediction_writer.write(example.qas_id, best_text)
+    self._nbest_writer.write(example.qas_id, nbest_json)
+
+  def close(self):
+    """Closes the output files and returns the predictions.
+
+    Returns:
+      The predictions for SQuAD v1.1, or a tuple of the (non-null)
+      predictions and the null score differences for SQuAD v2.0.
+    """
+    # Trailing examples without any feature never receive a result.
+    self._flush()
+    if self._next_example_index < len(self.all_examples):
+      raise ValueError(
+          "Missing results for %d examples." %
+          (len(self.all_examples) - self._next_example_index))
+
+    if self._prediction_writer is not None:
+      self._prediction_writer.close()
+    self._nbest_writer.close()
+    if self.is_v2:
+      self._null_odds_writer.close()
+      return self._predictions, self._scores_diff_json
+    return self._predictions
+
+
+def select_top_spans(all_features, unique_id_to_cls_logits, top_k):
+  """Keeps the `top_k` doc spans of each example most likely to hold answers.
+
+  `cls_logits` scores the absence of an answer, so the spans with the lowest
+  ones are kept. The features keep their original order.
+  """
+  example_index_to_features = collections.defaultdict(list)
+  for feature in all_features:
+    example_index_to_features[feature.example_index].append(feature)
+
+  kept_unique_ids = set()
+  for features in six.itervalues(example_index_to_features):
+    ranked = sorted(
+        features, key=lambda f: unique_id_to_cls_logits[f.unique_id])
+    kept_unique_ids.update(f.unique_id for f in ranked[:top_k])
+  return [f for f in all_features if f.unique_id in kept_unique_ids]
+
+
+def _gather_positions(output, positions, seq_length, use_one_hot):
+  """Gathers the [seq, batch, hidden] `output` at [batch(, k)] `positions`.
+
+  With `use_one_hot` the positions are selected by contracting with one-hot
+  matrices, which is faster on TPU; otherwise they are gathered directly.
+  """
+  if use_one_hot:
+    index = tf.one_hot(positions, depth=seq_length, axis=-1,
+                       dtype=tf.float32)
+    if positions.shape.ndims == 1:
+      return tf.einsum("lbh,bl->bh", output, index)
+    return tf.einsum("lbh,bkl->bkh", output, index)
+
+  batch_index = tf.range(tf.shape(positions)[0], dtype=positions.dtype)
+  if positions.shape.ndims == 2:
+    batch_index = tf.tile(batch_index[:, None], [1, tf.shape(positions)[1]])
+  return tf.gather_nd(output, tf.stack([positions, batch_index], axis=-1))
+
+
 def create_v2_model(albert_config, is_training, input_ids, input_mask,
                     segment_ids, use_one_hot_embeddings, features,
                     max_seq_length, start_n_top, end_n_top, dropout_prob,
@@ -1445,6 +1820,8 @@ def create_v2_model(albert_config, is_training, input_ids, input_mask,
   bsz = tf.shape(output)[0]
   return_dict = {}
   output = tf.transpose(output, [1, 0, 2])
+  # Batches bucketed by length are shorter than `max_seq_length`.
+  seq_length = modeling.get_shape_list(output, expected_rank=3)[0]
 
   # invalid position mask such as query and special symbols (PAD, SEP, CLS)
   p_mask = tf.cast(features["p_mask"], dtype=tf.float32)
@@ -1466,10 +1843,9 @@ def create_v2_model(albert_config, is_training, input_ids, input_mask,
       # during training, compute the end logits based on the
       # ground truth of the start position
       start_positions = tf.reshape(features["start_positions"], [-1])
-      start_index = tf.one_hot(start_positions, depth=max_seq_length, axis=-1,
-                               dtype=tf.float32)
-      start_features = tf.einsum("lbh,bl->bh", output, start_index)
-      start_features = tf.tile(start_features[None], [max_seq_length, 1, 1])
+      start_features = _gather_positions(
+          output, start_positions, seq_length, use_one_hot_embeddings)
+      start_features = tf.tile(start_features[None], [seq_length, 1, 1])
       end_logits = tf.layers.dense(
           tf.concat([output, start_features], axis=-1),
           albert_config.hidden_size,
@@ -1493,21 +1869,24 @@ def create_v2_model(albert_config, is_training, input_ids, input_mask,
 
       start_top_log_probs, start_top_index = tf.nn.top_k(
           start_log_probs, k=start_n_top)
-      start_index = tf.one_hot(start_top_index,
-                               depth=max_seq_length, axis=-1, dtype=tf.float32)
-      start_features = tf.einsum("lbh,bkl->bkh", output, start_index)
-      end_input = tf.tile(output[:, :, None],
-                          [1, 1, start_n_top, 1])
-      start_features = tf.tile(start_features[None],
-                               [max_seq_length, 1, 1, 1])
-      end_input = tf.concat([end_input, start_features], axis=-1)
-      end_logits = tf.layers.dense(
-          end_input,
-          albert_config.hidden_size,
-          kernel_initializer=modeling.create_initializer(
-              albert_config.initializer_range),
-          activation=tf.tanh,
-          name="dense_0")
+      start_features = _gather_positions(
+          output, start_top_index, seq_length, use_one_hot_embeddings)
+      # `dense_0` over concat([output, start_features]) without tiling both
+      # to [seq_length, batch, start_n_top, 2 * hidden]: the two halves of
+      # the kernel are applied separately and the projections broadcast-added.
+      hidden_size = albert_config.hidden_size
+      with tf.variable_scope("dense_0"):
+        kernel = tf.get_variable(
+            "kernel", [2 * hidden_size, hidden_size],
+            initializer=modeling.create_initializer(
+                albert_config.initializer_range))
+        bias = tf.get_variable(
+            "bias", [hidden_size], initializer=tf.zeros_initializer())
+      output_proj = tf.einsum("lbh,hd->lbd", output, kernel[:hidden_size])
+      start_proj = tf.einsum("bkh,hd->bkd", start_features,
+                             kernel[hidden_size:])
+      end_logits = tf.tanh(
+          output_proj[:, :, None] + start_proj[None] + bias)
       end_logits = contrib_layers.layer_norm(end_logits, begin_norm_axis=-1)
       end_logits = tf.layers.dense(
           end_logits,
@@ -1515,7 +1894,7 @@ def create_v2_model(albert_config, is_training, input_ids, input_mask,
           kernel_initializer=modeling.create_initializer(
               albert_config.initializer_range),
           name="dense_1")
-      end_logits = tf.reshape(end_logits, [max_seq_length, -1, start_n_top])
+      end_logits = tf.reshape(end_logits, [seq_length, -1, start_n_top])
       end_logits = tf.transpose(end_logits, [1, 2, 0])
       end_logits_masked = end_logits * (
           1 - p_mask[:, None]) - 1e30 * p_mask[:, None]
@@ -1541,10 +1920,9 @@ def create_v2_model(albert_config, is_training, input_ids, input_mask,
   # an additional layer to predict answerability
   with tf.variable_scope("answer_class"):
     # get the representation of CLS
-    cls_index = tf.one_hot(tf.zeros([bsz], dtype=tf.int32),
-                           max_seq_length,
-                           axis=-1, dtype=tf.float32)
-    cls_feature = tf.einsum("lbh,bl->bh", output, cls_index)
+    cls_feature = _gather_positions(
+        output, tf.zeros([bsz], dtype=tf.int32), seq_length,
+        use_one_hot_embeddings)
 
     # get the representation of START
     start_p = tf.nn.softmax(start_logits_masked, axis=-1,
@@ -1696,39 +2074,50 @@ def evaluate_v2(result_dict, cls_dict, prediction_json, eval_examples,
                 eval_features, all_results, n_best_size, max_answer_length,
                 output_prediction_file, output_nbest_file,
                 output_null_log_odds_file):
-  null_score_diff_threshold = None
+  """Writes and evaluates SQuAD v2.0 predictions at the best null threshold."""
+  # The n-best lists and null odds do not depend on the threshold, so they are
+  # computed and written once; predictions are written after the search.
   predictions, na_probs = write_predictions_v2(
       result_dict, cls_dict, eval_examples, eval_features,
       all_results, n_best_size, max_answer_length,
-      output_prediction_file, output_nbest_file,
-      output_null_log_odds_file, null_score_diff_threshold)
+      None, output_nbest_file, output_null_log_odds_file, None)
+  return evaluate_v2_predictions(prediction_json, predictions, na_probs,
+                                 output_prediction_file)
+
 
+def evaluate_v2_predictions(prediction_json, predictions, na_probs,
+                            output_prediction_file, metrics=None):
+  """Evaluates non-null predictions at the best null score threshold.
+
+  The thresholded predictions are written to `output_prediction_file`. Their
+  scores are derived from the scores of the non-null predictions, so answers
+  are only normalized and compared once. Pass a `SquadV2Metrics` built from
+  `prediction_json` as `metrics` to reuse it across checkpoints.
+  """
+  if metrics is None:
+    metrics = SquadV2Metrics(prediction_json)
   na_prob_thresh = 1.0  # default value taken from the eval script
-  qid_to_has_ans = make_qid_to_has_ans(prediction_json)  # maps qid to True/False
-  has_ans_qids = [k for k, v in qid_to_has_ans.items() if v]
-  no_ans_qids = [k for k, v in qid_to_has_ans.items() if not v]
-  exact_raw, f1_raw = get_raw_scores(prediction_json, predictions)
-  exact_thresh = apply_no_ans_threshold(exact_raw, na_probs, qid_to_has_ans,
-                                        na_prob_thresh)
-  f1_thresh = apply_no_ans_threshold(f1_raw, na_probs, qid_to_has_ans,
-                                     na_prob_thresh)
-  out_eval = make_eval_dict(exact_thresh, f1_thresh)
-  find_all_best_thresh(out_eval, predictions, exact_raw, f1_raw, na_probs, qid_to_has_ans)
-  null_score_diff_threshold = out_eval["best_f1_thresh"]
+  exact_raw, f1_raw = metrics.get_raw_scores(predictions)
+  _, null_score_diff_threshold = metrics.find_best_thresh(
+      predictions, f1_raw, na_probs)
+
+  thresholded_predictions = collections.OrderedDict()
+  for qid, text in predictions.items():
+    if na_probs[qid] < null_score_diff_threshold:
+      thresholded_predictions[qid] = text
+    else:
+      thresholded_predictions[qid] = ""
 
-  predictions, na_probs = write_predictions_v2(
-      result_dict, cls_dict,eval_examples, eval_features,
-      all_results, n_best_size, max_answer_length,
-      output_prediction_file, output_nbest_file,
-      output_null_log_odds_file, null_score_diff_threshold)
-
-  qid_to_has_ans = make_qid_to_has_ans(prediction_json)  # maps qid to True/False
-  has_ans_qids = [k for k, v in qid_to_has_ans.items() if v]
-  no_ans_qids = [k for k, v in qid_to_has_ans.items() if not v]
-  exact_raw, f1_raw = get_raw_scores(prediction_json, predictions)
-  exact_thresh = apply_no_ans_threshold(exact_raw, na_probs, qid_to_has_ans,
-                                        na_prob_thresh)
-  f1_thresh = apply_no_ans_threshold(f1_raw, na_probs, qid_to_has_ans,
+  tf.logging.info("Writing predictions to: %s" % (output_prediction_file))
+  with tf.gfile.GFile(output_prediction_file, "w") as writer:
+    writer.write(json.dumps(thresholded_predictions, indent=4) + "\n")
+
+  for qid in exact_raw:
+    if not thresholded_predictions[qid]:
+      exact_raw[qid] = f1_raw[qid] = metrics.null_scores[qid]
+  exact_thresh = apply_no_ans_threshold(exact_raw, na_probs,
+                                        metrics.qid_to_has_ans, na_prob_thresh)
+  f1_thresh = apply_no_ans_threshold(f1_raw, na_probs, metrics.qid_to_has_ans,
                                      na_prob_thresh)
   out_eval = make_eval_dict(exact_thresh, f1_thresh)
   out_eval["null_score_diff_threshold"] = null_score_diff_threshold